@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Micro-benchmarks for the daemon's hot paths, run in-process against
+# synthetic feeds.
+#
+#   benchmarks/bench.py [--feeds N] [--items N] [--repeat N] [--only substr]
+#                       [-o results.json] [--compare old.json]
+#
+# Each benchmark is run --repeat times on fresh state and the min, median and
+# mean of a single run are reported in seconds. With -o, results (along with
+# the git commit and parameters) are written as JSON, and --compare prints the
+# ratio of each median to the one in an earlier results file.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.tag import CantoTags, alltags
+from canto_next.search import search
+from canto_next.sortindex import sortindex
+from canto_next.config import config
+from canto_next.storage import CantoShelf
+from canto_next.protocol import CantoSocket
+from canto_next.compact import CompactEncoder, CompactDecoder
+from canto_next.transform import eval_transform
+
+from synthetic import generate_update_contents, generate_shelf, item_ids
+
+from threading import Thread, Lock
+import subprocess
+import platform
+import tempfile
+import getopt
+import shutil
+import socket
+import logging
+import json
+import time
+import zlib
+
+logging.basicConfig(level = logging.ERROR)
+
+results = {}
+
+def median(l):
+    l = sorted(l)
+    return l[len(l) // 2]
+
+def bench(name, func, setup = None, repeat = 5):
+    if only and only not in name:
+        return
+
+    times = []
+    for r in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        func(state)
+        times.append(time.perf_counter() - start)
+
+    results[name] = { "min" : min(times), "median" : median(times),
+            "mean" : sum(times) / len(times), "repeat" : repeat }
+
+    print("%-40s %10.3fms %10.3fms" % (name, results[name]["min"] * 1000,
+        results[name]["median"] * 1000))
+
+# In memory stand-in for CantoShelf.
+
+class BenchShelf(dict):
+    def update_mod(self):
+        pass
+
+    def update_umod(self):
+        pass
+
+# Populate allfeeds / alltags from a synthetic shelf, as the daemon does when
+# it loads from disk.
+
+def load_feeds(num_feeds, num_items):
+    alltags.reset()
+    allfeeds.reset()
+    search.reset()
+    sortindex.reset()
+    config.global_transform = None
+
+    shelf, feed_confs = generate_shelf(num_feeds, num_items)
+    shelf = BenchShelf(shelf)
+    feeds = []
+    for conf in feed_confs:
+        feed = CantoFeed(shelf, conf["name"], conf["url"], 10, 86400, False)
+        feed.index({ "entries" : [] })
+        feeds.append(feed)
+
+    return shelf, feeds
+
+def all_ids(shelf, feeds):
+    ids = []
+    for feed in feeds:
+        ids.extend(item_ids(feed.URL, shelf[feed.URL]["entries"]))
+    return ids
+
+def bench_index(num_feeds, num_items, repeat):
+    def setup_new():
+        alltags.reset()
+        allfeeds.reset()
+        search.reset()
+        sortindex.reset()
+        config.global_transform = None
+        feed = CantoFeed(BenchShelf(), "Feed", "http://example.com/", 10,
+                86400, False)
+        return feed, generate_update_contents(num_items)
+
+    def setup_unchanged():
+        feed, update = setup_new()
+        feed.index(generate_update_contents(num_items))
+        return feed, update
+
+    def setup_half():
+        feed, update = setup_new()
+        feed.index(generate_update_contents(num_items))
+        update = generate_update_contents(num_items, update_time = time.time() + 1)
+        for e in update["entries"][:num_items // 2]:
+            e["id"] += "new"
+        return feed, update
+
+    run = lambda s : s[0].index(s[1])
+
+    bench("index.new", run, setup_new, repeat)
+    bench("index.unchanged", run, setup_unchanged, repeat)
+    bench("index.half_new", run, setup_half, repeat)
+
+def bench_attributes(num_feeds, num_items, repeat):
+    def setup():
+        shelf, feeds = load_feeds(num_feeds, num_items)
+        return shelf, feeds[0]
+
+    def get(s):
+        shelf, feed = s
+        ids = item_ids(feed.URL, shelf[feed.URL]["entries"])
+        attrs = dict([ (i, [ "title", "canto-state" ]) for i in ids ])
+        feed.get_attributes(ids, attrs)
+
+    def set_(s):
+        shelf, feed = s
+        ids = item_ids(feed.URL, shelf[feed.URL]["entries"])[::10]
+        attrs = dict([ (i, { "canto-state" : [ "read" ] }) for i in ids ])
+        feed.set_attributes(ids, attrs)
+
+    # Marking a whole feed read, like MARKTAG.
+
+    def mark_all(s):
+        shelf, feed = s
+        ids = item_ids(feed.URL, shelf[feed.URL]["entries"])
+        allfeeds.set_attributes(dict([ (i, { "canto-state" : [ "read" ] })\
+                for i in ids ]))
+
+    bench("feed.get_attributes", get, setup, repeat)
+    bench("feed.set_attributes", set_, setup, repeat)
+    bench("feeds.set_attributes.all", mark_all, setup, repeat)
+
+def bench_tags(num_feeds, num_items, repeat):
+    def setup():
+        shelf, feeds = load_feeds(num_feeds, num_items)
+        return all_ids(shelf, feeds)
+
+    def add(ids):
+        tags = CantoTags()
+        for i, id in enumerate(ids):
+            tags.add_tag(id, "maintag:Feed %d" % (i % num_feeds))
+            tags.add_tag(id, "user:all")
+
+    def remove(ids):
+        for id in ids[::10]:
+            alltags.remove_id(id)
+
+    def changes(ids):
+        alltags.changed_tags = alltags.get_tags()
+        alltags.do_tag_changes()
+
+    def setup_filtered():
+        ids = setup()
+        config.global_transform = eval_transform("filter_read")
+        return ids
+
+    bench("tags.add_tag", add, setup, repeat)
+    bench("tags.remove_id", remove, setup, repeat)
+    bench("tags.do_tag_changes", changes, setup, repeat)
+    bench("tags.do_tag_changes.filter_read", changes, setup_filtered, repeat)
+
+TRANSFORMS = [
+    ("StateFilter", "StateFilter('read')"),
+    ("ContentFilterRegex", "ContentFilterRegex('title', '.*linux.*')"),
+    ("ContentFilter", "ContentFilter('title', 'linux')"),
+    ("ContentFilterRegex.alt",
+        "ContentFilterRegex('title', '.*(linux|bsd).*')"),
+    ("All.filters", "All(ContentFilter('title', 'linux'), "
+        "ContentFilter('title', 'bsd'), ContentFilter('title', 'mac'))"),
+    ("Any.filters", "Any(ContentFilter('title', 'linux'), "
+        "ContentFilter('title', 'bsd'), ContentFilter('title', 'mac'))"),
+    ("sort_alphabetical", "sort_alphabetical"),
+    ("sort_date", "sort_date"),
+    ("sort_feed", "sort_feed"),
+    ("All", "All(StateFilter('read'), ContentFilter('title', 'linux'))"),
+    ("Any", "Any(StateFilter('read'), ContentFilter('title', 'linux'))"),
+    ("InTags", "InTags('maintag:Feed 0')"),
+    ("ItemLimit", "ItemLimit(50)"),
+    ("newest_unread", "All(filter_read, sort_date, ItemLimit(50))"),
+    ("newest_filtered",
+        "All(ContentFilter('title', 'linux'), sort_date, ItemLimit(50))"),
+]
+
+def bench_transforms(num_feeds, num_items, repeat):
+    def setup():
+        shelf, feeds = load_feeds(num_feeds, num_items)
+        return all_ids(shelf, feeds)
+
+    for name, transform in TRANSFORMS:
+        t = eval_transform(transform)
+        bench("transform." + name, lambda ids : t(ids), setup, repeat)
+
+def bench_search(num_feeds, num_items, repeat):
+    if only and "search" not in only:
+        return
+
+    shelf, feeds = load_feeds(num_feeds, num_items)
+
+    def query(q, tags = None, limit = None):
+        def run(s):
+            alltags.tag_sets = {}
+            search.search(q, alltags.get_tags_set(tags), limit)
+        return run
+
+    # Including building the scope sets, as the first SEARCH after a tag
+    # change would.
+
+    bench("search.common", query("linux"), None, repeat)
+    bench("search.common_limit", query("linux", None, 50), None, repeat)
+    bench("search.and", query("linux kernel patch"), None, repeat)
+    bench("search.rare", query("title 42"), None, repeat)
+    bench("search.scoped", query("linux", [ "maintag:Feed 0" ]), None, repeat)
+
+    # What finding items took before, a regex over every item.
+
+    t = eval_transform("ContentFilterRegex('title', '.*linux.*')")
+    ids = all_ids(shelf, feeds)
+    bench("search.regex_scan", lambda s : t(ids), None, repeat)
+
+def bench_shelf(num_feeds, num_items, repeat):
+    tmpdir = tempfile.mkdtemp()
+    path = tmpdir + "/feeds"
+
+    def setup():
+        shelf, feeds = generate_shelf(num_feeds, num_items)
+        if os.path.exists(path):
+            os.unlink(path)
+        s = CantoShelf(path)
+        s.cache.update(shelf)
+        return s
+
+    def setup_open():
+        setup().sync()
+
+    bench("shelf.sync", lambda s : s.sync(), setup, repeat)
+    bench("shelf.open", lambda s : CantoShelf(path), setup_open, repeat)
+
+    shutil.rmtree(tmpdir)
+
+# A CantoSocket end of a socketpair.
+
+class BenchSocket(CantoSocket):
+    def __init__(self, sock):
+        self.sock = sock
+        CantoSocket.__init__(self, None)
+
+    def connect(self):
+        self.sockets.append(self.sock)
+        self.read_locks[self.sock] = Lock()
+        self.write_locks[self.sock] = Lock()
+        self.write_frags[self.sock] = None
+
+def bench_protocol(num_feeds, num_items, repeat):
+    shelf, feeds = load_feeds(num_feeds, num_items)
+    ids = all_ids(shelf, feeds)
+
+    attrs = {}
+    for feed in feeds:
+        feed_ids = item_ids(feed.URL, shelf[feed.URL]["entries"])
+        attrs.update(feed.get_attributes(feed_ids,
+            dict([ (i, [ "title", "link", "canto-state" ]) for i in feed_ids ])))
+
+    messages = [ ("ITEMS", { "maintag:Feed 0" : ids }), ("ATTRIBUTES", attrs) ]
+    messages += [ ("PING", []) ] * 100
+
+    def roundtrip(s, options = None):
+        a, b = socket.socketpair()
+        writer, reader = BenchSocket(a), BenchSocket(b)
+        if options:
+            writer.set_options(a, options)
+
+        def read():
+            for m in messages:
+                reader.do_read(b)
+
+        t = Thread(target = read)
+        t.start()
+        for cmd, args in messages:
+            writer.do_write(a, cmd, args)
+        t.join()
+
+        a.close()
+        b.close()
+
+    bench("protocol.roundtrip", roundtrip, None, repeat)
+    bench("protocol.roundtrip_compact", lambda s : roundtrip(s,
+        { "encoding" : "compact" }), None, repeat)
+    bench("protocol.roundtrip_zlib", lambda s : roundtrip(s,
+        { "compression" : "zlib" }), None, repeat)
+    bench("protocol.roundtrip_compact_zlib", lambda s : roundtrip(s,
+        { "encoding" : "compact", "compression" : "zlib" }), None, repeat)
+
+    # Wire size and decode time of the big messages alone.
+
+    for cmd, args in messages[:2]:
+        name = "protocol." + cmd.lower()
+        if only and only not in name:
+            continue
+
+        data = json.dumps((cmd, args)).encode("UTF-8")
+
+        # Time the second encoding, when the string table is already
+        # populated, as it is for all but the first message on a connection.
+
+        enc = CompactEncoder()
+        dec = CompactDecoder()
+        dec.decode(enc.encode((cmd, args)))
+        cdata = enc.encode((cmd, args))
+
+        bench(name + ".json_parse", lambda s : json.loads(data.decode()),
+                None, repeat)
+        bench(name + ".compact_parse", lambda s : dec.decode(cdata), None,
+                repeat)
+        print("%-40s %10d %10d bytes" % (name + " json/compact", len(data),
+            len(cdata)))
+
+        # And with zlib, again the second message in the stream.
+
+        sizes = []
+        for d in [ data, cdata ]:
+            c = zlib.compressobj(1)
+            c.compress(d)
+            c.flush(zlib.Z_SYNC_FLUSH)
+            sizes.append(len(c.compress(d) + c.flush(zlib.Z_SYNC_FLUSH)))
+        print("%-40s %10d %10d bytes" % (name + " json/compact zlib",
+            sizes[0], sizes[1]))
+
+def git_commit():
+    try:
+        return subprocess.check_output([ "git", "rev-parse", "HEAD" ],
+                cwd = os.path.dirname(os.path.abspath(__file__)),
+                stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(old_path):
+    old = json.load(open(old_path))["results"]
+    print("\n%-40s %10s %10s %7s" % ("vs. " + old_path, "old", "new", "ratio"))
+    for name in sorted(results.keys()):
+        if name not in old:
+            continue
+        o = old[name]["median"]
+        n = results[name]["median"]
+        print("%-40s %9.3fms %9.3fms %6.2fx" % (name, o * 1000, n * 1000,
+            n / o if o else 0))
+
+def write_results(path, params):
+    out = { "commit" : git_commit(), "python" : platform.python_version(),
+            "time" : time.time(), "params" : params, "results" : results }
+    f = open(path, "w")
+    json.dump(out, f, indent = 4, sort_keys = True)
+    f.close()
+
+only = None
+
+def main():
+    global only
+
+    optlist, args = getopt.getopt(sys.argv[1:], "o:",
+            [ "feeds=", "items=", "repeat=", "only=", "compare=" ])
+
+    params = { "feeds" : 10, "items" : 100, "repeat" : 5 }
+    output = None
+    old = None
+
+    for opt, arg in optlist:
+        if opt in [ "--feeds", "--items", "--repeat" ]:
+            params[opt[2:]] = int(arg)
+        elif opt == "--only":
+            only = arg
+        elif opt == "-o":
+            output = arg
+        elif opt == "--compare":
+            old = arg
+
+    print("%-40s %12s %12s" % ("%(feeds)d feeds x %(items)d items" % params,
+        "min", "median"))
+
+    for func in [ bench_index, bench_attributes, bench_tags, bench_transforms,
+            bench_search, bench_shelf, bench_protocol ]:
+        func(params["feeds"], params["items"], params["repeat"])
+
+    if output:
+        write_results(output, params)
+    if old:
+        compare(old)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# A local stand-in for the internet, serving thousands of synthetic RSS and
+# Atom feeds so the fetch pipeline can be load tested without hitting anybody.
+#
+#   benchmarks/feedserver.py [options]          serve until ^C
+#   benchmarks/feedserver.py --bench [options]  point a daemon at it
+#
+# Feeds are at http://127.0.0.1:PORT/feed/N and each gets a behavior, chosen
+# with a fixed seed from the fractions below:
+#
+#   --feeds N           number of feeds (1000)
+#   --items N           items in each document (20)
+#   --words N           words in each item description, i.e. size (50)
+#   --churn N           new items per feed per minute (1)
+#   --latency S         seconds before every response (0)
+#   --slow F            fraction of feeds on "slow hosts", which add
+#                       --slow-latency S (5) seconds
+#   --fail F            fraction of feeds that fail, alternating between
+#                       500s and dropped connections
+#   --atom F            fraction of feeds served as Atom instead of RSS (0.2)
+#   --basic F           fraction of feeds behind Basic auth
+#   --digest F          fraction of feeds behind Digest auth
+#   --no-etag           never answer 304
+#   --port N            port to listen on (0 picks one)
+#
+# Authenticated feeds take user "canto" and password "canto". Unless
+# --no-etag, every response has an ETag and Last-Modified and conditional
+# requests for unchanged feeds get a 304.
+#
+# With --bench, a daemon from this tree is started against a config with every
+# feed (with http-pool enabled if --pool is given), and after --duration
+# seconds (120, at least two of the daemon's one minute fetch rounds, or all
+# we'd see is the first fetch) we report:
+#
+#   feeds/sec    - successful fetches (200 or 304) per second
+#   freshness    - how long after being published items show up in the daemon
+#   CPU / item   - daemon CPU time per item served to it
+#
+# If the bench fails, the daemon's config dir (with its log and output) is
+# left behind for a look.
+
+import os
+import sys
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+
+from canto_next.client import CantoClient
+
+from synthetic import words
+from load import start_daemon, git_commit, percentile
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+from email.utils import formatdate
+import hashlib
+import tempfile
+import random
+import getopt
+import shutil
+import base64
+import socket
+import time
+import gzip
+import json
+import re
+
+USER = "canto"
+PASSWORD = "canto"
+REALM = "canto"
+
+# Minutes between fetches of each feed in the bench config. Rates are whole
+# minutes, so this is as low as it goes.
+
+BENCH_RATE = 1
+
+DEFAULTS = { "feeds" : 1000, "items" : 20, "words" : 50, "churn" : 1.0,
+        "latency" : 0.0, "slow" : 0.0, "slow-latency" : 5.0, "fail" : 0.0,
+        "atom" : 0.2, "basic" : 0.0, "digest" : 0.0, "port" : 0, "seed" : 0 }
+
+item_regex = re.compile("/feed/(\\d+)/item/(\\d+)")
+
+def md5(s):
+    return hashlib.md5(s.encode("UTF-8")).hexdigest()
+
+class FeedSpec():
+    def __init__(self, n, rng, params):
+        self.n = n
+        self.atom = rng.random() < params["atom"]
+        self.slow = rng.random() < params["slow"]
+        self.fail = rng.random() < params["fail"]
+
+        r = rng.random()
+        if r < params["basic"]:
+            self.auth = "basic"
+        elif r < params["basic"] + params["digest"]:
+            self.auth = "digest"
+        else:
+            self.auth = None
+
+        self.requests = 0
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, headers = {}, body = b""):
+        self.send_response(status)
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def challenge(self, spec):
+        if spec.auth == "basic":
+            value = 'Basic realm="%s"' % REALM
+        else:
+            value = 'Digest realm="%s", nonce="%s", qop="auth", algorithm=MD5' %\
+                    (REALM, md5("%s" % random.random()))
+        self.respond(401, { "WWW-Authenticate" : value })
+
+    def authorized(self, spec):
+        auth = self.headers.get("Authorization", "")
+
+        if spec.auth == "basic":
+            creds = base64.b64encode(("%s:%s" % (USER, PASSWORD)).encode())
+            return auth == "Basic " + creds.decode()
+
+        if not auth.startswith("Digest "):
+            return False
+
+        fields = dict(re.findall('(\\w+)="?([^",]*)"?', auth[7:]))
+        try:
+            ha1 = md5("%s:%s:%s" % (fields["username"], REALM, PASSWORD))
+            ha2 = md5("GET:%s" % fields["uri"])
+            expected = md5("%s:%s:%s:%s:%s:%s" % (ha1, fields["nonce"],
+                fields["nc"], fields["cnonce"], fields["qop"], ha2))
+        except KeyError:
+            return False
+
+        return fields["username"] == USER and fields["response"] == expected
+
+    def do_GET(self):
+        server = self.server
+        m = re.match("^/feed/(\\d+)$", self.path)
+        if not m or int(m.group(1)) >= len(server.specs):
+            server.count("not_found")
+            self.respond(404)
+            return
+
+        spec = server.specs[int(m.group(1))]
+        spec.requests += 1
+
+        delay = server.params["latency"]
+        if spec.slow:
+            delay += server.params["slow-latency"]
+        if delay:
+            time.sleep(delay)
+
+        if spec.auth and not self.authorized(spec):
+            server.count("unauthorized")
+            self.challenge(spec)
+            return
+
+        if spec.fail:
+            server.count("failed")
+            if spec.requests % 2:
+                self.respond(500, {}, b"Internal Server Error")
+            else:
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        newest = server.newest()
+        etag = '"%d-%d"' % (spec.n, newest)
+        modified = formatdate(server.published(newest), usegmt = True)
+
+        if server.etags and self.headers.get("If-None-Match") == etag:
+            server.count("not_modified")
+            self.respond(304, { "ETag" : etag })
+            return
+
+        body = server.document(spec, newest)
+        headers = { "Content-Type" : "application/atom+xml" if spec.atom\
+                else "application/rss+xml" }
+
+        if server.etags:
+            headers["ETag"] = etag
+            headers["Last-Modified"] = modified
+
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, 1)
+            headers["Content-Encoding"] = "gzip"
+
+        server.count("ok")
+        server.count("items", server.params["items"])
+        self.respond(200, headers, body)
+
+class CantoFeedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, params):
+        self.params = DEFAULTS.copy()
+        self.params.update(params)
+        self.etags = not self.params.get("no-etag", False)
+
+        rng = random.Random(self.params["seed"])
+        self.specs = [ FeedSpec(n, rng, self.params)\
+                for n in range(self.params["feeds"]) ]
+
+        # Item i is published at epoch + (i - items) * 60 / churn, so there's
+        # a full document of backlog at startup.
+
+        self.epoch = time.time()
+
+        self.lock = Lock()
+        self.counts = {}
+        self.cache = {}
+
+        HTTPServer.__init__(self, ("127.0.0.1", self.params["port"]),
+                FeedHandler)
+
+    def count(self, key, n = 1):
+        self.lock.acquire()
+        self.counts[key] = self.counts.get(key, 0) + n
+        self.lock.release()
+
+    def newest(self, now = None):
+        if now == None:
+            now = time.time()
+        items = self.params["items"]
+        if not self.params["churn"]:
+            return items - 1
+        return items - 1 + int((now - self.epoch) * self.params["churn"] / 60)
+
+    def published(self, i):
+        if not self.params["churn"]:
+            return self.epoch
+        return self.epoch + (i - self.params["items"] + 1) * 60 / self.params["churn"]
+
+    def url(self, n):
+        return "http://127.0.0.1:%d/feed/%d" % (self.server_address[1], n)
+
+    # Content only depends on (feed, newest item), so keep the last document
+    # for each feed.
+
+    def document(self, spec, newest):
+        key = spec.n
+        cached = self.cache.get(key)
+        if cached and cached[0] == newest:
+            return cached[1]
+
+        doc = self._render(spec, newest)
+        self.cache[key] = (newest, doc)
+        return doc
+
+    def _render(self, spec, newest):
+        base = self.url(spec.n)
+        rng = random.Random(spec.n)
+        entries = []
+
+        for i in range(newest, max(newest - self.params["items"], -1), -1):
+            link = "%s/item/%d" % (base, i)
+            title = "Feed %d item %d %s" % (spec.n, i, words(rng, 5))
+            body = words(rng, self.params["words"])
+            stamp = self.published(i)
+
+            if spec.atom:
+                entries.append("<entry><title>%s</title><id>%s</id>"\
+                        '<link href="%s"/><updated>%s</updated>'\
+                        "<summary>%s</summary></entry>" % (title, link, link,
+                            time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                time.gmtime(stamp)), body))
+            else:
+                entries.append("<item><title>%s</title><guid>%s</guid>"\
+                        "<link>%s</link><pubDate>%s</pubDate>"\
+                        "<description>%s</description></item>" % (title, link,
+                            link, formatdate(stamp, usegmt = True), body))
+
+        if spec.atom:
+            doc = '<?xml version="1.0" encoding="utf-8"?>'\
+                    '<feed xmlns="http://www.w3.org/2005/Atom">'\
+                    "<title>Feed %d</title><id>%s</id><updated>%s</updated>%s"\
+                    "</feed>" % (spec.n, base, time.strftime(\
+                        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.published(newest))),
+                        "".join(entries))
+        else:
+            doc = '<?xml version="1.0" encoding="utf-8"?><rss version="2.0">'\
+                    "<channel><title>Feed %d</title><link>%s</link>"\
+                    "<description>Synthetic feed</description>%s</channel>"\
+                    "</rss>" % (spec.n, base, "".join(entries))
+
+        return doc.encode("UTF-8")
+
+    # Config entries for canto-daemon.
+
+    def feed_confs(self):
+        confs = []
+        for spec in self.specs:
+            conf = { "name" : "Feed %d" % spec.n, "url" : self.url(spec.n) }
+            if spec.auth:
+                conf["username"] = USER
+                conf["password"] = PASSWORD
+            confs.append(conf)
+        return confs
+
+def cpu_seconds(pid):
+    try:
+        f = open("/proc/%d/stat" % pid)
+        fields = f.read().rsplit(")", 1)[1].split()
+        f.close()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return None
+
+def bench(server, duration, pool, interval, daemon_args):
+    conf_dir = tempfile.mkdtemp()
+
+    f = open(conf_dir + "/conf", "w")
+    json.dump({ "defaults" : { "rate" : BENCH_RATE,
+        "global_transform" : "None" },
+        "feeds" : server.feed_confs() }, f)
+    f.close()
+
+    if pool:
+        os.mkdir(conf_dir + "/plugins")
+        shutil.copy(top + "/plugins/http-pool.py", conf_dir + "/plugins/")
+        daemon_args = [ "--enableplugins", "http-pool" ] + daemon_args
+
+    # start_daemon passes --nofetch, which is the last thing we want.
+
+    tags = [ "maintag:Feed %d" % spec.n for spec in server.specs ]
+    seen = set()
+    lags = []
+
+    proc = None
+    ok = False
+    try:
+        proc, sock = start_daemon(conf_dir, daemon_args, fetch = True)
+
+        client = CantoClient(sock)
+        start = time.time()
+        cpu_start = cpu_seconds(proc.pid)
+        counts_start = server.counts.copy()
+
+        while time.time() - start < duration:
+            time.sleep(interval)
+
+            client.write("ITEMS", tags)
+            now = time.time()
+
+            # One ITEMS and ITEMSDONE per tag
+
+            done = 0
+            while done < len(tags):
+                r = client.read()
+                if type(r) == int:
+                    raise Exception("Lost connection to daemon")
+                if r[0] == "ITEMSDONE":
+                    done += 1
+                    continue
+                if r[0] != "ITEMS":
+                    continue
+
+                for items in r[1].values():
+                    for id in items:
+                        if id in seen:
+                            continue
+                        seen.add(id)
+
+                        m = item_regex.search(id)
+                        if not m:
+                            continue
+
+                        published = server.published(int(m.group(2)))
+                        if published > start:
+                            lags.append(now - published)
+
+        elapsed = time.time() - start
+        cpu = cpu_seconds(proc.pid)
+        if cpu != None and cpu_start != None:
+            cpu -= cpu_start
+        ok = True
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        if ok:
+            shutil.rmtree(conf_dir)
+        else:
+            print("Daemon log and output kept in %s" % conf_dir)
+
+    counts = {}
+    for key in server.counts:
+        counts[key] = server.counts[key] - counts_start.get(key, 0)
+
+    fetched = counts.get("ok", 0) + counts.get("not_modified", 0)
+    items = counts.get("items", 0)
+    lags.sort()
+
+    results = { "elapsed" : elapsed, "counts" : counts,
+            "feeds_per_sec" : fetched / elapsed,
+            "freshness" : { "items" : len(lags),
+                "p50" : percentile(lags, 0.5), "p90" : percentile(lags, 0.9),
+                "max" : lags[-1] if lags else 0 },
+            "cpu" : cpu,
+            "cpu_per_item" : cpu / items if cpu and items else None }
+
+    print("%d feeds, %.0fs: %s" % (len(server.specs), elapsed, counts))
+    print("feeds/sec: %.1f" % results["feeds_per_sec"])
+    print("freshness: %d new items, p50 %.1fs p90 %.1fs max %.1fs" %\
+            (len(lags), results["freshness"]["p50"],
+                results["freshness"]["p90"], results["freshness"]["max"]))
+    if results["cpu_per_item"]:
+        print("CPU: %.2fs, %.3fms per item" % (cpu,
+            results["cpu_per_item"] * 1000))
+
+    return results
+
+def main():
+    opts = [ key + "=" for key in DEFAULTS ] + [ "no-etag", "bench", "pool",
+            "duration=", "interval=", "daemon-arg=" ]
+    optlist, args = getopt.getopt(sys.argv[1:], "o:", opts)
+
+    params = {}
+    bench_mode = False
+    pool = False
+    duration = 120
+    interval = 2
+    daemon_args = []
+    output = None
+
+    for opt, arg in optlist:
+        key = opt[2:]
+        if key == "bench":
+            bench_mode = True
+        elif key == "pool":
+            pool = True
+        elif key == "no-etag":
+            params["no-etag"] = True
+        elif key == "duration":
+            duration = float(arg)
+        elif key == "interval":
+            interval = float(arg)
+        elif key == "daemon-arg":
+            daemon_args.append(arg)
+        elif opt == "-o":
+            output = arg
+        elif type(DEFAULTS[key]) == int:
+            params[key] = int(arg)
+        else:
+            params[key] = float(arg)
+
+    if bench_mode and duration < 2 * BENCH_RATE * 60:
+        print("--duration must be at least %d seconds, the daemon only"\
+                " fetches every %d minute(s)" % (2 * BENCH_RATE * 60,
+                    BENCH_RATE))
+        sys.exit(1)
+
+    server = CantoFeedServer(params)
+    Thread(target = server.serve_forever, daemon = True).start()
+
+    print("Serving %d feeds at %s" % (len(server.specs), server.url(0)))
+
+    if not bench_mode:
+        try:
+            while True:
+                time.sleep(10)
+                print(server.counts)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    results = bench(server, duration, pool, interval, daemon_args)
+    results["params"] = server.params
+    results["pool"] = pool
+    results["commit"] = git_commit()
+
+    if output:
+        f = open(output, "w")
+        json.dump(results, f, indent = 4, sort_keys = True)
+        f.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# End-to-end client load against a real daemon.
+#
+#   benchmarks/load.py [--feeds N] [--items N] [--clients N] [--ops N]
+#                      [--daemon-arg ARG ...] [-o results.json]
+#
+# A canto-daemon from this tree is started with --nofetch --noplugins in a
+# temporary directory, with a synthetic feed database and config. Then
+# --clients connections each run --ops rounds of:
+#
+#   ITEMS on a random feed's tag (until ITEMSDONE)
+#   ATTRIBUTES for 50 of its items
+#   SETATTRIBUTES toggling canto-state on 5 of them (followed by PING, so the
+#       time is until the daemon has processed it)
+#
+# over the unix socket, and latency percentiles and throughput are reported
+# per command.
+
+import os
+import sys
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+
+from canto_next.client import CantoClient
+
+from synthetic import generate_shelf, item_ids
+
+from threading import Thread
+import subprocess
+import platform
+import tempfile
+import getopt
+import shutil
+import random
+import json
+import gzip
+import time
+
+# REPLACE_VERSION and GIT_HASH are filled in by setup.py on install, so define
+# them to run canto-daemon straight from the source tree.
+
+DAEMON = "import builtins;"\
+        "builtins.REPLACE_VERSION = 'bench'; builtins.GIT_HASH = '';"\
+        "from canto_next.canto_backend import CantoBackend;"\
+        "CantoBackend()"
+
+def start_daemon(conf_dir, extra_args, fetch = False, plugins = False):
+    env = os.environ.copy()
+    env["PYTHONPATH"] = top + os.pathsep + env.get("PYTHONPATH", "")
+
+    args = [ sys.executable, "-c", DAEMON, "-D", conf_dir ]
+    if not fetch:
+        args.append("--nofetch")
+    if not plugins:
+        args.append("--noplugins")
+
+    # Anything that doesn't make it to daemon-log, like a traceback on
+    # startup, goes to daemon-output.
+
+    output = open(conf_dir + "/daemon-output", "w")
+    proc = subprocess.Popen(args + extra_args, env = env,
+        stdout = output, stderr = subprocess.STDOUT)
+    output.close()
+
+    sock = conf_dir + "/.canto_socket"
+    for i in range(300):
+        if os.path.exists(sock):
+            return proc, sock
+        if proc.poll() != None:
+            break
+        time.sleep(0.1)
+
+    raise Exception("Daemon failed to start, see %s/daemon-log and "\
+            "daemon-output" % conf_dir)
+
+def wait_response(client, cmd):
+    while True:
+        r = client.read()
+        if type(r) == int:
+            raise Exception("Connection lost: %s" % r)
+        if r and r[0] == cmd:
+            return r[1]
+        if r and r[0] == "EXCEPT":
+            raise Exception("Daemon exception: %s" % r[1])
+
+def percentile(l, p):
+    if not l:
+        return 0
+    return l[min(len(l) - 1, int(len(l) * p))]
+
+class LoadClient(Thread):
+    def __init__(self, sock, tags, ids, ops, seed):
+        Thread.__init__(self)
+        self.sock = sock
+        self.tags = tags
+        self.ids = ids
+        self.ops = ops
+        self.rng = random.Random(seed)
+        self.times = { "ITEMS" : [], "ATTRIBUTES" : [], "SETATTRIBUTES" : [] }
+        self.error = None
+
+    def timed(self, name, func):
+        start = time.perf_counter()
+        func()
+        self.times[name].append(time.perf_counter() - start)
+
+    def run(self):
+        try:
+            self._run()
+        except Exception as e:
+            self.error = e
+
+    def _run(self):
+        client = CantoClient(self.sock)
+
+        for i in range(self.ops):
+            tag = self.rng.choice(self.tags)
+            ids = self.ids[tag]
+
+            def items():
+                client.write("ITEMS", [ tag ])
+                wait_response(client, "ITEMSDONE")
+
+            def attributes():
+                req = dict([ (id, [ "title", "link", "canto-state" ])\
+                        for id in self.rng.sample(ids, min(50, len(ids))) ])
+                client.write("ATTRIBUTES", req)
+                wait_response(client, "ATTRIBUTES")
+
+            def setattributes():
+                state = [ "read" ] if i % 2 else []
+                req = dict([ (id, { "canto-state" : state })\
+                        for id in self.rng.sample(ids, min(5, len(ids))) ])
+                client.write("SETATTRIBUTES", req)
+                client.write("PING", [])
+                wait_response(client, "PONG")
+
+            self.timed("ITEMS", items)
+            self.timed("ATTRIBUTES", attributes)
+            self.timed("SETATTRIBUTES", setattributes)
+
+        client.sockets[0].close()
+
+def git_commit():
+    try:
+        return subprocess.check_output([ "git", "rev-parse", "HEAD" ],
+                cwd = top, stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    optlist, args = getopt.getopt(sys.argv[1:], "o:",
+            [ "feeds=", "items=", "clients=", "ops=", "daemon-arg=" ])
+
+    params = { "feeds" : 20, "items" : 100, "clients" : 4, "ops" : 50 }
+    daemon_args = []
+    output = None
+
+    for opt, arg in optlist:
+        if opt == "-o":
+            output = arg
+        elif opt == "--daemon-arg":
+            daemon_args.append(arg)
+        else:
+            params[opt[2:]] = int(arg)
+
+    conf_dir = tempfile.mkdtemp()
+
+    shelf, feeds = generate_shelf(params["feeds"], params["items"])
+    shelf["control"] = {}
+
+    f = gzip.open(conf_dir + "/feeds", "wt", 9, "UTF-8")
+    json.dump(shelf, f)
+    f.close()
+
+    f = open(conf_dir + "/conf", "w")
+    json.dump({ "defaults" : { "global_transform" : "None" },
+        "feeds" : feeds }, f)
+    f.close()
+
+    ids = {}
+    for feed in feeds:
+        ids["maintag:" + feed["name"]] =\
+                item_ids(feed["url"], shelf[feed["url"]]["entries"])
+
+    proc, sock = start_daemon(conf_dir, daemon_args)
+
+    try:
+        # Wait for the daemon to finish loading from disk.
+
+        client = CantoClient(sock)
+        last = "maintag:" + feeds[-1]["name"]
+        while True:
+            client.write("ITEMS", [ last ])
+            if wait_response(client, "ITEMS")[last]:
+                break
+            time.sleep(0.1)
+        client.sockets[0].close()
+
+        clients = [ LoadClient(sock, list(ids.keys()), ids, params["ops"], i)\
+                for i in range(params["clients"]) ]
+
+        start = time.perf_counter()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.perf_counter() - start
+
+        for c in clients:
+            if c.error:
+                raise c.error
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(conf_dir)
+
+    results = {}
+    print("%d clients x %d ops, %d feeds x %d items, %.2fs" %\
+            (params["clients"], params["ops"], params["feeds"],
+                params["items"], elapsed))
+    print("%-15s %8s %10s %10s %10s %10s" % ("command", "count", "ops/s",
+        "p50", "p90", "p99"))
+
+    for cmd in [ "ITEMS", "ATTRIBUTES", "SETATTRIBUTES" ]:
+        times = sorted(sum([ c.times[cmd] for c in clients ], []))
+        results[cmd] = { "count" : len(times),
+                "ops_per_sec" : len(times) / elapsed,
+                "p50" : percentile(times, 0.5),
+                "p90" : percentile(times, 0.9),
+                "p99" : percentile(times, 0.99),
+                "max" : times[-1] }
+        r = results[cmd]
+        print("%-15s %8d %10.1f %8.2fms %8.2fms %8.2fms" % (cmd, r["count"],
+            r["ops_per_sec"], r["p50"] * 1000, r["p90"] * 1000,
+            r["p99"] * 1000))
+
+    if output:
+        f = open(output, "w")
+        json.dump({ "commit" : git_commit(),
+            "python" : platform.python_version(), "time" : time.time(),
+            "params" : params, "elapsed" : elapsed, "results" : results },
+            f, indent = 4, sort_keys = True)
+        f.close()
+
+if __name__ == "__main__":
+    main()
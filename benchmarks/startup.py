@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Cold start time of one-shot canto-remote commands.
+#
+#   benchmarks/startup.py [--runs N] [--plugins] [--imports]
+#                         [-o results.json] [command ...]
+#
+# A canto-daemon from this tree is started on an empty config, then each
+# command (by default "status" and "force-update") is run --runs times as a
+# fresh canto-remote process, and wall time from exec to exit is reported
+# alongside bare interpreter startup and just importing canto_next.remote.
+#
+# --plugins copies the bundled plugins into the config directory first, as
+# a typical install would have them. --imports prints the slowest imports
+# (from python -X importtime) for the first command.
+
+import os
+import sys
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+
+from load import start_daemon, git_commit
+
+import subprocess
+import platform
+import tempfile
+import getopt
+import shutil
+import json
+import time
+
+BUILTINS = "import builtins;"\
+        "builtins.REPLACE_VERSION = 'bench'; builtins.GIT_HASH = '';"
+
+REMOTE = BUILTINS + "from canto_next.remote import CantoRemote; CantoRemote()"
+
+def median(l):
+    l = sorted(l)
+    return l[len(l) // 2]
+
+def timed_runs(args, runs, env):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.call(args, env = env, stdin = subprocess.DEVNULL,
+                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return { "min" : min(times), "median" : median(times), "runs" : runs }
+
+def slowest_imports(args, env, n = 15):
+    p = subprocess.run([ args[0], "-X", "importtime" ] + args[1:], env = env,
+            stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL,
+            stderr = subprocess.PIPE)
+
+    imports = []
+    for line in p.stderr.decode().split("\n"):
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[12:].split("|")
+        try:
+            imports.append((int(fields[1]), fields[2].rstrip()))
+        except ValueError:
+            pass
+
+    imports.sort(reverse = True)
+    return imports[:n]
+
+def main():
+    optlist, commands = getopt.getopt(sys.argv[1:], "o:",
+            [ "runs=", "plugins", "imports" ])
+
+    runs = 20
+    plugins = False
+    imports = False
+    output = None
+
+    for opt, arg in optlist:
+        if opt == "--runs":
+            runs = int(arg)
+        elif opt == "--plugins":
+            plugins = True
+        elif opt == "--imports":
+            imports = True
+        elif opt == "-o":
+            output = arg
+
+    if not commands:
+        commands = [ "status", "force-update" ]
+
+    conf_dir = tempfile.mkdtemp()
+
+    f = open(conf_dir + "/conf", "w")
+    json.dump({ "feeds" : [] }, f)
+    f.close()
+
+    if plugins:
+        os.mkdir(conf_dir + "/plugins")
+        for fname in os.listdir(top + "/plugins"):
+            if fname.endswith(".py"):
+                shutil.copy(top + "/plugins/" + fname, conf_dir + "/plugins/")
+
+    env = os.environ.copy()
+    env["PYTHONPATH"] = top + os.pathsep + env.get("PYTHONPATH", "")
+
+    results = {}
+    proc, sock = start_daemon(conf_dir, [])
+
+    try:
+        results["python"] = timed_runs([ sys.executable, "-c", "pass" ],
+                runs, env)
+        results["import"] = timed_runs([ sys.executable, "-c", BUILTINS +\
+                "import canto_next.remote" ], runs, env)
+
+        for cmd in commands:
+            args = [ sys.executable, "-c", REMOTE, "-D", conf_dir ] + cmd.split()
+            results[cmd] = timed_runs(args, runs, env)
+
+            if imports and cmd == commands[0]:
+                slowest = slowest_imports(args, env)
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(conf_dir)
+
+    print("%-20s %10s %10s" % ("%d runs" % runs, "min", "median"))
+    for name in [ "python", "import" ] + commands:
+        print("%-20s %8.1fms %8.1fms" % (name, results[name]["min"] * 1000,
+            results[name]["median"] * 1000))
+
+    if imports:
+        print("\nSlowest imports (cumulative) for %s:" % commands[0])
+        for us, name in slowest:
+            print("%8.1fms %s" % (us / 1000, name))
+
+    if output:
+        f = open(output, "w")
+        json.dump({ "commit" : git_commit(),
+            "python" : platform.python_version(), "time" : time.time(),
+            "plugins" : plugins, "results" : results }, f, indent = 4,
+            sort_keys = True)
+        f.close()
+
+if __name__ == "__main__":
+    main()
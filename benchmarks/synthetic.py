@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Synthetic content for benchmarks. Everything is derived from a seed, so the
+# same arguments always give the same feeds.
+
+import random
+import json
+import time
+
+TEST_URL = "http://example.com/%d/"
+
+WORDS = ("canto rss reader daemon feed item story python linux kernel release "
+        "update security patch news review comic science space music video "
+        "open source free software network storage memory thread lock tag "
+        "filter sort transform client server socket protocol").split()
+
+# Like the item templates in tests/test-feed-index.py, "%d" in any string
+# value is replaced with the item number.
+
+ITEM_TEMPLATE = {
+        "title" : "Title %d",
+        "link" : "http://example.com/item/%d/",
+        "id" : "http://example.com/item/%d/",
+}
+
+def words(rng, n):
+    return " ".join([ rng.choice(WORDS) for i in range(n) ])
+
+def generate_update_contents(num_items, item_content_template = ITEM_TEMPLATE,
+        update_time = None, seed = 0, body_words = 50):
+    rng = random.Random(seed)
+
+    if update_time == None:
+        update_time = time.time()
+
+    entries = []
+
+    for i in range(num_items):
+        c = eval(repr(item_content_template))
+        for key in c:
+            if type(c[key]) == str and "%d" in c[key]:
+                c[key] = c[key] % i
+
+        c["title"] += " " + words(rng, 6)
+        c["summary"] = words(rng, body_words)
+        c["author"] = words(rng, 2)
+        c["published_parsed"] = list(time.gmtime(update_time - i * 3600))
+        entries.append(c)
+
+    return { "canto_update" : update_time, "entries" : entries }
+
+# Generate num_feeds feeds' worth of shelf content, as the daemon would have
+# stored it. read is the fraction of items marked read.
+
+def generate_shelf(num_feeds, num_items, read = 0.5, seed = 0):
+    rng = random.Random(seed)
+    shelf = {}
+    feeds = []
+
+    now = time.time()
+
+    for f in range(num_feeds):
+        URL = TEST_URL % f
+        template = { "title" : "Feed %d Item %%d" % f,
+                "link" : URL + "%d/", "id" : URL + "%d/" }
+
+        update = generate_update_contents(num_items, template, now, seed + f)
+        for entry in update["entries"]:
+            entry["canto_update"] = now
+            if rng.random() < read:
+                entry["canto-state"] = [ "read" ]
+            else:
+                entry["canto-state"] = []
+
+        shelf[URL] = update
+        feeds.append({ "name" : "Feed %d" % f, "url" : URL })
+
+    return shelf, feeds
+
+# Full item ids (as used by tags and the protocol) for a generated feed.
+
+def item_ids(URL, entries):
+    return [ json.dumps({ "URL" : URL, "ID" : e["id"] }) for e in entries ]
+
+def generate_rss(name, num_items, seed = 0, start = 0, body_words = 50):
+    rng = random.Random(seed)
+    now = time.time()
+
+    items = []
+    for i in range(start, start + num_items):
+        stamp = time.strftime("%a, %d %b %Y %H:%M:%S +0000",
+                time.gmtime(now - i * 3600))
+        items.append("<item><title>%s %d %s</title>"\
+                "<link>http://example.com/%s/%d/</link>"\
+                "<guid>http://example.com/%s/%d/</guid>"\
+                "<pubDate>%s</pubDate>"\
+                "<description>%s</description></item>" %\
+                (name, i, words(rng, 6), name, i, name, i, stamp,
+                    words(rng, body_words)))
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0">'\
+            "<channel><title>%s</title><link>http://example.com/%s/</link>"\
+            "<description>Synthetic feed</description>%s</channel></rss>" %\
+            (name, name, "".join(items))).encode("UTF-8")
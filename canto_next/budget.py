@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# A cap on the number of items stored across all feeds (the max_items
+# setting, 0 for no cap), for when keep_time isn't enough, like a few chatty
+# feeds with keep_unread set.
+#
+# When there are too many, read items are evicted, least recently accessed
+# first. Accessed means asked for with ATTRIBUTES, or, for items that haven't
+# been, seen in a fetch. Each feed keeps at least its min_items, and unread
+# items and items from a feed's latest fetch are never evicted, so the cap can
+# be exceeded if that's all there is.
+#
+# Evicted items are dropped like expired items (see retention.py), so the
+# tags, search and sort indexes follow.
+
+from .retention import untag_dropped
+from .sortindex import sortindex
+from .metrics import metrics
+from .memory import memory
+from .feed import allfeeds
+
+import logging
+import heapq
+import time
+
+log = logging.getLogger("BUDGET")
+
+metrics.describe("canto_items_evicted_total", "counter",
+        "Read items discarded to stay under max_items.")
+
+class CantoBudget():
+    def __init__(self):
+        self.max_items = 0
+        self.evicted = 0
+
+        # item id -> last ATTRIBUTES time
+        self.access = {}
+
+        # What the feeds looked like the last time we looked for items to
+        # evict, see enforce().
+        self.scanned = None
+
+    def touch(self, ids):
+        if self.max_items:
+            self.access.update(dict.fromkeys(ids, time.time()))
+
+    def items(self):
+        return sum([ feed.item_count for feed in allfeeds.get_feeds() ])
+
+    # Evict items until we're under max_items, return how many were evicted.
+
+    def enforce(self):
+        if not self.max_items:
+            return 0
+
+        # Forget items that have gone away some other way (expired, or their
+        # feed was removed).
+
+        if len(self.access) > self.max_items * 2:
+            known = sortindex.urls
+            self.access = dict([ (id, seen) for id, seen in\
+                    list(self.access.items()) if id in known ])
+
+        feeds = allfeeds.get_feeds()
+        over = sum([ feed.item_count for feed in feeds ]) - self.max_items
+        if over <= 0:
+            return 0
+
+        # If we're still over after the last look, everything left is unread,
+        # new or under min_items, and that won't change until feeds are
+        # indexed or items are marked read.
+
+        scanned = (self.max_items, [ (feed.URL, feed.changes) for feed in feeds ])
+        if scanned == self.scanned:
+            return 0
+        self.scanned = scanned
+
+        runs = []
+        for n, feed in enumerate(feeds):
+            runs.append([ (seen, full_id, id, n) for seen, full_id, id in\
+                    feed.eviction_candidates(self.access) ])
+
+        victims = {}
+        for seen, full_id, id, n in heapq.merge(*runs):
+            if over <= 0:
+                break
+            if n in victims:
+                victims[n].add(id)
+            else:
+                victims[n] = set([ id ])
+            over -= 1
+
+        dropped = []
+        for n, ids in victims.items():
+            items = feeds[n].evict(ids)
+            if items:
+                dropped.append((feeds[n], items))
+
+        if not dropped:
+            log.debug("Over max_items, but nothing to evict")
+            return 0
+
+        count = untag_dropped(dropped)
+
+        # Forget items that are gone.
+
+        for feed, items in dropped:
+            for item in items:
+                self.access.pop(feed._item_id(item), None)
+
+        log.info("Evicted %d read items to stay under %d", count,
+                self.max_items)
+
+        self.evicted += count
+        metrics.inc("canto_items_evicted_total", count)
+        return count
+
+    def report(self):
+        return { "items" : self.items(), "max_items" : self.max_items,
+                "evicted" : self.evicted }
+
+budget = CantoBudget()
+memory.add_cache("budget", lambda : budget.access)
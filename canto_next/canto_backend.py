@@ -18,11 +18,23 @@ from .storage import CantoShelf
 from .fetch import CantoFetch
 from .hooks import on_hook, call_hook
 from .tag import alltags
+from .search import search
+from .retention import retention
+from .budget import budget
 from .transform import eval_transform
 from .plugins import PluginHandler, Plugin, try_plugins, set_program
 from .rwlock import alllocks, write_lock, read_lock
+from .metrics import metrics
+from .metricsserver import CantoMetricsServer
+from .cmdstats import cmdstats
+from .profiler import profiler, PROFILE_RATE
+from .memory import memory, deep_size
+from .protocol import io_bytes
 from .locks import *
 
+from threading import local
+from socket import AF_UNIX
+
 import traceback
 import logging
 import signal
@@ -41,6 +53,43 @@ logging.basicConfig(
 
 log = logging.getLogger("CANTO-DAEMON")
 
+metrics.describe("canto_command_errors_total", "counter",
+        "Commands that raised an exception, by command.")
+metrics.describe("canto_command_seconds", "summary",
+        "Time spent handling each command, including hooks.")
+metrics.describe("canto_connections", "gauge", "Connected clients.")
+metrics.describe("canto_fetch_threads", "gauge", "Running fetch threads.")
+metrics.describe("canto_fetch_deferred", "gauge",
+        "Fetches waiting for a free thread.")
+metrics.describe("canto_feeds", "gauge", "Configured feeds.")
+metrics.describe("canto_shelf_entries", "gauge",
+        "Top level entries in the feed database.")
+metrics.describe("canto_shelf_file_bytes", "gauge",
+        "Size of the feed database on disk.")
+metrics.describe("canto_tag_items", "gauge", "Items in each tag.")
+metrics.describe("canto_lock_wait_seconds_total", "counter",
+        "Time spent waiting to acquire each lock.")
+
+# Commands that can be part of a BATCH, and the locks each of them takes for
+# writing. Anything else (like SETCONFIGS, which takes every lock, or plugin
+# commands we know nothing about) has to be sent on its own.
+
+BATCH_COMMANDS = {
+        "VERSION" : [], "PING" : [], "LISTTAGS" : [], "LISTTRANSFORMS" : [],
+        "TRANSFORM" : [ socktran_lock ], "AUTOATTR" : [ attr_lock ],
+        "ITEMS" : [], "COUNTS" : [], "SEARCH" : [], "ATTRIBUTES" : [],
+        "SETATTRIBUTES" : [ tag_lock ], "CONFIGS" : [],
+        "WATCHCONFIGS" : [ watch_lock ], "WATCHNEWTAGS" : [ watch_lock ],
+        "WATCHDELTAGS" : [ watch_lock ], "WATCHTAGS" : [ watch_lock ],
+        "UPDATE" : [], "FORCEUPDATE" : [], "SCHEDULE" : [], "HEALTH" : [],
+        "FEEDSTATS" : [], "CMDSTATS" : [], "MEMORY" : [],
+}
+
+# The order BATCH takes locks in.
+
+BATCH_LOCKS = [ config_lock, attr_lock, feed_lock, tag_lock, socktran_lock,
+        watch_lock ]
+
 class DaemonBackendPlugin(Plugin):
     pass
 
@@ -71,14 +120,23 @@ class CantoBackend(PluginHandler, CantoServer):
 
         self.autoattr = {}
 
+        # While a thread is running a BATCH, writes to the batch's socket are
+        # collected here instead of sent.
+        self.batch_local = local()
+
         # Per socket transforms.
         self.socket_transforms = {}
 
         self.shelf = None
 
+        # Optional metrics endpoint, port or unix socket path.
+        self.metrics_spec = None
+        self.metrics_server = None
+
         # No bad arguments.
         version = "canto-daemon " + REPLACE_VERSION + " " + GIT_HASH
-        optl = self.common_args("nhc:",["nofetch","help","cache="], version)
+        optl = self.common_args("nhc:",["nofetch","help","cache=","metrics="],
+                version)
         if optl == -1:
             sys.exit(-1)
 
@@ -146,6 +204,15 @@ class CantoBackend(PluginHandler, CantoServer):
             call_hook("daemon_exit", [])
             sys.exit(-1)
 
+        if self.metrics_spec:
+            try:
+                self.metrics_server = CantoMetricsServer(self.metrics_spec,
+                        self.addr or "127.0.0.1")
+            except Exception as e:
+                log.error("Couldn't start metrics server: %s" % e)
+            else:
+                metrics.add_collector(self._metrics)
+
         # Signal handlers kickoff after everything else is init'd
 
         self.interrupted = 0
@@ -153,6 +220,7 @@ class CantoBackend(PluginHandler, CantoServer):
         signal.signal(signal.SIGINT, self.sig_int)
         signal.signal(signal.SIGTERM, self.sig_int)
         signal.signal(signal.SIGUSR1, self.sig_usr)
+        signal.signal(signal.SIGUSR2, self.sig_usr2)
 
         self.start()
 
@@ -246,9 +314,35 @@ class CantoBackend(PluginHandler, CantoServer):
         on_hook("daemon_get_configs", lambda x, y : self.internal_command(x, self.in_configs, y))
 
     # VERSION -> X.Y
+    # VERSION { "encodings" : [ "compact", ... ], "compression" : [ "zlib" ] }
+    #   -> { "version" : X.Y, "encoding" : "compact" | "json",
+    #        "compression" : "zlib" | None }
+    #
+    # In the second form, everything after the reply on this socket uses the
+    # encoding (see compact.py) and compression we replied with. Compression
+    # is only used on inet sockets, local clients have nothing to gain from
+    # it. Switching isn't done inside a BATCH, whose reply has yet to be
+    # written.
 
     def cmd_version(self, socket, args):
-        self.write(socket, "VERSION", CANTO_PROTOCOL_VERSION)
+        if type(args) != dict:
+            self.write(socket, "VERSION", CANTO_PROTOCOL_VERSION)
+            return
+
+        reply = { "version" : CANTO_PROTOCOL_VERSION, "encoding" : "json",
+                "compression" : None }
+
+        if not socket or getattr(self.batch_local, "captured", None) != None:
+            self.write(socket, "VERSION", reply)
+            return
+
+        if "compact" in args.get("encodings", []):
+            reply["encoding"] = "compact"
+        if "zlib" in args.get("compression", []) and\
+                socket.family != AF_UNIX:
+            reply["compression"] = "zlib"
+
+        self.do_write(socket, "VERSION", reply, reply)
 
     # PING -> PONG
 
@@ -341,8 +435,12 @@ class CantoBackend(PluginHandler, CantoServer):
 
     # ITEMS [tags] -> { tag : [ ids ], tag2 : ... }
 
+    # Transforms read the tags, the sort index and the search index, which
+    # are only changed with tag_lock held for writing.
+
     @read_lock(attr_lock)
     @read_lock(feed_lock)
+    @read_lock(tag_lock)
     def _apply_socktrans(self, socket, tag):
         feeds = allfeeds.items_to_feeds(tag)
         rlock_feed_objs(feeds)
@@ -384,6 +482,43 @@ class CantoBackend(PluginHandler, CantoServer):
             for attr_req in attr_list:
                 self.cmd_attributes(socket, attr_req)
 
+    # COUNTS [ tags ] -> { tag : { "unread" : n, "read" : n, "total" : n } }
+    # COUNTS [] -> same, for every tag.
+
+    # Counts are of the tag after global and tag transforms (like ITEMS), but
+    # before socket transforms.
+
+    @read_lock(tag_lock)
+    def cmd_counts(self, socket, args):
+        if not args:
+            args = alltags.get_tags()
+
+        r = {}
+        for tag in args:
+            r[tag] = alltags.get_counts(tag)
+
+        self.write(socket, "COUNTS", r)
+
+    # SEARCH { "query" : "words", "tags" : [ tags ], "limit" : n } ->
+    #   { "query" : "words", "items" : [ ids ] }
+    # SEARCH "words" -> same, for every tag and without a limit.
+
+    # Items have to contain every word of the query in their title or summary,
+    # and are returned newest first. Like COUNTS, tags are after global and
+    # tag transforms but before socket transforms, so without "tags" items
+    # that have been filtered out of every tag aren't returned.
+
+    @read_lock(tag_lock)
+    def cmd_search(self, socket, args):
+        if type(args) == str:
+            args = { "query" : args }
+
+        scope = alltags.get_tags_set(args.get("tags"))
+        items = search.search(args["query"], scope, args.get("limit"))
+
+        self.write(socket, "SEARCH", { "query" : args["query"],
+            "items" : items })
+
     # ATTRIBUTES { id : [ attribs .. ] .. } ->
     # { id : { attribute : value } ... }
 
@@ -398,6 +533,8 @@ class CantoBackend(PluginHandler, CantoServer):
         for f in feeds:
             ret.update(f.get_attributes(feeds[f], args))
 
+        budget.touch(args.keys())
+
         self.write(socket, "ATTRIBUTES", ret)
 
     # SETATTRIBUTES { id : { attribute : value } ... } -> None
@@ -405,14 +542,62 @@ class CantoBackend(PluginHandler, CantoServer):
     @read_lock(feed_lock)
     @write_lock(tag_lock)
     def cmd_setattributes(self, socket, args):
+        allfeeds.set_attributes(args)
 
-        feeds = allfeeds.items_to_feeds(list(args.keys()))
+    # MARKTAG { "tag" : tag, "state" : "read" } ->
+    #   { "tag" : tag, "state" : "read", "changed" : n }
+    # MARKTAG { "tag" : tag, "state" : "-read" } -> same, removing the state.
+
+    # Sets (or unsets) a state, like "read", on every item in a tag without the
+    # client sending all of their IDs. This is done as a SETATTRIBUTES of the
+    # items that change, with the SETATTRIBUTES hooks called outside of the
+    # locks like they are for SETATTRIBUTES itself, so plugins see it. For the
+    # same reason, MARKTAG can't be part of a BATCH.
+
+    def cmd_marktag(self, socket, args):
+        attributes = self._marktag_attributes(args["tag"], args["state"])
+
+        if attributes:
+            call_hook("daemon_pre_setattributes", [ socket, attributes ])
+            self.cmd_setattributes(socket, attributes)
+            call_hook("daemon_post_setattributes", [ socket, attributes ])
+
+        self.write(socket, "MARKTAG", { "tag" : args["tag"],
+            "state" : args["state"], "changed" : len(attributes) })
+
+    # Return SETATTRIBUTES arguments for the items in tag that MARKTAG would
+    # change.
+
+    @read_lock(feed_lock)
+    @read_lock(tag_lock)
+    def _marktag_attributes(self, tag, state):
+        remove = state.startswith("-")
+        if remove:
+            state = state[1:]
+
+        ids = alltags.get_tag(tag)[:]
+        feeds = allfeeds.items_to_feeds(ids)
+
+        attributes = {}
         for f in feeds:
-            f.set_attributes(feeds[f], args)
+            current = f.get_attributes(feeds[f], dict([ (id, [ "canto-state" ])\
+                    for id in feeds[f] ]))
+
+            for id, attrs in current.items():
+                states = attrs["canto-state"]
+                if not states:
+                    states = []
+
+                if remove and state in states:
+                    states = [ s for s in states if s != state ]
+                elif not remove and state not in states:
+                    states = states + [ state ]
+                else:
+                    continue
+
+                attributes[id] = { "canto-state" : states }
 
-        tags = alltags.items_to_tags(list(args.keys()))
-        for t in tags:
-            call_hook("daemon_tag_change", [ t ])
+        return attributes
 
     # CONFIGS [ "top_sec", ... ] -> { "top_sec" : full_value }
 
@@ -521,6 +706,248 @@ class CantoBackend(PluginHandler, CantoServer):
         self.fetch_manual = True
         self.fetch_force = True
 
+    # SCHEDULE [ URLs ] -> { URL : { "interval" : seconds, ... } }
+
+    # Report what the scheduler has learned about each feed (or just the given
+    # feeds), and when they'll next be fetched.
+
+    @read_lock(feed_lock)
+    def cmd_schedule(self, socket, args):
+        r = {}
+        for feed in allfeeds.get_feeds():
+            if args and feed.URL not in args:
+                continue
+            r[feed.URL] = feed.schedule.report(feed.last_update)
+
+        self.write(socket, "SCHEDULE", r)
+
+    # HEALTH {} -> { URL : { "failures" : n, "last_error" : "...", ... } }
+
+    # List only feeds that have been failing to fetch.
+
+    @read_lock(feed_lock)
+    def cmd_health(self, socket, args):
+        r = {}
+        for feed in allfeeds.get_feeds():
+            state = feed.schedule.state
+            if not state["failures"]:
+                continue
+
+            r[feed.URL] = { "name" : feed.name,
+                    "failures" : state["failures"],
+                    "last_error" : state["last_error"],
+                    "last_failure" : state["last_failure"],
+                    "circuit" : feed.schedule.circuit(),
+                    "next_update" : feed.schedule.next_update(feed.last_update) }
+
+        self.write(socket, "HEALTH", r)
+
+    # FEEDSTATS {} -> { URL : { "name" : name, "samples" : n, "mean" : {...},
+    #   "last" : {...} } }
+
+    # Fetch timing and size, averaged over the last few fetches of each feed.
+    # See feedstats.py for the keys.
+
+    @read_lock(feed_lock)
+    def cmd_feedstats(self, socket, args):
+        r = {}
+        for feed in allfeeds.get_feeds():
+            summary = feed.stats.summary()
+            if not summary:
+                continue
+            summary["name"] = feed.name
+            r[feed.URL] = summary
+
+        self.write(socket, "FEEDSTATS", r)
+
+    # CMDSTATS {} -> { "commands" : { CMD : { "count" : n, "mean" : ms, ... } },
+    #   "slow" : [ { "cmd" : CMD, "ms" : ms, "args" : summary, ... }, ... ] }
+    # CMDSTATS { "reset" : True } -> same, then starts counting from zero.
+
+    # Latency histograms ("buckets" are [ max ms, count ] pairs, the last max
+    # is null) and payload sizes for every command handled so far, and the
+    # most recent commands slower than the slow_command setting.
+
+    def cmd_cmdstats(self, socket, args):
+        r = cmdstats.report()
+        r["threshold"] = config.slow_command
+        if args and "reset" in args and args["reset"]:
+            cmdstats.reset()
+        self.write(socket, "CMDSTATS", r)
+
+    # PROFILE {} -> { "running" : bool, "rate" : hz, "samples" : n, ... }
+    # PROFILE { "start" : True, ("rate" : hz) } -> same, after starting, or
+    #   EXCEPT for a bad rate. Rates over MAX_PROFILE_RATE are clamped.
+    # PROFILE { "stop" : True } -> same, plus "path" of the written profile
+
+    # Toggle the sampling profiler, see profiler.py. SIGUSR2 does the same.
+
+    def _profile_path(self):
+        return self.conf_dir + "/profile-%s.folded" %\
+                time.strftime("%Y%m%d-%H%M%S")
+
+    def cmd_profile(self, socket, args):
+        if args and args.get("start"):
+            try:
+                profiler.start(args.get("rate", PROFILE_RATE))
+            except ValueError as e:
+                self.write(socket, "EXCEPT", "Couldn't start profiler: %s" % e)
+                return
+        elif args and args.get("stop"):
+            r = profiler.stop(self._profile_path())
+            if r:
+                self.write(socket, "PROFILE", r)
+                return
+
+        self.write(socket, "PROFILE", profiler.status())
+
+    # MEMORY {} -> { "feeds" : { URL : { "name" : name, "items" : n,
+    #   "bytes" : n } }, "tags" : { tag : { "items" : n, "bytes" : n } },
+    #   "sockets" : { fd : { "transforms" : n, "autoattr" : n, "pending" : n } },
+    #   "caches" : { name : n }, "total" : n }
+
+    # Approximate memory used by each feed's stored items, each tag's item
+    # list, each connection's state and anything registered with
+    # memory.add_cache(). See memory.py for how approximate.
+
+    @read_lock(attr_lock)
+    @read_lock(feed_lock)
+    @read_lock(tag_lock)
+    @read_lock(socktran_lock)
+    def cmd_memory(self, socket, args):
+        r = { "feeds" : {}, "tags" : {}, "sockets" : {} }
+
+        for feed in allfeeds.get_feeds():
+            feed.lock.acquire_read()
+            try:
+                entry = self.shelf.cache.get(feed.URL, {})
+                r["feeds"][feed.URL] = { "name" : feed.name,
+                        "items" : len(entry.get("entries", [])),
+                        "bytes" : deep_size(entry) + deep_size(feed.stats) }
+            finally:
+                feed.lock.release_read()
+
+        for tag, items in alltags.tags.items():
+            r["tags"][tag] = { "items" : len(items),
+                    "bytes" : deep_size(items) }
+
+        self.connections_lock.acquire()
+        socks = [ c for c, t in self.connections ]
+        self.connections_lock.release()
+
+        for sock in socks:
+            r["sockets"][sock.fileno()] = {
+                    "transforms" : deep_size(self.socket_transforms.get(sock, {})),
+                    "autoattr" : deep_size(self.autoattr.get(sock, [])),
+                    "pending" : deep_size(self.write_frags.get(sock)) }
+
+        r["caches"] = memory.cache_sizes()
+        r["budget"] = budget.report()
+
+        r["total"] = sum([ f["bytes"] for f in r["feeds"].values() ]) +\
+                sum([ t["bytes"] for t in r["tags"].values() ]) +\
+                sum([ sum(s.values()) for s in r["sockets"].values() ]) +\
+                sum(r["caches"].values())
+
+        self.write(socket, "MEMORY", r)
+
+    # COMPACT {} -> { "feeds" : n, "fields" : n }
+
+    # Prune stored items down to each feed's keep_fields and write the
+    # shrunken database to disk.
+
+    @read_lock(feed_lock)
+    def _compact_feeds(self):
+        feeds = 0
+        fields = 0
+        for feed in allfeeds.get_feeds():
+            pruned = feed.compact()
+            if pruned:
+                feeds += 1
+                fields += pruned
+        return { "feeds" : feeds, "fields" : fields }
+
+    def cmd_compact(self, socket, args):
+        r = self._compact_feeds()
+        log.info("Compacted %d fields from %d feeds.", r["fields"], r["feeds"])
+
+        self.shelf.sync()
+        self.write(socket, "COMPACT", r)
+
+    # BATCH [ [ CMD, args ], ... ] ->
+    #   [ [ [ RESPONSE, args ], ... ], ... ] (one list per CMD)
+
+    # Run several commands under a single acquisition of the locks they need
+    # and reply with everything they would have written to this socket as one
+    # message, with a list of each command's writes (which may be empty, like
+    # for SETATTRIBUTES) in the same position as the command. Commands not in
+    # BATCH_COMMANDS, or that fail, get an EXCEPT in their list. Hooks for
+    # each command run before the locks are taken (pre) and after they're
+    # released (post), as plugins may take locks of their own.
+
+    def write(self, conn, cmd, args):
+        captured = getattr(self.batch_local, "captured", None)
+        if captured != None and conn == self.batch_local.conn:
+            captured.append((cmd, args))
+            return
+        return CantoServer.write(self, conn, cmd, args)
+
+    def _batch_locks(self, cmds):
+        writes = []
+        for cmd, args in cmds:
+            writes.extend(BATCH_COMMANDS.get(cmd, []))
+        return [ (lock, lock in writes) for lock in BATCH_LOCKS ]
+
+    def cmd_batch(self, socket, args):
+        cmds = [ (cmd, a) for cmd, a in args ]
+        locks = self._batch_locks(cmds)
+
+        for cmd, a in cmds:
+            if cmd in BATCH_COMMANDS:
+                call_hook("daemon_pre_" + cmd.lower(), [socket, a])
+
+        self.batch_local.conn = socket
+        replies = []
+
+        for lock, write in locks:
+            if write:
+                lock.acquire_write()
+            else:
+                lock.acquire_read()
+
+        try:
+            for cmd, a in cmds:
+                self.batch_local.captured = []
+                replies.append(self.batch_local.captured)
+
+                if cmd not in BATCH_COMMANDS:
+                    self.write(socket, "EXCEPT", "%s can't be batched" % cmd)
+                    continue
+
+                try:
+                    getattr(self, "cmd_" + cmd.lower())(socket, a)
+                except Exception as e:
+                    metrics.inc("canto_command_errors_total", cmd = cmd)
+                    tb = "".join(traceback.format_exc())
+                    self.write(socket, "EXCEPT", tb)
+                    log.error("Protocol exception in BATCH:")
+                    log.error("\n" + tb)
+        finally:
+            for lock, write in reversed(locks):
+                if write:
+                    lock.release_write()
+                else:
+                    lock.release_read()
+
+            self.batch_local.captured = None
+            self.batch_local.conn = None
+
+        for cmd, a in cmds:
+            if cmd in BATCH_COMMANDS:
+                call_hook("daemon_post_" + cmd.lower(), [socket, a])
+
+        self.write(socket, "BATCH", replies)
+
     # The workhorse that maps all requests to their handlers.
 
     def socket_command(self, socket, data):
@@ -534,20 +961,55 @@ class CantoBackend(PluginHandler, CantoServer):
             if hasattr(self, cmdf):
                 func = getattr(self, cmdf)
 
+                start = time.time()
+                written = getattr(io_bytes, "written", 0)
+
                 call_hook("daemon_pre_" + cmd.lower(), [socket, args])
 
                 try:
                     func(socket, args)
                 except Exception as e:
+                    metrics.inc("canto_command_errors_total", cmd = cmd)
                     tb = "".join(traceback.format_exc())
                     self.write(socket, "EXCEPT", tb)
                     log.error("Protocol exception:")
                     log.error("\n" + tb)
 
                 call_hook("daemon_post_" + cmd.lower(), [socket, args])
+
+                duration = time.time() - start
+                cmdstats.record(cmd, args, duration,
+                        getattr(io_bytes, "read", 0),
+                        getattr(io_bytes, "written", 0) - written,
+                        config.slow_command)
+                metrics.observe("canto_command_seconds", duration, cmd = cmd)
             else:
                 log.info("Got unknown command: %s" % (cmd))
 
+    # Gauges for the metrics endpoint, computed when it's scraped.
+
+    def _metrics(self):
+        r = [ ("canto_connections", {}, len(self.connections)),
+              ("canto_fetch_threads", {}, len(self.fetch.threads)),
+              ("canto_fetch_deferred", {}, len(self.fetch.deferred)),
+              ("canto_feeds", {}, len(allfeeds.get_feeds())),
+              ("canto_shelf_entries", {}, len(self.shelf.cache)) ]
+
+        if os.path.exists(self.feed_path):
+            r.append(("canto_shelf_file_bytes", {},
+                os.path.getsize(self.feed_path)))
+
+        for tag, items in list(alltags.tags.items()):
+            r.append(("canto_tag_items", { "tag" : tag }, len(items)))
+
+        for lock in alllocks:
+            r.append(("canto_lock_wait_seconds_total",
+                { "lock" : lock.name, "mode" : "read" }, lock.read_wait))
+            r.append(("canto_lock_wait_seconds_total",
+                { "lock" : lock.name, "mode" : "write" }, lock.write_wait))
+
+        return r
+
     def internal_command(self, cb, func, args):
         r = func(args)
         if cb:
@@ -581,6 +1043,21 @@ class CantoBackend(PluginHandler, CantoServer):
                 self.fetch_manual = False
                 self.fetch_force = False
 
+            # Even if we're not fetching, feeds may still be waiting to be
+            # loaded from disk.
+
+            elif self.fetch.deferred:
+                self.fetch.fetch_deferred()
+
+            # Discard items older than keep_time.
+
+            if retention.needs_sweep(time.time()):
+                retention.sweep()
+
+            # Evict read items over max_items.
+
+            budget.enforce()
+
             call_hook("daemon_end_loop", [])
 
             time.sleep(1)
@@ -601,6 +1078,12 @@ class CantoBackend(PluginHandler, CantoServer):
 
         call_hook("daemon_exit", [])
 
+        if self.metrics_server:
+            self.metrics_server.close()
+
+        if profiler.running():
+            profiler.stop(self._profile_path())
+
         # The rest of this is bonus, the important part is to protect the disk.
         log.debug("DB shutdown.")
 
@@ -631,6 +1114,7 @@ class CantoBackend(PluginHandler, CantoServer):
         print("\t-v/\t\tVerbose logging (for debug)")
         print("\t-D/--dir <dir>\tSet configuration directory.")
         print("\t-n/--nofetch\tJust serve content, don't fetch new content.")
+        print("\t--metrics <port|path>\tServe Prometheus metrics on this port or unix socket.")
         print("\n\nPlugin control\n")
         print("\t--noplugins\t\t\t\tDisable plugins")
         print("\t--enableplugins 'plugin1 plugin2...'\tEnable single plugins (overrides --noplugins)")
@@ -645,6 +1129,8 @@ class CantoBackend(PluginHandler, CantoServer):
         for opt, arg in optlist:
             if opt in ["-n", "--nofetch"]:
                 self.no_fetch = True
+            elif opt in ["--metrics"]:
+                self.metrics_spec = arg
             elif opt in ['-h', '--help']:
                 self.print_help()
                 sys.exit(0)
@@ -709,6 +1195,12 @@ class CantoBackend(PluginHandler, CantoServer):
         except:
             pass
 
+    def sig_usr2(self, a, b):
+        if profiler.running():
+            profiler.stop(self._profile_path())
+        else:
+            profiler.start()
+
     # This function makes sure that the configuration paths are all R/W or
     # creatable.
 
@@ -76,6 +76,13 @@ class CantoClient(CantoSocket):
     def write(self, cmd, args, conn=0):
         return self.do_write(self.sockets[conn], cmd, args)
 
+    # Ask the daemon to switch conn to the compact encoding and, if it's an
+    # inet socket, compression. Its VERSION reply says what it did, and
+    # reading that reply switches our end.
+    def negotiate(self, conn=0):
+        return self.write("VERSION", { "encodings" : [ "compact" ],
+            "compression" : [ "zlib" ] }, conn)
+
     # Read a (cmd, args)
     def read(self, timeout=None, conn=0):
         return self.do_read(self.sockets[conn], timeout)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# CantoCommandStats keeps latency histograms and payload sizes for each
+# protocol command handled by CantoBackend.socket_command, and a log of the
+# most recent commands that took longer than the slow_command threshold, with
+# their arguments summarized so that a huge SETATTRIBUTES doesn't end up in
+# memory twice.
+
+from .memory import memory
+
+from threading import Lock
+from collections import deque
+
+import logging
+import time
+
+log = logging.getLogger("CMDSTATS")
+
+# Histogram bucket upper bounds, in milliseconds. The last bucket catches
+# everything else.
+
+BUCKETS = [ 1, 5, 10, 50, 100, 500, 1000, 5000 ]
+
+SLOW_LOG_LENGTH = 50
+
+# Summarize arbitrary JSON-able args into something short enough to log.
+
+def summarize(args, depth = 0):
+    if type(args) == str:
+        if len(args) > 60:
+            return args[:60] + "..."
+        return args
+
+    if type(args) == list:
+        if depth >= 2:
+            return "[%d items]" % len(args)
+        r = [ summarize(a, depth + 1) for a in args[:5] ]
+        if len(args) > 5:
+            r.append("... (%d total)" % len(args))
+        return r
+
+    if type(args) == dict:
+        if depth >= 2:
+            return "{%d keys}" % len(args)
+        r = {}
+        for key in list(args.keys())[:5]:
+            r[summarize(key, depth + 1)] = summarize(args[key], depth + 1)
+        if len(args) > 5:
+            r["..."] = "(%d total)" % len(args)
+        return r
+
+    return args
+
+class CantoCommandStats():
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        self.commands = {}
+        self.slow = deque(maxlen = SLOW_LOG_LENGTH)
+        self.lock.release()
+
+    def record(self, cmd, args, duration, in_bytes, out_bytes, threshold):
+        ms = duration * 1000
+
+        self.lock.acquire()
+
+        if cmd not in self.commands:
+            self.commands[cmd] = { "count" : 0, "total" : 0, "max" : 0,
+                    "buckets" : [ 0 ] * (len(BUCKETS) + 1),
+                    "in_bytes" : 0, "in_max" : 0, "out_bytes" : 0,
+                    "out_max" : 0 }
+
+        c = self.commands[cmd]
+        c["count"] += 1
+        c["total"] += ms
+        c["max"] = max(c["max"], ms)
+        c["in_bytes"] += in_bytes
+        c["in_max"] = max(c["in_max"], in_bytes)
+        c["out_bytes"] += out_bytes
+        c["out_max"] = max(c["out_max"], out_bytes)
+
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                c["buckets"][i] += 1
+                break
+        else:
+            c["buckets"][-1] += 1
+
+        self.lock.release()
+
+        if threshold and ms >= threshold:
+            entry = { "cmd" : cmd, "time" : time.time(), "ms" : ms,
+                    "in_bytes" : in_bytes, "out_bytes" : out_bytes,
+                    "args" : summarize(args) }
+
+            log.info("Slow command %s took %dms: %s", cmd, ms, entry["args"])
+
+            self.lock.acquire()
+            self.slow.append(entry)
+            self.lock.release()
+
+    def report(self):
+        self.lock.acquire()
+
+        commands = {}
+        for cmd, c in self.commands.items():
+            r = c.copy()
+            r["mean"] = c["total"] / c["count"]
+            r["buckets"] = list(zip(BUCKETS + [ None ], c["buckets"]))
+            commands[cmd] = r
+
+        slow = list(self.slow)
+
+        self.lock.release()
+
+        return { "commands" : commands, "slow" : slow }
+
+cmdstats = CantoCommandStats()
+memory.add_cache("cmdstats", lambda : (cmdstats.commands, cmdstats.slow))
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The "compact" wire encoding, an alternative to JSON that a client can ask for
+# with VERSION { "encodings" : [ "compact" ] }.
+#
+# It carries the same values as JSON (converted the same way, tuples to lists
+# and dict keys to strings), but the big messages are mostly item ids, which
+# are JSON strings of the form {"URL": "<url>", "ID": "<id>"}, and dicts with
+# the same handful of keys over and over. So:
+#
+#   - Dict keys, attribute names and the feed URL of item ids go in a string
+#     table that lives as long as the connection, so after the first message
+#     they're sent as a small integer.
+#
+#   - A list of item ids is sent as runs of (URL, count) and the rest of each
+#     id, newline separated (ids are JSON text, which can't contain a raw
+#     newline), so decoding it is a str.split and putting the strings back
+#     together.
+#
+#   - A dict keyed by item ids is that list of ids plus a list of values, and
+#     a list of dicts that all have the same keys (like attributes) is sent
+#     by column, a string column being one newline separated string if it
+#     can be and anything else a JSON list, so str.split and json.loads do
+#     the heavy lifting.
+#
+#   - Anything else is either a small binary value, or a JSON list of plain
+#     values.
+#
+# Each end of a connection has a CompactEncoder for what it writes and a
+# CompactDecoder for what it reads, and messages have to be decoded in the
+# order they were encoded, which the protocol's per-connection locks ensure.
+
+from itertools import groupby
+
+import struct
+import json
+
+NONE, TRUE, FALSE, INT, FLOAT, STR, LIST, DICT, DEFINE, REF, ITEM_ID, JSON,\
+        ID_LIST, ID_DICT, RECORDS = range(15)
+
+# Don't let a client grow the table forever.
+
+MAX_TABLE = 65536
+
+ID_PREFIX = '{"URL": "'
+ID_SEP = '", "ID": "'
+ID_SUFFIX = '"}'
+
+PLAIN = (type(None), bool, int, float)
+
+pack_double = struct.Struct("!d").pack
+unpack_double = struct.Struct("!d").unpack_from
+
+json_encode = json.JSONEncoder(separators=(",", ":")).encode
+json_decode = json.JSONDecoder().decode
+
+def varint(n):
+    if n < 0x80:
+        return bytes((n,))
+
+    r = bytearray()
+    while n >= 0x80:
+        r.append((n & 0x7f) | 0x80)
+        n >>= 7
+    r.append(n)
+    return bytes(r)
+
+# Split an item id into (url, rest), or return None if it isn't one.
+
+def split_id(s):
+    if type(s) != str or not s.startswith(ID_PREFIX) or\
+            not s.endswith(ID_SUFFIX):
+        return None
+
+    url, sep, rest = s[9:-2].partition(ID_SEP)
+    if not sep:
+        return None
+    return (url, rest)
+
+def is_plain(o):
+    if type(o) == str:
+        return not o.startswith(ID_PREFIX)
+    return isinstance(o, PLAIN)
+
+class CompactEncoder():
+    def __init__(self):
+        self.table = {}
+
+    def encode(self, message):
+        out = [ bytes((LIST,)) + varint(len(message)) ]
+        for o in message:
+            self._encode(o, out)
+        return b"".join(out)
+
+    def _blob(self, s, out):
+        b = s.encode("UTF-8")
+        out.append(varint(len(b)))
+        out.append(b)
+
+    def _string(self, s, out):
+        idx = self.table.get(s)
+        if idx != None:
+            out.append(bytes((REF,)) + varint(idx))
+            return
+
+        if len(self.table) < MAX_TABLE:
+            self.table[s] = len(self.table)
+            out.append(bytes((DEFINE,)))
+        else:
+            out.append(bytes((STR,)))
+        self._blob(s, out)
+
+    def _key(self, k, out):
+        if type(k) != str:
+            k = json_encode(k)
+        if k.startswith(ID_PREFIX):
+            out.append(bytes((STR,)))
+            self._blob(k, out)
+        else:
+            self._string(k, out)
+
+    # Returns False if l isn't entirely item ids.
+
+    def _id_list(self, l, out):
+        try:
+            if not all([ i.startswith(ID_PREFIX) and i.endswith(ID_SUFFIX)\
+                    for i in l ]):
+                return False
+        except AttributeError:
+            return False
+
+        parts = [ i[9:-2].partition(ID_SEP) for i in l ]
+        if not all([ p[1] for p in parts ]):
+            return False
+
+        blob = "\n".join([ p[2] for p in parts ])
+        if blob.count("\n") != len(parts) - 1:
+            return False
+
+        runs = [ (url, len(list(g))) for url, g in\
+                groupby([ p[0] for p in parts ]) ]
+
+        out.append(bytes((ID_LIST,)) + varint(len(runs)))
+        for url, count in runs:
+            self._string(url, out)
+            out.append(varint(count))
+        self._blob(blob, out)
+        return True
+
+    # Returns False unless l is dicts that all have the same string keys, in
+    # the same order. Each key's values are sent as a column, either newline
+    # separated strings or a JSON list.
+
+    def _records(self, l, out):
+        first = l[0]
+        if not first:
+            return False
+
+        keys = tuple(first.keys())
+        for k in keys:
+            if type(k) != str:
+                return False
+
+        try:
+            if not all([ tuple(d.keys()) == keys for d in l ]):
+                return False
+        except AttributeError:
+            return False
+
+        out.append(bytes((RECORDS,)) + varint(len(keys)))
+
+        for k in keys:
+            self._key(k, out)
+
+            column = [ d[k] for d in l ]
+            if all([ type(v) == str for v in column ]):
+                blob = "\n".join(column)
+                if blob.count("\n") == len(column) - 1:
+                    out.append(bytes((STR,)))
+                    self._blob(blob, out)
+                    continue
+
+            out.append(bytes((JSON,)))
+            self._blob(json_encode(column), out)
+        return True
+
+    def _list(self, l, out):
+        if l:
+            if type(l[0]) == str and l[0].startswith(ID_PREFIX) and\
+                    self._id_list(l, out):
+                return
+            if type(l[0]) == dict and len(l) > 1 and self._records(l, out):
+                return
+
+        for o in l:
+            if not is_plain(o):
+                break
+        else:
+            out.append(bytes((JSON,)))
+            self._blob(json_encode(l), out)
+            return
+
+        out.append(bytes((LIST,)) + varint(len(l)))
+        for o in l:
+            self._encode(o, out)
+
+    def _dict(self, d, out):
+        if d:
+            keys = list(d.keys())
+            if type(keys[0]) == str and keys[0].startswith(ID_PREFIX):
+                mark = len(out)
+                out.append(bytes((ID_DICT,)))
+                if self._id_list(keys, out):
+                    self._list(list(d.values()), out)
+                    return
+                del out[mark:]
+
+        out.append(bytes((DICT,)) + varint(len(d)))
+        for k, v in d.items():
+            self._key(k, out)
+            self._encode(v, out)
+
+    def _encode(self, obj, out):
+        t = type(obj)
+
+        if t == str:
+            s = split_id(obj)
+            if s:
+                out.append(bytes((ITEM_ID,)))
+                self._string(s[0], out)
+                self._blob(s[1], out)
+            else:
+                out.append(bytes((STR,)))
+                self._blob(obj, out)
+        elif t == dict:
+            self._dict(obj, out)
+        elif t == list or t == tuple:
+            self._list(obj, out)
+        elif obj is None:
+            out.append(bytes((NONE,)))
+        elif obj is True:
+            out.append(bytes((TRUE,)))
+        elif obj is False:
+            out.append(bytes((FALSE,)))
+        elif t == int:
+            out.append(bytes((INT,)) + varint((obj << 1) if obj >= 0 else\
+                    ((-obj << 1) - 1)))
+        elif t == float:
+            out.append(bytes((FLOAT,)) + pack_double(obj))
+        else:
+            raise TypeError("Can't encode %s" % t)
+
+class CompactDecoder():
+    def __init__(self):
+        self.table = []
+
+    def decode(self, data):
+        if data[0] != LIST:
+            raise ValueError("Not a compact message")
+
+        obj, pos = self._decode(data, 0)
+        if pos != len(data):
+            raise ValueError("Trailing data")
+        return obj
+
+    def _varint(self, data, pos):
+        b = data[pos]
+        if b < 0x80:
+            return b, pos + 1
+
+        n = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n, pos
+            shift += 7
+
+    def _blob(self, data, pos):
+        n, pos = self._varint(data, pos)
+        end = pos + n
+        if end > len(data):
+            raise ValueError("Truncated message")
+        return data[pos:end].decode("UTF-8"), end
+
+    def _string(self, data, pos):
+        t = data[pos]
+        if t == REF:
+            n, pos = self._varint(data, pos + 1)
+            if n >= len(self.table):
+                raise ValueError("Bad string reference %d" % n)
+            return self.table[n], pos
+
+        s, pos = self._blob(data, pos + 1)
+        if t == DEFINE:
+            if len(self.table) >= MAX_TABLE:
+                raise ValueError("String table full")
+            self.table.append(s)
+        elif t != STR:
+            raise ValueError("Expected string, got %d" % t)
+        return s, pos
+
+    def _id_list(self, data, pos):
+        nruns, pos = self._varint(data, pos)
+        runs = []
+        for i in range(nruns):
+            url, pos = self._string(data, pos)
+            count, pos = self._varint(data, pos)
+            runs.append((ID_PREFIX + url + ID_SEP, count))
+
+        blob, pos = self._blob(data, pos)
+        rests = blob.split("\n")
+
+        if len(runs) == 1:
+            prefix = runs[0][0]
+            return [ prefix + r + ID_SUFFIX for r in rests ], pos
+
+        r = []
+        start = 0
+        for prefix, count in runs:
+            r.extend([ prefix + rest + ID_SUFFIX for rest in\
+                    rests[start:start + count] ])
+            start += count
+        return r, pos
+
+    def _decode(self, data, pos):
+        t = data[pos]
+        pos += 1
+
+        if t == DICT:
+            n, pos = self._varint(data, pos)
+            r = {}
+            for i in range(n):
+                k, pos = self._string(data, pos)
+                r[k], pos = self._decode(data, pos)
+            return r, pos
+        elif t == ID_LIST:
+            return self._id_list(data, pos)
+        elif t == ID_DICT:
+            keys, pos = self._decode(data, pos)
+            values, pos = self._decode(data, pos)
+            if len(values) != len(keys):
+                raise ValueError("ID_DICT length mismatch")
+            return dict(zip(keys, values)), pos
+        elif t == RECORDS:
+            n, pos = self._varint(data, pos)
+            keys = []
+            columns = []
+            for i in range(n):
+                k, pos = self._string(data, pos)
+                keys.append(k)
+
+                kind = data[pos]
+                column, pos = self._blob(data, pos + 1)
+                if kind == STR:
+                    columns.append(column.split("\n"))
+                else:
+                    columns.append(json_decode(column))
+
+            return [ dict(zip(keys, row)) for row in zip(*columns) ], pos
+        elif t == JSON:
+            s, pos = self._blob(data, pos)
+            return json_decode(s), pos
+        elif t == STR or t == DEFINE or t == REF:
+            return self._string(data, pos - 1)
+        elif t == ITEM_ID:
+            url, pos = self._string(data, pos)
+            rest, pos = self._blob(data, pos)
+            return ID_PREFIX + url + ID_SEP + rest + ID_SUFFIX, pos
+        elif t == LIST:
+            n, pos = self._varint(data, pos)
+            r = []
+            for i in range(n):
+                o, pos = self._decode(data, pos)
+                r.append(o)
+            return r, pos
+        elif t == NONE:
+            return None, pos
+        elif t == TRUE:
+            return True, pos
+        elif t == FALSE:
+            return False, pos
+        elif t == INT:
+            n, pos = self._varint(data, pos)
+            return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+        elif t == FLOAT:
+            return unpack_double(data, pos)[0], pos + 8
+
+        raise ValueError("Unknown type %d" % t)
@@ -11,6 +11,7 @@ from .locks import feed_lock, config_lock, tag_lock, watch_lock
 from .encoding import locale_enc
 from .transform import eval_transform
 from .feed import allfeeds, CantoFeed
+from .budget import budget
 from .tag import alltags
 
 import traceback
@@ -70,7 +71,11 @@ class CantoConfig():
                 ("rate", self.validate_int, False),
                 ("keep_time", self.validate_int, False),
                 ("keep_unread", self.validate_bool, False),
+                ("keep_fields", self.validate_string_list, False),
                 ("global_transform", self.validate_set_transform, False),
+                ("slow_command", self.validate_int, False),
+                ("max_items", self.validate_int, False),
+                ("min_items", self.validate_int, False),
         ]
 
         self.defaults_defaults = {
@@ -78,6 +83,9 @@ class CantoConfig():
                 "keep_time" : 86400,
                 "keep_unread" : False,
                 "global_transform" : "None",
+                "slow_command" : 500,
+                "max_items" : 0,
+                "min_items" : 10,
         }
 
         self.feed_validators = [
@@ -86,6 +94,8 @@ class CantoConfig():
                 ("rate", self.validate_int, False),
                 ("keep_time", self.validate_int, False),
                 ("keep_unread", self.validate_bool, False),
+                ("keep_fields", self.validate_string_list, False),
+                ("min_items", self.validate_int, False),
                 ("username", self.validate_string, False),
                 ("password", self.validate_string, False),
         ]
@@ -350,6 +360,13 @@ class CantoConfig():
                     if k in feed:
                         kws[k] = feed[k]
 
+                # Optional arguments that can also be set in defaults
+                for k in ["keep_fields", "min_items"]:
+                    if k in feed:
+                        kws[k] = feed[k]
+                    elif k in self.final["defaults"]:
+                        kws[k] = self.final["defaults"][k]
+
                 feed = CantoFeed(self.shelf, feed["name"],\
                         feed["url"], feed["rate"], feed["keep_time"], feed["keep_unread"], **kws)
 
@@ -358,6 +375,14 @@ class CantoConfig():
         self.global_transform = eval_transform(\
                 self.final["defaults"]["global_transform"])
 
+        # Commands slower than this many milliseconds are logged, 0 disables.
+
+        self.slow_command = self.final["defaults"]["slow_command"]
+
+        # Most items to store across all feeds, 0 for no limit.
+
+        budget.max_items = self.final["defaults"]["max_items"]
+
     # Delete settings from the JSON. Any key equal to "DELETE" will be removed,
     # keys that are lists will items removed if specified.
 
@@ -9,12 +9,17 @@
 
 from .plugins import PluginHandler, Plugin
 from .tag import alltags
+from .search import search
+from .sortindex import sortindex
 from .rwlock import RWLock, read_lock, write_lock
 from .locks import feed_lock, tag_lock
+from .schedule import CantoSchedule
+from .feedstats import CantoFeedStats
 from .hooks import call_hook
 
 import traceback
 import logging
+import heapq
 import json
 import time
 
@@ -68,6 +73,19 @@ class CantoFeeds():
                 f[feed] = [i]
         return f
 
+    # Like CantoFeed.set_attributes, for items in any feed, with one round of
+    # tag changes, so each tag they're in changes (and is sent as a TAGCHANGE)
+    # once. Called with feed_lock read and tag_lock write held.
+
+    def set_attributes(self, attributes):
+        feeds = self.items_to_feeds(list(attributes.keys()))
+        changed = [ (feed, feed._set_attributes(feeds[feed], attributes))\
+                for feed in feeds ]
+
+        for feed, items in changed:
+            feed._retag_changed_locked(items)
+        alltags.do_tag_changes()
+
     def all_parsed(self):
         for URL in self.dead_feeds:
             feed = self.dead_feeds[URL]
@@ -164,6 +182,9 @@ class CantoFeed(PluginHandler):
 
         self.last_update = 0
 
+        self.schedule = CantoSchedule(self)
+        self.stats = CantoFeedStats()
+
         # This is held by the update thread, as well as any get / set attribute
         # threads
 
@@ -177,6 +198,37 @@ class CantoFeed(PluginHandler):
         if "password" in kwargs:
             self.password = kwargs["password"]
 
+        # Entry keys to store, None means keep everything. The item ID and
+        # canto's own keys are always kept. Note that "description" is an
+        # alias for "summary" in get_attributes.
+
+        self.keep_fields = None
+        if "keep_fields" in kwargs and kwargs["keep_fields"] != None:
+            self.keep_fields = set(kwargs["keep_fields"])
+            if "description" in self.keep_fields:
+                self.keep_fields.add("summary")
+
+        # Items that max_items can't evict from this feed, see budget.py.
+
+        self.min_items = 0
+        if "min_items" in kwargs:
+            self.min_items = kwargs["min_items"]
+
+        # Bumped whenever items are indexed or have their attributes set, which
+        # is all that can make more items evictable.
+
+        self.changes = 0
+
+        # Heap of (when, id) for when items will expire, rebuilt on every
+        # index, and ids that expire() has dropped from disk but that are
+        # still waiting to be untagged. See retention.py. latest is the
+        # newest canto_update, i.e. when items were last seen in the feed.
+
+        self.expiry = []
+        self.expiring = set()
+        self.latest = 0
+        self.item_count = 0
+
         allfeeds.add_feed(URL, self)
 
     def __str__(self):
@@ -223,32 +275,53 @@ class CantoFeed(PluginHandler):
 
     # Given an ID and a dict of attributes, update the disk.
     def set_attributes(self, items, attributes):
+        changed = self._set_attributes(items, attributes)
 
-        self.lock.acquire_write()
+        feed_lock.acquire_read()
+        tag_lock.acquire_write()
 
-        d = self.shelf[self.URL]
+        self._retag_changed_locked(changed)
+        alltags.do_tag_changes()
 
-        items_to_remove = []
-        tags_to_add = []
+        tag_lock.release_write()
+        feed_lock.release_read()
 
-        for item in items:
-            d_id = dict_id(item)["ID"]
+    # Update the disk, and return [ (old, item) ... ] for the items that were
+    # found, where old is a copy of the item from before the change.
 
-            for d_item in d["entries"]:
-                if d_id != d_item["id"]:
+    def _set_attributes(self, items, attributes):
+        self.lock.acquire_write()
+        try:
+            if self.stopped or self.URL not in self.shelf:
+                return []
+
+            d = self.shelf[self.URL]
+            entries = dict([ (item["id"], item) for item in d["entries"] ])
+            changed = []
+
+            for item in items:
+                d_item = entries.get(dict_id(item)["ID"])
+                if d_item == None:
                     continue
-                for a in attributes[item]:
-                    d_item[a] = attributes[item][a]
 
-                items_to_remove.append(d_item)
-                tags_to_add += self._tag([d_item])
+                old = dict(d_item)
+                d_item.update(attributes[item])
+                changed.append((old, d_item))
 
-        self.shelf[self.URL] = d
-        self.shelf.update_umod()
+                # Items kept because they were unread can expire once read.
 
-        self.lock.release_write()
+                if self.keep_unread:
+                    heapq.heappush(self.expiry,
+                            (self._expires(d_item), d_item["id"]))
 
-        self._retag(items_to_remove, tags_to_add, [])
+            if changed:
+                self.shelf[self.URL] = d
+                self.shelf.update_umod()
+                self.changes += 1
+
+            return changed
+        finally:
+            self.lock.release_write()
 
     def _item_id(self, item):
         return json.dumps({ "URL" : self.URL, "ID" : item["id"] })
@@ -269,42 +342,267 @@ class CantoFeed(PluginHandler):
         feed_lock.acquire_read()
         tag_lock.acquire_write()
 
+        self._retag_locked(items_to_remove, tags_to_add, tags_to_remove)
+        alltags.do_tag_changes()
+
+        tag_lock.release_write()
+        feed_lock.release_read()
+
+    # The work of _retag, without the tag changes, for callers that hold the
+    # locks and retag more than one feed.
+
+    def _retag_locked(self, items_to_remove, tags_to_add, tags_to_remove):
+        old = {}
         for item in items_to_remove:
-            alltags.remove_id(self._item_id(item))
+            old[self._item_id(item)] = item
+        alltags.remove_ids(old)
 
+        new = {}
         for item, tag in tags_to_add:
-            alltags.add_tag(self._item_id(item), tag)
+            id = self._item_id(item)
+            alltags.add_tag(id, tag)
+            alltags.set_read(id, "read" in item.get("canto-state", []))
+            new[id] = item
 
         for item, tag in tags_to_remove:
             alltags.remove_tag(self._item_id(item), tag)
 
-        alltags.do_tag_changes()
+        search.update(self.URL, old, new)
+        sortindex.update(self.URL, old, new)
 
-        tag_lock.release_write()
-        feed_lock.release_read()
+    # Retag items changed by _set_attributes. Items that are still in the same
+    # tags (like when only their state changed) just have their tags marked
+    # changed, instead of being taken out of each tag and put back at the end.
+    # Called with feed_lock read and tag_lock write held.
 
-    def _keep_olditem(self, olditem):
-        ref_time = time.time()
+    def _retag_changed_locked(self, changed):
+        items_to_remove = []
+        tags_to_add = []
+        old = {}
+        new = {}
 
-        if "canto_update" not in olditem:
-            olditem["canto_update"] = ref_time
+        for old_item, item in changed:
+            id = self._item_id(item)
+            tags = set([ tag for i, tag in self._tag([ item ]) ])
 
-        item_time = olditem["canto_update"]
+            if tags != set([ tag for i, tag in self._tag([ old_item ]) ]) or\
+                    not tags <= alltags.item_tags.get(id, set()):
+                items_to_remove.append(old_item)
+                tags_to_add += self._tag([ item ])
+                continue
 
-        if "canto-state" in olditem:
-            item_state = olditem["canto-state"]
-        else:
-            item_state = []
+            alltags.set_read(id, "read" in item.get("canto-state", []))
+            alltags.item_changed(id)
+            old[id] = old_item
+            new[id] = item
 
-        if (ref_time - item_time) < self.keep_time:
-            log.debug("Item not over keep_time (%d): %s", 
-                    self.keep_time, olditem["id"])
-        elif self.keep_unread and "read" not in item_state:
-            log.debug("Keeping unread item: %s\n", olditem["id"])
-        else:
-            log.debug("Discarding: %s", olditem["id"])
-            return False
-        return True
+        search.update(self.URL, old, new)
+        sortindex.update(self.URL, old, new)
+
+        if items_to_remove:
+            self._retag_locked(items_to_remove, tags_to_add, [])
+
+    # Write schedule state without a full index (i.e. on failed fetches).
+
+    def save_schedule(self):
+        self.lock.acquire_write()
+        try:
+            if self.stopped:
+                return
+
+            if self.URL in self.shelf:
+                d = self.shelf[self.URL]
+            else:
+                d = { "entries" : [] }
+
+            d["canto-schedule"] = self.schedule.state
+            self.shelf[self.URL] = d
+        finally:
+            self.lock.release_write()
+
+    # Strip entries down to keep_fields, return number of keys removed.
+
+    def _prune(self, entries):
+        if self.keep_fields == None:
+            return 0
+
+        pruned = 0
+        for entry in entries:
+            for key in list(entry.keys()):
+                if key == "id" or key.startswith("canto") or\
+                        key in self.keep_fields:
+                    continue
+                del entry[key]
+                pruned += 1
+        return pruned
+
+    # Prune entries already on disk, for when keep_fields has been set or
+    # narrowed after items were stored.
+
+    def compact(self):
+        self.lock.acquire_write()
+        try:
+            if self.URL not in self.shelf:
+                return 0
+
+            d = self.shelf[self.URL]
+            pruned = self._prune(d["entries"])
+            if pruned:
+                self.shelf[self.URL] = d
+            return pruned
+        finally:
+            self.lock.release_write()
+
+    # When an item expires. Items from the latest fetch are still in the feed,
+    # so they're kept at least until a couple of missed fetches, even if
+    # keep_time is shorter than the rate.
+
+    def _protected(self):
+        return self.latest + 2 * self.schedule.interval()
+
+    def _expires(self, item, latest = None, protected = None):
+        if latest == None:
+            latest = self.latest
+            protected = self._protected()
+
+        when = item["canto_update"] + self.keep_time
+        if item["canto_update"] >= latest and when < protected:
+            return protected
+        return when
+
+    # Drop expired items from disk, and return them so the caller can untag
+    # them (see retention.py). Heap entries can be stale (the item was seen
+    # again, or is gone), so each is checked against the item on disk.
+
+    def expire(self, now):
+        self.lock.acquire_write()
+        try:
+            if self.stopped or not self.expiry or self.expiry[0][0] > now or\
+                    self.URL not in self.shelf:
+                return []
+
+            d = self.shelf[self.URL]
+            entries = dict([ (item["id"], item) for item in d["entries"] ])
+            protected = self._protected()
+            expired = {}
+
+            while self.expiry and self.expiry[0][0] <= now:
+                when, id = heapq.heappop(self.expiry)
+                if id not in entries or id in expired:
+                    continue
+
+                item = entries[id]
+                when = self._expires(item, self.latest, protected)
+                if when > now:
+                    heapq.heappush(self.expiry, (when, id))
+                elif self.keep_unread and\
+                        "read" not in item.get("canto-state", []):
+                    log.debug("Keeping unread item: %s", id)
+                else:
+                    log.debug("Discarding: %s", id)
+                    expired[id] = item
+
+            self._drop(d, expired)
+            return list(expired.values())
+        finally:
+            self.lock.release_write()
+
+    # Drop read items, given by id, from disk, down to min_items and return
+    # them so the caller can untag them (see budget.py). Items from the latest
+    # fetch are never dropped, they'd just come back unread on the next one.
+
+    def evict(self, ids):
+        self.lock.acquire_write()
+        try:
+            if self.stopped or self.URL not in self.shelf:
+                return []
+
+            d = self.shelf[self.URL]
+            allowed = len(d["entries"]) - self.min_items
+            evicted = {}
+
+            for item in d["entries"]:
+                if len(evicted) >= allowed:
+                    break
+                if item["id"] in ids and self._evictable(item):
+                    evicted[item["id"]] = item
+
+            self._drop(d, evicted)
+            return list(evicted.values())
+        finally:
+            self.lock.release_write()
+
+    # Read items that could be evicted, as [ (key, full id, id) ... ], where
+    # key is when they were last accessed (or seen in a fetch), oldest first.
+
+    def eviction_candidates(self, access):
+        self.lock.acquire_read()
+        try:
+            if self.stopped or self.URL not in self.shelf:
+                return []
+
+            entries = self.shelf[self.URL]["entries"]
+            allowed = len(entries) - self.min_items
+            if allowed <= 0:
+                return []
+
+            r = []
+            for item in entries:
+                if self._evictable(item):
+                    full_id = self._item_id(item)
+                    seen = access.get(full_id, item.get("canto_update", 0))
+                    r.append((seen, full_id, item["id"]))
+
+            r.sort()
+            return r[:allowed]
+        finally:
+            self.lock.release_read()
+
+    def _evictable(self, item):
+        return item["canto_update"] < self.latest and\
+                "read" in item.get("canto-state", [])
+
+    def _drop(self, d, dropped):
+        if not dropped:
+            return
+
+        d["entries"] = [ item for item in d["entries"]\
+                if item["id"] not in dropped ]
+        self.shelf[self.URL] = d
+        self.item_count = len(d["entries"])
+        self.expiring.update(dropped.keys())
+
+    # Untag items returned by expire() or evict(), unless they've been indexed
+    # again since. Called with feed_lock read and tag_lock write held.
+
+    def untag_expired(self, items):
+        items = [ item for item in items if item["id"] in self.expiring ]
+        self.expiring.difference_update([ item["id"] for item in items ])
+        self._retag_locked(items, [], [])
+        return len(items)
+
+    def _schedule_expiry(self, entries):
+        now = time.time()
+        latest = 0
+        for item in entries:
+            if "canto_update" not in item:
+                item["canto_update"] = now
+            latest = max(latest, item["canto_update"])
+
+        self.latest = latest
+        self.item_count = len(entries)
+        protected = self._protected()
+        keep_time = self.keep_time
+
+        # Same as _expires(), inline.
+
+        self.expiry = [ (max(t + keep_time, protected) if t >= latest else\
+                t + keep_time, id) for t, id in\
+                [ (item["canto_update"], item["id"]) for item in entries ] ]
+        heapq.heapify(self.expiry)
+
+        if self.expiring:
+            self.expiring.difference_update([ item["id"] for item in entries ])
 
     # Re-index contents
     # If we have update_contents, use that
@@ -319,6 +617,8 @@ class CantoFeed(PluginHandler):
         if self.stopped:
             return
 
+        start = time.time()
+
         self.lock.acquire_write()
 
         if self.URL not in self.shelf:
@@ -329,6 +629,9 @@ class CantoFeed(PluginHandler):
             old_contents = self.shelf[self.URL]
             log.debug("Fetched previous content for %s.", self.URL)
 
+        if not self.schedule.loaded:
+            self.schedule.load(old_contents)
+
         new_entries = []
 
         for i, item in enumerate(update_contents["entries"]):
@@ -363,24 +666,25 @@ class CantoFeed(PluginHandler):
 
         old_entries.sort(key=lambda x: x[1])
 
-        keep_all = new_entries == []
+        # Old items are all kept, they're expired by retention.py.
 
         kept_entries = []
+        new_items = 0
+        j = 0
 
         for x in new_entries:
 
-            # old_entry is really old, see if we should keep or discard
+            # old_entry isn't in the new content, keep it
 
-            while old_entries and x[1] > old_entries[0][1]:
-                if keep_all or self._keep_olditem(old_entries[0][2]):
-                    kept_entries.append(old_entries.pop(0))
-                else:
-                    old_entries.pop(0)
+            while j < len(old_entries) and x[1] > old_entries[j][1]:
+                kept_entries.append(old_entries[j])
+                j += 1
 
             # new entry and old entry match, move content over
 
-            if old_entries and x[1] == old_entries[0][1]:
-                olditem = old_entries.pop(0)[2]
+            if j < len(old_entries) and x[1] == old_entries[j][1]:
+                olditem = old_entries[j][2]
+                j += 1
                 for key in olditem:
                     if key == "canto_update":
                         continue
@@ -391,21 +695,23 @@ class CantoFeed(PluginHandler):
 
             else:
                 call_hook("daemon_new_item", [self, x[2]])
+                new_items += 1
+
+        kept_entries += old_entries[j:]
 
         # Resort lists by place, instead of string id
         new_entries.sort()
-        old_entries.sort()
 
-        if keep_all:
-            kept_entries += old_entries
-        else:
-            for x in old_entries:
-                if self._keep_olditem(x[2]):
-                    kept_entries.append(x)
+        self.stats.update({ "added" : new_items, "kept" : len(kept_entries) })
 
         kept_entries.sort()
         new_entries += kept_entries
 
+        # Only real fetches have canto_update, not loads from disk.
+
+        if "canto_update" in update_contents:
+            self.schedule.indexed([ x[2] for x in new_entries ], new_items)
+
         update_contents["entries"] = [ x[2] for x in new_entries ]
 
         tags_to_add = self._tag(update_contents["entries"])
@@ -440,6 +746,16 @@ class CantoFeed(PluginHandler):
                 log.error("Error running feed editing plugin")
                 log.error(traceback.format_exc())
 
+        # Prune after plugins have run, as they may rely on fields that aren't
+        # going to be stored.
+
+        self._prune(update_contents["entries"])
+
+        self._schedule_expiry(update_contents["entries"])
+        self.changes += 1
+
+        update_contents["canto-schedule"] = self.schedule.state
+
         if not self.stopped:
             # Commit the updates to disk.
 
@@ -447,7 +763,12 @@ class CantoFeed(PluginHandler):
 
             self.lock.release_write()
 
+            retag_start = time.time()
+            self.stats.record("index", retag_start - start)
+
             self._retag(old_contents["entries"] + remove_items, tags_to_add, tags_to_remove)
+
+            self.stats.record("retag", time.time() - retag_start)
         else:
             self.lock.release_write()
 
@@ -458,3 +779,6 @@ class CantoFeed(PluginHandler):
         self.stopped = True
         if self.URL in self.shelf:
             del self.shelf[self.URL]
+
+        search.remove_feed(self.URL)
+        sortindex.remove_feed(self.URL)
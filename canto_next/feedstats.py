@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# CantoFeedStats keeps timing and size numbers for the last STATS_WINDOW
+# fetches of a feed, so we can find the feeds that dominate a fetch cycle.
+#
+# A sample is started by the fetch thread, filled in as the fetch goes
+# through download, parse and index, and committed at the end. Only one fetch
+# thread runs per feed, so there is at most one open sample.
+#
+# Sample keys (times in seconds):
+#
+#   fetch     - all of get_update(), i.e. download + parse with feedparser
+#   dns       - name resolution (pooled fetches on a new connection only)
+#   connect   - TCP / TLS connect (pooled fetches on a new connection only)
+#   download  - request to last byte of the body (pooled fetches only)
+#   bytes     - size of the body, after decompression (pooled fetches only)
+#   parse     - feedparser (pooled fetches only) and sanitizing
+#   index     - CantoFeed.index, excluding retag
+#   retag     - CantoFeed._retag
+#   added     - items new in this fetch
+#   kept      - old items kept, even though they weren't in this fetch
+#   total     - the whole fetch thread
+#   failed    - 1 if the fetch failed, so its mean is the failure rate
+
+from threading import Lock
+from collections import deque
+
+import time
+
+STATS_WINDOW = 20
+
+class CantoFeedStats():
+    def __init__(self, window = STATS_WINDOW):
+        self.samples = deque(maxlen = window)
+        self.current = None
+        self.lock = Lock()
+
+    def begin(self):
+        self.current = { "started" : time.time() }
+
+    def record(self, key, value):
+        sample = self.current
+        if sample == None:
+            return
+        sample[key] = sample.get(key, 0) + value
+
+    def update(self, d):
+        for key in d:
+            self.record(key, d[key])
+
+    def commit(self):
+        sample = self.current
+        if sample == None:
+            return
+
+        self.current = None
+        sample["total"] = time.time() - sample["started"]
+        sample.setdefault("failed", 0)
+
+        self.lock.acquire()
+        self.samples.append(sample)
+        self.lock.release()
+
+    # Average of each key over the window, along with the last sample.
+
+    def summary(self):
+        self.lock.acquire()
+        samples = list(self.samples)
+        self.lock.release()
+
+        if not samples:
+            return None
+
+        sums = {}
+        counts = {}
+
+        for sample in samples:
+            for key in sample:
+                if key == "started":
+                    continue
+                sums[key] = sums.get(key, 0) + sample[key]
+                counts[key] = counts.get(key, 0) + 1
+
+        mean = {}
+        for key in sums:
+            mean[key] = sums[key] / counts[key]
+
+        return { "samples" : len(samples), "mean" : mean,
+                "last" : samples[-1] }
@@ -15,20 +15,78 @@ from threading import Thread
 
 import feedparser
 import traceback
+import json
 import urllib.parse
 import urllib.request
 import urllib.error
 import logging
 import socket
-import json
 import time
 
 log = logging.getLogger("CANTO-FETCH")
 
-# Function to pass to json.dumps to strip non-serializable data
-def json_ignore(x):
+# Top level keys of a feedparser result that are worth storing. Everything
+# else (response headers, namespaces, ...) is only interesting at fetch time.
+# Plugins that need more can append to this list, which is also handed to
+# parse pool workers since they don't run plugins.
+
+keep_toplevel = [ "entries", "feed", "bozo", "bozo_exception", "canto_update",
+        "etag", "modified", "href", "status", "version", "encoding" ]
+
+# Strip non-serializable data (time.struct_time becomes a list, exceptions and
+# other objects become None, FeedParserDicts become plain dicts) in one pass.
+# This is equivalent to
+#
+#   json.loads(json.dumps(obj, default=lambda x: None, skipkeys=True))
+#
+# without building the intermediate string.
+
+def json_clean(obj):
+    t = type(obj)
+    if t in [ str, int, float, bool ] or obj is None:
+        return obj
+
+    if isinstance(obj, dict):
+        r = {}
+        for key, value in obj.items():
+            if type(key) != str:
+                if isinstance(key, str):
+                    key = str.__str__(key)
+                elif key is None:
+                    key = "null"
+                elif type(key) == bool:
+                    key = "true" if key else "false"
+                elif isinstance(key, (int, float)):
+                    key = json.dumps(key)
+                else:
+                    continue
+            r[key] = json_clean(value)
+        return r
+
+    if isinstance(obj, (list, tuple)):
+        return [ json_clean(x) for x in obj ]
+
+    if isinstance(obj, str):
+        return str.__str__(obj)
+    if isinstance(obj, int):
+        return int(obj)
+    if isinstance(obj, float):
+        return float(obj)
     return None
 
+def sanitize_update(update_contents, clean=False, keep=None):
+    if keep == None:
+        keep = keep_toplevel
+
+    r = {}
+    for key in keep:
+        if key in update_contents:
+            if clean:
+                r[key] = update_contents[key]
+            else:
+                r[key] = json_clean(update_contents[key])
+    return r
+
 class DaemonFetchThreadPlugin(Plugin):
     pass
 
@@ -52,6 +110,43 @@ class CantoFetchThread(PluginHandler, Thread):
         self.feed = feed
         self.fromdisk = fromdisk
 
+        # Set by get_update implementations that return content that's already
+        # been stripped of non-serializable data (i.e. parsed out of process).
+
+        self.sanitized = False
+
+    # Download and parse the feed, returning feedparser's result.
+    # DaemonFetchThreadPlugins can replace this wholesale by defining
+    # "get_update" in their plugin_attrs, for example to use a different
+    # transport than feedparser's own urllib fetching.
+
+    def get_update(self, extra_headers):
+        # Passworded Feed
+        if self.feed.username or self.feed.password:
+            domain = urllib.parse.urlparse(self.feed.URL)[1]
+            man = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+            auth = urllib.request.HTTPBasicAuthHandler(man)
+            auth.handler_order = 490
+            auth.add_password(None, domain, self.feed.username,
+                    self.feed.password)
+
+            try:
+                return feedparser.parse(self.feed.URL, handlers=[auth],
+                        request_headers = extra_headers)
+            except:
+                # And, failing that, Digest Authentication
+                man = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+                auth = urllib.request.HTTPDigestAuthHandler(man)
+                auth.handler_order = 490
+                auth.add_password(None, domain, self.feed.username,
+                        self.feed.password)
+                return feedparser.parse(self.feed.URL, handlers=[auth],
+                        request_headers = extra_headers)
+
+        # No password
+        return feedparser.parse(self.feed.URL,
+                request_headers = extra_headers)
+
     def run(self):
 
         # Initial load, just feed.index grab from disk.
@@ -61,54 +156,48 @@ class CantoFetchThread(PluginHandler, Thread):
             return
 
         self.feed.last_update = time.time()
+        self.feed.stats.begin()
+
+        try:
+            self._fetch()
+        finally:
+            self.feed.stats.commit()
+
+    def _fetch(self):
 
         # Otherwise, actually try to get an update.
 
         extra_headers = { 'User-Agent' :\
                 'Canto/0.9.0 + http://codezen.org/canto-ng'}
 
-        try:
-            result = None
-            # Passworded Feed
-            if self.feed.username or self.feed.password:
-                domain = urllib.parse.urlparse(self.feed.URL)[1]
-                man = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-                auth = urllib.request.HTTPBasicAuthHandler(man)
-                auth.handler_order = 490
-                auth.add_password(None, domain, self.feed.username,
-                        self.feed.password)
+        # Only ask for changes if we've got the old content to fall back on.
 
-                try:
-                    result = feedparser.parse(self.feed.URL, handlers=[auth],
-                            request_headers = extra_headers)
-                except:
-                    # And, failing that, Digest Authentication
-                    man = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-                    auth = urllib.request.HTTPDigestAuthHandler(man)
-                    auth.handler_order = 490
-                    auth.add_password(None, domain, self.feed.username,
-                            self.feed.password)
-                    result = feedparser.parse(self.feed.URL, handlers=[auth],
-                            request_headers = extra_headers)
-
-            # No password
-            else:
-                result = feedparser.parse(self.feed.URL,
-                        request_headers = extra_headers)
+        if self.feed.URL in self.feed.shelf:
+            extra_headers.update(self.feed.schedule.request_headers())
 
-            update_contents = result
+        start = time.time()
+        try:
+            update_contents = self.get_update(extra_headers)
         except Exception as e:
             log.error("ERROR: try to parse %s, got %s" % (self.feed.URL, e))
+            self.feed.schedule.failed("%s" % e)
+            self.feed.stats.record("failed", 1)
             return
+        finally:
+            self.feed.stats.record("fetch", time.time() - start)
 
         # Allow DaemonFetchThreadPlugins to do any sort of fetch stuff Doing
         # this before any other processing allows us to have plugins that
         # totally override the standard fetch.
 
+        fetch_plugins = False
+
         for attr in list(self.plugin_attrs.keys()):
             if not attr.startswith("fetch_"):
                 continue
 
+            fetch_plugins = True
+
             try:
                 a = getattr(self, attr)
                 a(feed = self.feed, newcontent = update_contents)
@@ -127,11 +216,17 @@ class CantoFetchThread(PluginHandler, Thread):
                 log.error("ERROR: couldn't grab %s : %s" %\
                         (self.feed.URL,\
                         update_contents["bozo_exception"].reason))
+                self.feed.schedule.failed("%s" %\
+                        update_contents["bozo_exception"].reason)
+                self.feed.stats.record("failed", 1)
                 return
             elif len(update_contents["entries"]) == 0:
                 log.error("No content in %s: %s" %\
                         (self.feed.URL,\
                         update_contents["bozo_exception"]))
+                self.feed.schedule.failed("No content: %s" %\
+                        update_contents["bozo_exception"])
+                self.feed.stats.record("failed", 1)
                 return
 
             # Replace it if we ignore it, since exceptions
@@ -139,10 +234,21 @@ class CantoFetchThread(PluginHandler, Thread):
 
             update_contents["bozo_exception"] = None
 
+        # After fetch_* plugins, which can replace the content entirely.
+
+        self.feed.schedule.fetched(update_contents)
+        self.feed.schedule.succeeded()
+
         # Update timestamp
         update_contents["canto_update"] = self.feed.last_update
 
-        update_contents = json.loads(json.dumps(update_contents, default=json_ignore))
+        # fetch_* plugins may have added anything to the content, so only trust
+        # sanitized content if none ran.
+
+        start = time.time()
+        update_contents = sanitize_update(update_contents,
+                self.sanitized and not fetch_plugins)
+        self.feed.stats.record("parse", time.time() - start)
 
         log.debug("Parsed %s", self.feed.URL)
 
@@ -158,10 +264,7 @@ class CantoFetch():
         log.debug("Thread Limit: %s", self.thread_limit)
 
     def needs_update(self, feed):
-        passed = time.time() - feed.last_update
-        if passed < feed.rate * 60:
-            return False
-        return True
+        return feed.schedule.needs_update(feed.last_update)
 
     def still_working(self, URL):
         for thread, workingURL in self.threads:
@@ -185,13 +288,20 @@ class CantoFetch():
         self.threads.append((thread, feed.URL))
         return True
 
-    def fetch(self, force, fromdisk):
+    # Start deferred work, returns False if there's still some left.
+
+    def fetch_deferred(self):
         for feed, fd in self.deferred[:]:
             if self._start_one(feed, fd):
                 log.debug("No longer deferred")
                 self.deferred = self.deferred[1:]
             else:
-                return
+                return False
+        return True
+
+    def fetch(self, force, fromdisk):
+        if not self.fetch_deferred():
+            return
 
         for feed in allfeeds.get_feeds():
             if not force and not self.needs_update(feed):
@@ -209,7 +319,7 @@ class CantoFetch():
         newthreads = []
 
         for thread, URL in self.threads:
-            if not force and thread.isAlive():
+            if not force and thread.is_alive():
                 newthreads.append((thread, URL))
                 continue
             work_done = True
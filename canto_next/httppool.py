@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# CantoHTTPPool is an alternative transport for feed downloads. Instead of
+# feedparser opening a fresh urllib connection for every fetch, requests are
+# funneled into a single asyncio event loop running in its own thread, which
+# keeps a few persistent HTTP/1.1 connections open per host and bounds the
+# total number of requests in flight.
+#
+# Fetch threads are still threads, they just block on the result of the
+# coroutine instead of on a socket of their own.
+
+from .schedule import skip_hours_from
+
+from threading import Thread, Lock
+
+import urllib.request
+import urllib.parse
+import feedparser
+import asyncio
+import logging
+import base64
+import socket
+import time
+import zlib
+import ssl
+
+log = logging.getLogger("HTTPPOOL")
+
+# The biggest body we'll take, as sent or decompressed. Feeds are rarely more
+# than a few megabytes, this is to keep a broken or hostile server (or a small
+# gzip bomb) from filling memory.
+
+MAX_BODY = 64 * 1024 * 1024
+
+class CantoHTTPResponse():
+    def __init__(self, URL, status, headers, body):
+        self.URL = URL
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+        # Seconds spent in dns, connect and download, summed over redirects
+        # and auth retries.
+        self.timing = { "dns" : 0, "connect" : 0, "download" : 0 }
+
+    def __str__(self):
+        return "CantoHTTPResponse: %s %s (%d bytes)" %\
+                (self.status, self.URL, len(self.body))
+
+class CantoHTTPConnection():
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.time()
+        self.requests = 0
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class CantoHTTPPool():
+    def __init__(self, max_connections=8, max_per_host=2, idle_timeout=60,
+            timeout=30, max_redirects=5):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+
+        # (scheme, host, port) -> [ idle CantoHTTPConnections ]
+        self.idle = {}
+
+        # (scheme, host, port) -> asyncio.Semaphore
+        self.host_sems = {}
+
+        # Connection counters, mostly so tests and stats can tell whether
+        # we're actually reusing anything.
+
+        self.opened = 0
+        self.reused = 0
+
+        self.loop = None
+        self.thread = None
+        self.sem = None
+        self.ssl_context = None
+        self.start_lock = Lock()
+
+    # The loop is started lazily, so that importing this module (and creating
+    # the pool in a plugin) is free for canto-remote and friends.
+
+    def start(self):
+        self.start_lock.acquire()
+        try:
+            if self.loop:
+                return
+
+            self.loop = asyncio.new_event_loop()
+
+            self.thread = Thread(target = self._run_loop, name = "HTTP Pool")
+            self.thread.daemon = True
+            self.thread.start()
+            log.debug("Started HTTP pool loop.")
+        finally:
+            self.start_lock.release()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.sem = asyncio.Semaphore(self.max_connections)
+        self.loop.call_later(self.idle_timeout, self._reap_idle)
+        self.loop.run_forever()
+
+    def _reap_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        for key in list(self.idle.keys()):
+            for conn in self.idle[key][:]:
+                if conn.last_used < cutoff:
+                    log.debug("Closing idle connection to %s", key[1])
+                    self.idle[key].remove(conn)
+                    conn.close()
+            if self.idle[key] == []:
+                del self.idle[key]
+        self.loop.call_later(self.idle_timeout, self._reap_idle)
+
+    def close(self):
+        if not self.loop:
+            return
+
+        def _close():
+            for key in self.idle:
+                for conn in self.idle[key]:
+                    conn.close()
+            self.idle = {}
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(_close)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.thread = None
+
+    # Blocking interface for fetch threads.
+
+    def get(self, URL, headers={}, username=None, password=None):
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(\
+                self._get(URL, headers, username, password), self.loop)
+        return future.result()
+
+    # Fetch several URLs concurrently, returns a list of responses (or
+    # exceptions) in the same order as URLs.
+
+    def get_many(self, URLs, headers={}):
+        self.start()
+
+        async def _gather():
+            return await asyncio.gather(\
+                    *[ self._get(URL, headers, None, None) for URL in URLs ],
+                    return_exceptions = True)
+
+        future = asyncio.run_coroutine_threadsafe(_gather(), self.loop)
+        return future.result()
+
+    def _host_key(self, URL):
+        parts = urllib.parse.urlsplit(URL)
+        if parts.scheme not in [ "http", "https" ]:
+            raise Exception("Unsupported scheme: %s" % parts.scheme)
+
+        port = parts.port
+        if not port:
+            port = 443 if parts.scheme == "https" else 80
+
+        return (parts.scheme, parts.hostname, port)
+
+    def _host_sem(self, key):
+        if key not in self.host_sems:
+            self.host_sems[key] = asyncio.Semaphore(self.max_per_host)
+        return self.host_sems[key]
+
+    # Resolve separately from connecting so the two can be timed.
+
+    async def _open(self, key, timing):
+        scheme, host, port = key
+        ssl_ctx = None
+        server_hostname = None
+        if scheme == "https":
+            if not self.ssl_context:
+                self.ssl_context = ssl.create_default_context()
+            ssl_ctx = self.ssl_context
+            server_hostname = host
+
+        start = time.time()
+        addrs = await asyncio.get_running_loop().getaddrinfo(host, port,
+                type = socket.SOCK_STREAM)
+        timing["dns"] += time.time() - start
+
+        start = time.time()
+        try:
+            for i, addr in enumerate(addrs):
+                try:
+                    reader, writer = await asyncio.open_connection(\
+                            addr[4][0], addr[4][1], ssl = ssl_ctx,
+                            server_hostname = server_hostname)
+                    break
+                except OSError:
+                    if i == len(addrs) - 1:
+                        raise
+        finally:
+            timing["connect"] += time.time() - start
+
+        self.opened += 1
+        log.debug("Opened connection to %s:%d", host, port)
+        return CantoHTTPConnection(reader, writer)
+
+    def _checkout(self, key):
+        while key in self.idle and self.idle[key]:
+            conn = self.idle[key].pop()
+            if conn.reader.at_eof() or conn.writer.is_closing():
+                conn.close()
+                continue
+            self.reused += 1
+            return conn
+        return None
+
+    def _checkin(self, key, conn):
+        conn.last_used = time.time()
+        if key in self.idle:
+            self.idle[key].append(conn)
+        else:
+            self.idle[key] = [ conn ]
+
+    async def _get(self, URL, headers, username, password):
+        auth = None
+        redirects = 0
+        timing = { "dns" : 0, "connect" : 0, "download" : 0 }
+
+        while True:
+            req_headers = { "Accept-Encoding" : "gzip, deflate" }
+            req_headers.update(headers)
+            if auth:
+                req_headers["Authorization"] = auth
+
+            status, resp_headers, body = await self._request(URL,
+                    req_headers, timing)
+
+            if status in [ 301, 302, 303, 307, 308 ] and\
+                    "location" in resp_headers:
+                redirects += 1
+                if redirects > self.max_redirects:
+                    raise Exception("Too many redirects: %s" % URL)
+                URL = urllib.parse.urljoin(URL, resp_headers["location"])
+                log.debug("Redirected to %s", URL)
+                continue
+
+            if status == 401 and not auth and (username or password):
+                auth = self._authorization(URL, resp_headers, username,
+                        password)
+                if auth:
+                    continue
+
+            response = CantoHTTPResponse(URL, status, resp_headers,
+                    self._decode_body(resp_headers, body))
+            response.timing = timing
+            return response
+
+    # Emulate the HTTPBasicAuthHandler / HTTPDigestAuthHandler pair that the
+    # default fetch path uses.
+
+    def _authorization(self, URL, resp_headers, username, password):
+        if "www-authenticate" not in resp_headers:
+            return None
+
+        challenge = resp_headers["www-authenticate"]
+        scheme = challenge.split(" ", 1)[0].lower()
+
+        if scheme == "basic":
+            creds = "%s:%s" % (username, password)
+            return "Basic " + base64.b64encode(creds.encode("UTF-8")).decode()
+
+        if scheme == "digest":
+            man = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+            man.add_password(None, urllib.parse.urlsplit(URL)[1], username,
+                    password)
+            handler = urllib.request.HTTPDigestAuthHandler(man)
+            chal = urllib.request.parse_keqv_list(\
+                    urllib.request.parse_http_list(challenge.split(" ", 1)[1]))
+            return handler.get_authorization(urllib.request.Request(URL), chal)
+
+        log.debug("Unknown auth scheme: %s", scheme)
+        return None
+
+    # zlib.decompress, but refusing to inflate past MAX_BODY.
+
+    def _inflate(self, body, wbits):
+        decompressor = zlib.decompressobj(wbits)
+        r = decompressor.decompress(body, MAX_BODY)
+        if decompressor.unconsumed_tail:
+            raise Exception("Decompressed body over %d bytes" % MAX_BODY)
+        if not decompressor.eof:
+            raise zlib.error("Incomplete or truncated stream")
+        return r
+
+    def _decode_body(self, resp_headers, body):
+        encoding = resp_headers.get("content-encoding", "").lower()
+        try:
+            if encoding == "gzip":
+                return self._inflate(body, 16 + zlib.MAX_WBITS)
+            elif encoding == "deflate":
+                try:
+                    return self._inflate(body, zlib.MAX_WBITS)
+                except zlib.error:
+                    return self._inflate(body, -zlib.MAX_WBITS)
+        except zlib.error as e:
+            log.error("Failed to decompress body: %s" % e)
+        return body
+
+    async def _request(self, URL, headers, timing):
+        key = self._host_key(URL)
+        parts = urllib.parse.urlsplit(URL)
+
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        host = parts.hostname
+        if parts.port:
+            host += ":%d" % parts.port
+
+        request = "GET %s HTTP/1.1\r\nHost: %s\r\n" % (path, host)
+        for header in headers:
+            request += "%s: %s\r\n" % (header, headers[header])
+        request += "\r\n"
+        request = request.encode("latin-1")
+
+        # The timeout only starts once we have our slots, so requests queued
+        # behind others to the same host don't time out without being sent.
+
+        async with self.sem:
+            async with self._host_sem(key):
+                return await asyncio.wait_for(self._exchange(key, request,
+                    timing), self.timeout)
+
+    async def _exchange(self, key, request, timing):
+
+        # A pooled connection may have been closed by the server since we last
+        # used it, which we only find out by trying. In that case, retry once
+        # on a fresh connection.
+
+        conn = self._checkout(key)
+        for attempt in range(2):
+            fresh = conn == None
+            if fresh:
+                conn = await self._open(key, timing)
+
+            start = time.time()
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                status, resp_headers, body, keep =\
+                        await self._response(conn.reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                conn = None
+                if fresh:
+                    raise
+                log.debug("Stale connection to %s, retrying", key[1])
+                continue
+            except:
+                conn.close()
+                raise
+
+            timing["download"] += time.time() - start
+
+            conn.requests += 1
+            if keep:
+                self._checkin(key, conn)
+            else:
+                conn.close()
+
+            return (status, resp_headers, body)
+
+    async def _response(self, reader):
+        status_line = await reader.readuntil(b"\r\n")
+        version, status = status_line.decode("latin-1").split(" ", 2)[:2]
+        status = int(status)
+
+        resp_headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            resp_headers[name.strip().lower()] = value.strip()
+
+        keep = version == "HTTP/1.1" and\
+                resp_headers.get("connection", "").lower() != "close"
+
+        if status in [ 204, 304 ] or 100 <= status < 200:
+            return (status, resp_headers, b"", keep)
+
+        too_big = Exception("Body over %d bytes" % MAX_BODY)
+
+        if resp_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            total = 0
+            while True:
+                size = await reader.readuntil(b"\r\n")
+                size = int(size.split(b";", 1)[0], 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                        pass
+                    break
+                total += size
+                if total > MAX_BODY:
+                    raise too_big
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in resp_headers:
+            size = int(resp_headers["content-length"])
+            if size > MAX_BODY:
+                raise too_big
+            body = await reader.readexactly(size)
+        else:
+            chunks = []
+            total = 0
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if total > MAX_BODY:
+                    raise too_big
+                chunks.append(chunk)
+            body = b"".join(chunks)
+            keep = False
+
+        return (status, resp_headers, body, keep)
+
+# Download URL through pool, and hand the bytes to feedparser, or to
+# parse_pool's worker processes if given. The result is shaped like
+# feedparser's own URL fetching result so the rest of CantoFetchThread.run
+# can't tell the difference. If stats (a CantoFeedStats) is given, timing and
+# size are recorded in it.
+
+def pool_parse(pool, URL, request_headers, username=None, password=None,
+        parse_pool=None, stats=None):
+    response = pool.get(URL, request_headers, username, password)
+
+    start = time.time()
+
+    if response.status == 304:
+        result = { "bozo" : 0, "entries" : [], "feed" : {} }
+    else:
+        headers = response.headers.copy()
+        headers["content-location"] = response.URL
+        if parse_pool:
+            result = parse_pool.parse(response.body, headers)
+        else:
+            result = feedparser.parse(response.body, response_headers = headers)
+
+    if stats:
+        stats.update(response.timing)
+        stats.update({ "bytes" : len(response.body),
+            "parse" : time.time() - start })
+
+    if response.body:
+        result["skiphours"] = skip_hours_from(response.body)
+
+    result["status"] = response.status
+    result["href"] = response.URL
+    result["headers"] = response.headers
+
+    if "etag" in response.headers:
+        result["etag"] = response.headers["etag"]
+    if "last-modified" in response.headers:
+        result["modified"] = response.headers["last-modified"]
+
+    return result
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Approximate memory accounting for the MEMORY command.
+#
+# deep_size() walks containers (and the attributes of plain objects, like
+# transforms) adding up sys.getsizeof, so it's an estimate: it doesn't know
+# about allocator overhead, and anything shared between two things measured
+# separately is counted in both.
+#
+# Modules that keep caches register them with memory.add_cache() so they show
+# up in the report without the backend having to know about them.
+
+from collections import deque
+from threading import Lock
+
+import types
+import sys
+
+CONTAINERS = (list, tuple, set, frozenset, deque)
+
+OPAQUE = (type, types.ModuleType, types.FunctionType, types.MethodType,
+        types.BuiltinFunctionType)
+
+def deep_size(obj, seen = None):
+    if seen == None:
+        seen = set()
+
+    size = 0
+    stack = [ obj ]
+
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        size += sys.getsizeof(o)
+
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, CONTAINERS):
+            stack.extend(o)
+        elif hasattr(o, "__dict__") and not isinstance(o, OPAQUE):
+            stack.append(o.__dict__)
+
+    return size
+
+class CantoMemory():
+    def __init__(self):
+        self.lock = Lock()
+        self.caches = {}
+
+    # get is called when a report is made, and returns the object(s) that
+    # make up the cache.
+
+    def add_cache(self, name, get):
+        self.lock.acquire()
+        self.caches[name] = get
+        self.lock.release()
+
+    def remove_cache(self, name):
+        self.lock.acquire()
+        if name in self.caches:
+            del self.caches[name]
+        self.lock.release()
+
+    def cache_sizes(self):
+        self.lock.acquire()
+        caches = list(self.caches.items())
+        self.lock.release()
+
+        r = {}
+        for name, get in caches:
+            r[name] = deep_size(get())
+        return r
+
+memory = CantoMemory()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Counters and gauges from across the daemon, published in the Prometheus text
+# format by CantoMetricsServer (metricsserver.py) when canto-daemon is started
+# with --metrics.
+#
+# Counting is disabled (and costs an attribute check) until the server is
+# started. Things that are cheaper to look at than to count (connections, tag
+# sizes, ...) are registered as collectors instead, and only evaluated when
+# the endpoint is scraped.
+
+from .memory import memory
+
+from threading import Lock
+
+import traceback
+import logging
+
+log = logging.getLogger("METRICS")
+
+class CantoMetrics():
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+
+        # name -> (type, help)
+        self.descriptions = {}
+
+        # name -> { labels tuple : value }
+        self.values = {}
+
+        # Functions returning a list of (name, labels dict, value)
+        self.collectors = []
+
+    def describe(self, name, kind, helptext):
+        self.descriptions[name] = (kind, helptext)
+
+    def inc(self, name, value = 1, **labels):
+        if not self.enabled:
+            return
+
+        key = tuple(sorted(labels.items()))
+
+        self.lock.acquire()
+        if name not in self.values:
+            self.values[name] = {}
+        d = self.values[name]
+        d[key] = d.get(key, 0) + value
+        self.lock.release()
+
+    # Summaries are just a pair of counters.
+
+    def observe(self, name, value, **labels):
+        self.inc(name + "_sum", value, **labels)
+        self.inc(name + "_count", 1, **labels)
+
+    def add_collector(self, func):
+        self.collectors.append(func)
+
+    def collect(self):
+        self.lock.acquire()
+        samples = []
+        for name in self.values:
+            for key, value in self.values[name].items():
+                samples.append((name, dict(key), value))
+        self.lock.release()
+
+        for func in self.collectors:
+            try:
+                samples.extend(func())
+            except Exception:
+                log.error("Error in metrics collector:")
+                log.error(traceback.format_exc())
+
+        return samples
+
+    def render(self):
+        by_name = {}
+        for name, labels, value in self.collect():
+            if name not in by_name:
+                by_name[name] = []
+            by_name[name].append((labels, value))
+
+        described = set()
+        lines = []
+
+        for name in sorted(by_name.keys()):
+            base = name
+            for suffix in [ "_sum", "_count" ]:
+                if name.endswith(suffix) and name[:-len(suffix)] in self.descriptions:
+                    base = name[:-len(suffix)]
+
+            if base in self.descriptions and base not in described:
+                kind, helptext = self.descriptions[base]
+                lines.append("# HELP %s %s" % (base, helptext))
+                lines.append("# TYPE %s %s" % (base, kind))
+                described.add(base)
+
+            for labels, value in by_name[name]:
+                if labels:
+                    l = ",".join([ '%s="%s"' % (k, escape_label(labels[k]))\
+                            for k in sorted(labels.keys()) ])
+                    lines.append("%s{%s} %s" % (name, l, format_value(value)))
+                else:
+                    lines.append("%s %s" % (name, format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return ("%s" % value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if type(value) == float:
+        return "%.6f" % value
+    return "%s" % value
+
+metrics = CantoMetrics()
+memory.add_cache("metrics", lambda : metrics.values)
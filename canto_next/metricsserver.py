@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The HTTP side of metrics.py. This is kept separate so that everything that
+# only counts (protocol.py, and so canto-remote) doesn't have to import
+# http.server.
+
+from .metrics import metrics
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Thread
+
+import logging
+import os
+
+log = logging.getLogger("METRICS")
+
+class CantoMetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class CantoMetricsTCPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class CantoMetricsUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    # BaseHTTPRequestHandler expects an (addr, port) client address.
+
+    def get_request(self):
+        request, addr = self.socket.accept()
+        return (request, ("unix", 0))
+
+# Serve metrics on either a port (on interface) or a unix socket path.
+
+class CantoMetricsServer():
+    def __init__(self, spec, interface = "127.0.0.1"):
+        self.path = None
+
+        if spec.isdigit():
+            self.server = CantoMetricsTCPServer((interface, int(spec)),
+                    CantoMetricsHandler)
+            log.info("Serving metrics on %s:%s" % (interface, spec))
+        else:
+            self.path = spec
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.server = CantoMetricsUnixServer(self.path,
+                    CantoMetricsHandler)
+            log.info("Serving metrics on %s" % self.path)
+
+        metrics.enabled = True
+
+        self.thread = Thread(target = self.server.serve_forever,
+                name = "Metrics Server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
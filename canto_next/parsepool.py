@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# feedparser is pure Python, so parsing a large feed in a fetch thread holds
+# the GIL and starves the connection threads answering clients. CantoParsePool
+# moves that work into worker processes. Workers get the raw bytes and return
+# a plain, JSON-clean dict, so the only thing the daemon process pays for is
+# unpickling the result.
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+import multiprocessing
+import feedparser
+import logging
+
+log = logging.getLogger("PARSEPOOL")
+
+# This runs in the worker process. Workers are spawned and import fetch fresh,
+# so keep is the daemon's keep_toplevel, with anything plugins added.
+
+def parse_feed(body, headers, keep):
+    from .fetch import sanitize_update
+
+    result = feedparser.parse(body, response_headers = headers)
+
+    # Exceptions don't survive sanitizing, but we still want to be able to log
+    # why a feed was bozo, so keep the message.
+
+    if "bozo_exception" in result:
+        result["bozo_exception"] = str(result["bozo_exception"])
+
+    return sanitize_update(result, keep = keep)
+
+class CantoParsePool():
+    def __init__(self, processes):
+        self.processes = processes
+        self.executor = None
+        self.lock = Lock()
+
+    # The daemon is heavily threaded, so workers are spawned rather than
+    # forked to avoid inheriting locks held by other threads.
+
+    def _get_executor(self):
+        self.lock.acquire()
+        try:
+            if not self.executor:
+                log.debug("Starting %d parse processes.", self.processes)
+                self.executor = ProcessPoolExecutor(self.processes,
+                        multiprocessing.get_context("spawn"))
+            return self.executor
+        finally:
+            self.lock.release()
+
+    def parse(self, body, headers):
+        from .fetch import keep_toplevel
+
+        executor = self._get_executor()
+        try:
+            return executor.submit(parse_feed, body, headers,
+                    keep_toplevel).result()
+        except BrokenProcessPool:
+            log.error("Parse process died, restarting pool.")
+            self.lock.acquire()
+            if self.executor == executor:
+                self.executor = None
+            self.lock.release()
+
+            # Don't lose this update, just parse it here.
+            return parse_feed(body, headers, keep_toplevel)
+
+    def close(self):
+        self.lock.acquire()
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        self.lock.release()
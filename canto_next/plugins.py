@@ -10,6 +10,7 @@
 import traceback
 import logging
 import sys
+import re
 import os
 
 log = logging.getLogger("PLUGINS")
@@ -28,6 +29,27 @@ def check_program(*args):
     if PROGRAM not in args:
         raise CantoWrongProgramException
 
+# Plugins call check_program() on import to bail out of the wrong program, but
+# importing them at all can be expensive (the sync plugins pull in half of the
+# standard library), and canto-remote shouldn't pay that for daemon plugins. If
+# the check_program call is just string literals, we can skip it unimported.
+
+check_regex = re.compile("^check_program\\(((?:\\s*[\"'][\\w-]+[\"']\\s*,?)+)\\)",
+        re.M)
+
+def plugin_programs(path):
+    try:
+        f = open(path, "r")
+        m = check_regex.search(f.read())
+        f.close()
+    except Exception:
+        return None
+
+    if not m:
+        return None
+
+    return re.findall("[\\w-]+", m.group(1))
+
 def try_plugins(topdir, plugin_default=True, disabled_plugins=[], enabled_plugins=[]):
     p = topdir + "/plugins"
     pinit = p + "/__init__.py"
@@ -67,6 +89,10 @@ def try_plugins(topdir, plugin_default=True, disabled_plugins=[], enabled_plugin
             try:
                 proper = fname[:-3]
 
+                programs = plugin_programs(p + "/" + fname)
+                if programs != None and PROGRAM not in programs:
+                    continue
+
                 if plugin_default:
                     if proper in disabled_plugins:
                         log.info("[plugin] %s - DISABLED" % proper)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# CantoProfiler is a sampling profiler that can be started and stopped in a
+# running daemon. While running, a thread wakes up `rate` times a second and
+# records every other thread's stack. When stopped, the samples are written in
+# collapsed stack format, one line per unique stack:
+#
+#   thread;outer_func (file.py:line);...;inner_func (file.py:line) count
+#
+# Which flamegraph.pl, speedscope, etc. take directly.
+
+from .memory import memory
+
+from threading import Thread, Lock, Event, enumerate as enumerate_threads
+
+import logging
+import time
+import sys
+import os
+
+log = logging.getLogger("PROFILER")
+
+# Samples per second, by default, and at most. Each sample walks every
+# thread's stack with the GIL held, so much faster would only profile itself.
+
+PROFILE_RATE = 100
+MAX_PROFILE_RATE = 1000
+
+def frame_name(code):
+    name = "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+            code.co_firstlineno)
+    return name.replace(";", ":")
+
+# Raises ValueError unless rate is a positive number of samples per second.
+
+def check_rate(rate):
+    try:
+        rate = int(rate)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Bad profile rate: %s" % (rate,))
+
+    if rate <= 0:
+        raise ValueError("Profile rate must be positive: %d" % rate)
+    return min(rate, MAX_PROFILE_RATE)
+
+class CantoProfiler():
+    def __init__(self):
+        self.lock = Lock()
+        self.thread = None
+        self.stopping = Event()
+        self.reset()
+
+    def reset(self):
+        self.stacks = {}
+        self.samples = 0
+        self.rate = PROFILE_RATE
+        self.started = None
+
+    def running(self):
+        return self.thread != None
+
+    # Raises ValueError for a bad rate, see check_rate.
+
+    def start(self, rate = PROFILE_RATE):
+        rate = check_rate(rate)
+
+        self.lock.acquire()
+        try:
+            if self.thread:
+                return False
+
+            self.reset()
+            self.rate = rate
+            self.started = time.time()
+            self.stopping.clear()
+
+            self.thread = Thread(target = self._run, name = "Profiler",
+                    daemon = True)
+            self.thread.start()
+        finally:
+            self.lock.release()
+
+        log.info("Profiling at %dHz", rate)
+        return True
+
+    # Stop sampling and write what we have to path. Returns a summary, or None
+    # if we weren't running.
+
+    def stop(self, path):
+        self.lock.acquire()
+        try:
+            if not self.thread:
+                return None
+
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        finally:
+            self.lock.release()
+
+        f = open(path, "w")
+        for stack, count in sorted(self.stacks.items()):
+            f.write("%s %d\n" % (stack, count))
+        f.close()
+
+        r = self.status()
+        r["path"] = path
+
+        log.info("Wrote %d samples to %s", self.samples, path)
+        return r
+
+    def status(self):
+        r = { "running" : self.running(), "rate" : self.rate,
+                "samples" : self.samples, "stacks" : len(self.stacks) }
+        if self.started:
+            r["started"] = self.started
+        return r
+
+    def sample(self):
+        me = self.thread.ident
+        names = dict([ (t.ident, t.name) for t in enumerate_threads() ])
+
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+
+            stack.append(names.get(ident, str(ident)).replace(";", ":"))
+            key = ";".join(reversed(stack))
+
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+        self.samples += 1
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        while not self.stopping.wait(interval):
+            self.sample()
+
+profiler = CantoProfiler()
+memory.add_cache("profiler", lambda : profiler.stacks)
@@ -7,7 +7,10 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
-from threading import Lock
+from .compact import CompactEncoder, CompactDecoder, LIST
+from .metrics import metrics
+
+from threading import Lock, local
 import logging
 import socket
 import select
@@ -16,12 +19,38 @@ import getopt
 import struct
 import shlex
 import json
+import zlib
 import time
 import sys
 import os
 
 log = logging.getLogger('SOCKET')
 
+# With compression negotiated, messages at least this big are compressed.
+# Smaller ones aren't worth the CPU.
+
+COMPRESS_MIN = 4096
+
+# The biggest message we'll read, before or after decompression, so neither a
+# bogus size nor a small compressed message that inflates to gigabytes can
+# make us buffer it all.
+
+MAX_MESSAGE = 256 * 1024 * 1024
+
+# Size of the last message read, and bytes written, by the current thread. Used
+# to account payload sizes to commands.
+
+io_bytes = local()
+
+metrics.describe("canto_received_messages_total", "counter",
+        "Messages received, by command.")
+metrics.describe("canto_received_bytes_total", "counter",
+        "Bytes received, by command.")
+metrics.describe("canto_sent_messages_total", "counter",
+        "Messages sent, by command.")
+metrics.describe("canto_sent_bytes_total", "counter",
+        "Bytes sent, by command.")
+
 class CantoSocket:
     def __init__(self, socket_name, **kwargs):
 
@@ -52,6 +81,21 @@ class CantoSocket:
         self.write_locks = {}
         self.write_frags = {}
 
+        # Connections that have switched to the compact encoding. Writes use
+        # the encoder once negotiated, reads are decoded by their first byte
+        # (JSON messages always start with '[') so nothing sent before the
+        # switch is misread.
+
+        self.encoders = {}
+        self.decoders = {}
+
+        # Connections with zlib compression negotiated. Compressed messages
+        # have a negative size, and each direction is one zlib stream, so
+        # repeated URLs and keys compress across messages.
+
+        self.compressors = {}
+        self.decompressors = {}
+
         self.connect()
 
     # Handle options common to all servers and clients
@@ -199,13 +243,52 @@ class CantoSocket:
     # Take raw data, return (cmd, args) tuple or None if not enough data.
     def parse(self, conn, data):
         try:
-            cmd, args = eval(repr(json.loads(data)), {}, {})
+            if data[0] == LIST:
+                if conn not in self.decoders:
+                    self.decoders[conn] = CompactDecoder()
+                cmd, args = self.decoders[conn].decode(data)
+            else:
+                cmd, args = json.loads(data.decode())
         except:
             log.error("Failed to parse message: %s" % data)
         else:
-            log.debug("\n\nRead:\n%s", json.dumps((cmd, args), indent=4, sort_keys=True))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("\n\nRead:\n%s", json.dumps((cmd, args), indent=4, sort_keys=True))
+
+            # The daemon agreed to a client's request for the compact
+            # encoding and/or compression, everything we write from here on
+            # can use them.
+
+            if not self.server and cmd == "VERSION" and type(args) == dict:
+                self.set_options(conn, args)
+
             return (cmd, args)
 
+    # Switch conn to the encoding / compression given in options, which looks
+    # like the daemon's VERSION reply.
+
+    def set_options(self, conn, options):
+        wlock = self.write_locks.get(conn)
+        if not wlock:
+            return
+
+        wlock.acquire()
+        self._set_options(conn, options)
+        wlock.release()
+
+    def _set_options(self, conn, options):
+        if options.get("encoding") == "compact":
+            if conn not in self.encoders:
+                self.encoders[conn] = CompactEncoder()
+        elif conn in self.encoders:
+            del self.encoders[conn]
+
+        if options.get("compression") == "zlib":
+            if conn not in self.compressors:
+                self.compressors[conn] = zlib.compressobj(1)
+        elif conn in self.compressors:
+            del self.compressors[conn]
+
     def do_read(self, conn, timeout=None):
         while True:
             to = timeout
@@ -266,6 +349,15 @@ class CantoSocket:
 
             size = struct.unpack('!q', size_bytes)[0]
 
+            compressed = size < 0
+            if compressed:
+                size = -size
+
+            if size > MAX_MESSAGE:
+                log.error("Message too big: %d bytes" % size)
+                log.error("Interpreting as HUP")
+                return select.POLLHUP
+
             while size:
                 try:
                     frag = conn.recv(min((4096, size)))
@@ -286,7 +378,33 @@ class CantoSocket:
                 log.debug("Read POLLIN with no data")
                 return select.POLLHUP
 
-            return self.parse(conn, message.decode())
+            io_bytes.read = len(message) + 8
+
+            if compressed:
+                if conn not in self.decompressors:
+                    self.decompressors[conn] = zlib.decompressobj()
+                decompressor = self.decompressors[conn]
+                try:
+                    message = decompressor.decompress(message, MAX_MESSAGE)
+                except zlib.error as e:
+                    log.error("Failed to decompress message: %s" % e)
+                    log.error("Interpreting as HUP")
+                    return select.POLLHUP
+
+                # Input left over means it would have inflated past the
+                # limit, and the stream can't be resynced, so give up on it.
+
+                if decompressor.unconsumed_tail:
+                    log.error("Decompressed message too big")
+                    log.error("Interpreting as HUP")
+                    return select.POLLHUP
+
+            r = self.parse(conn, message)
+            if r:
+                metrics.inc("canto_received_messages_total", cmd = r[0])
+                metrics.inc("canto_received_bytes_total", io_bytes.read,
+                        cmd = r[0])
+            return r
 
         # Parse POLLHUP last so if we still got POLLIN, any data
         # is still retrieved from the socket.
@@ -301,8 +419,11 @@ class CantoSocket:
     # Writes a (cmd, args) to a single connection, returns:
     # 1) None if the write completed.
     # 2) select.POLLHUP is the connection is dead.
+    #
+    # If options are given, the connection switches to them (see set_options)
+    # after this message is queued, without letting another write in between.
 
-    def do_write(self, conn, cmd, args):
+    def do_write(self, conn, cmd, args, options=None):
 
         # conn could be missing when the connection monitor thread has already
         # cleaned up a connection (i.e. saw it close) before the response
@@ -326,6 +447,10 @@ class CantoSocket:
             wlock.acquire()
 
         r, frag = self._do_write(conn, cmd, args, self.write_frags[conn])
+
+        if options:
+            self._set_options(conn, options)
+
         wlock.release()
 
         if r == select.POLLHUP:
@@ -338,15 +463,32 @@ class CantoSocket:
         return r
 
     def _do_write(self, conn, cmd, args, frag):
-        log.debug("\n\nWrite:\n%s\n", json.dumps((cmd, args), indent=4, sort_keys=True))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("\n\nWrite:\n%s\n", json.dumps((cmd, args), indent=4, sort_keys=True))
 
         tosend = b""
 
         if cmd:
-            message = json.dumps((cmd, args)).encode("UTF-8")
-            size = struct.pack("!q", len(message))
+            encoder = self.encoders.get(conn)
+            if encoder:
+                message = encoder.encode((cmd, args))
+            else:
+                message = json.dumps((cmd, args)).encode("UTF-8")
+
+            compressor = self.compressors.get(conn)
+            if compressor and len(message) >= COMPRESS_MIN:
+                message = compressor.compress(message) +\
+                        compressor.flush(zlib.Z_SYNC_FLUSH)
+                size = struct.pack("!q", -len(message))
+            else:
+                size = struct.pack("!q", len(message))
             tosend = size + message
 
+            io_bytes.written = getattr(io_bytes, "written", 0) + len(tosend)
+
+            metrics.inc("canto_sent_messages_total", cmd = cmd)
+            metrics.inc("canto_sent_bytes_total", len(tosend), cmd = cmd)
+
         if frag:
             tosend = frag + tosend
 
@@ -402,3 +544,7 @@ class CantoSocket:
         del self.read_locks[conn]
         del self.write_locks[conn]
         del self.write_frags[conn]
+        self.encoders.pop(conn, None)
+        self.decoders.pop(conn, None)
+        self.compressors.pop(conn, None)
+        self.decompressors.pop(conn, None)
@@ -11,16 +11,15 @@ from .client import CantoClient
 from .format import escsplit
 from .hooks import call_hook
 
-from xml.sax.saxutils import escape as xml_escape
-import xml.parsers.expat
-import feedparser
 import traceback
-import pprint
 import time
 import sys
 
 import logging
 
+# canto-remote is run a lot (status bars poll it), so feedparser, expat and
+# friends are only imported by the commands that use them.
+
 def assign_to_dict(d, var, val):
     terms = escsplit(var, '.', 0, 0, True)
     cur = d
@@ -124,7 +123,13 @@ class CantoRemote(PluginHandler, CantoClient):
         print("\tlistfeeds - list all subscribed feeds")
         print("\tdelfeed - unsubscribe from a feed")
         print("\tstatus - print item counts")
+        print("\tsearch - find items by title and summary")
+        print("\tmarktag - mark every item in a tag read / unread")
         print("\tforce-update - refetch all feeds")
+        print("\tcompact - prune stored items to configured keep_fields")
+        print("\tfeedstats - print fetch cost of each feed")
+        print("\tprofile - start / stop the daemon's sampling profiler")
+        print("\tmemory - print approximate memory use by feed, tag and cache")
         print("\tconfig - change / query configuration variables")
         print("\tone-config - change / query one configuration variable")
         print("\texport - export feed list as OPML")
@@ -160,6 +165,8 @@ class CantoRemote(PluginHandler, CantoClient):
         return None
 
     def _autoname(self, URL):
+        import feedparser
+
         extra_headers = { 'User-Agent' :\
                 'Canto/0.9.0 + http://codezen.org/canto-ng' }
         try:
@@ -356,6 +363,8 @@ class CantoRemote(PluginHandler, CantoClient):
 
     This will print an OPML file to standard output."""
 
+        from xml.sax.saxutils import escape as xml_escape
+
         print("""<opml version="1.0">""")
         print("""\t<body>""")
         for f in self._get_feeds():
@@ -404,6 +413,8 @@ class CantoRemote(PluginHandler, CantoClient):
 
             feeds.append(f)
 
+        import xml.parsers.expat
+
         parser = xml.parsers.expat.ParserCreate()
         parser.StartElementHandler = parse_opml
         parser.Parse(data.encode("UTF-8"), 1)
@@ -428,6 +439,8 @@ class CantoRemote(PluginHandler, CantoClient):
             lines = f.readlines()
             f.close()
 
+        import pprint
+
         pp = pprint.PrettyPrinter()
 
         for line in lines:
@@ -480,29 +493,232 @@ class CantoRemote(PluginHandler, CantoClient):
 
         self.write("FORCEUPDATE", {})
 
-    def _numstate(self, tag, state):
-        self.write("AUTOATTR", [ "canto-state" ])
-        self.write("ITEMS", [ tag ])
+    def cmd_compact(self):
+        """USAGE: canto-remote compact
 
-        items = []
+    Prune items already stored in the feed database down to the fields set in
+    keep_fields (per feed, or in defaults) and rewrite the database. New items
+    are pruned automatically as they're fetched."""
 
-        cmd, r = self._wait_response(None)
-        while cmd != "ITEMSDONE":
-            if cmd == "ITEMS":
-                items.extend(r[tag])
-            cmd, r = self._wait_response(None)
+        if len(sys.argv) > 1:
+            return False
 
-        if len(items) == 0:
-            return 0
+        self.write("COMPACT", {})
+        r = self._wait_response("COMPACT")
+        if r:
+            print("Removed %d fields from %d feeds." % (r["fields"], r["feeds"]))
 
-        attrs = self._wait_response("ATTRIBUTES")
+    def cmd_feedstats(self):
+        """USAGE: canto-remote feedstats
+
+    Print how long each feed has taken to fetch, averaged over its last few
+    fetches, most expensive first. Times are in milliseconds, sizes in KiB.
+    Size, DNS and connect times are only known with the http-pool plugin."""
+
+        if len(sys.argv) > 1:
+            return False
+
+        self.write("FEEDSTATS", {})
+        r = self._wait_response("FEEDSTATS")
+        if r == None:
+            return
+
+        cols = [ "total", "fetch", "dns", "connect", "parse", "index", "retag" ]
+
+        print("%-30s %5s " % ("feed", "n") +\
+                " ".join([ "%8s" % c for c in cols ]) +\
+                " %8s %6s %6s" % ("KiB", "added", "fail%"))
+
+        feeds = sorted(r.values(), key = lambda f : f["mean"]["total"],
+                reverse = True)
+
+        for f in feeds:
+            mean = f["mean"]
+            line = "%-30s %5d " % (f["name"][:30], f["samples"])
+            line += " ".join([ "%8.1f" % (mean[c] * 1000) if c in mean else\
+                    "%8s" % "-" for c in cols ])
+
+            if "bytes" in mean:
+                line += " %8.1f" % (mean["bytes"] / 1024)
+            else:
+                line += " %8s" % "-"
+
+            line += " %6.1f %6d" % (mean.get("added", 0), mean["failed"] * 100)
+            print(line)
+
+    def cmd_profile(self):
+        """USAGE: canto-remote profile [start (rate)|stop]
+
+    Start sampling the daemon's threads rate times a second (default 100), or
+    stop and write the samples to a profile-*.folded file in the daemon's
+    directory, in collapsed stack format for flamegraph.pl or speedscope.
+    Without arguments, print whether the profiler is running.
+
+    Sending the daemon SIGUSR2 also starts and stops it."""
+
+        if len(sys.argv) > 3:
+            return False
+
+        args = {}
+        if len(sys.argv) > 1:
+            if sys.argv[1] == "start":
+                args["start"] = True
+                if len(sys.argv) > 2:
+                    try:
+                        args["rate"] = int(sys.argv[2])
+                    except:
+                        print("Rate must be an integer")
+                        return False
+            elif sys.argv[1] == "stop" and len(sys.argv) == 2:
+                args["stop"] = True
+            else:
+                return False
+
+        self.write("PROFILE", args)
+        r = self._wait_response("PROFILE")
+        if r == None:
+            return
 
-        if state == "unread":
-            return len([ x for x in items if "read" not in attrs[x]["canto-state"]])
-        elif state == "read":
-            return len([ x for x in items if "read" in attrs[x]["canto-state"]])
+        if "path" in r:
+            print("Wrote %d samples to %s" % (r["samples"], r["path"]))
+        elif r["running"]:
+            print("Profiling at %dHz, %d samples so far" % (r["rate"],
+                r["samples"]))
         else:
-            return len(items)
+            print("Not profiling")
+
+    def cmd_memory(self):
+        """USAGE: canto-remote memory (--all)
+
+    Print the approximate memory used by the daemon for each feed's stored
+    items, each tag, each client connection and each internal cache, largest
+    first, in KiB. Only the 20 largest feeds and tags are shown without
+    --all. If max_items is set, also print how many items are stored and how
+    many have been evicted."""
+
+        if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] != "--all"):
+            return False
+
+        limit = None if "--all" in sys.argv else 20
+
+        self.write("MEMORY", {})
+        r = self._wait_response("MEMORY")
+        if r == None:
+            return
+
+        def section(title, rows):
+            print("%-50s %8s %10s" % (title, "items", "KiB"))
+            rows.sort(key = lambda row : row[2], reverse = True)
+            for name, items, size in rows[:limit]:
+                print("%-50s %8s %10.1f" % (name[:50], items, size / 1024))
+            if limit and len(rows) > limit:
+                print("... %d more" % (len(rows) - limit))
+            print("")
+
+        section("feed", [ (f["name"], f["items"], f["bytes"])\
+                for f in r["feeds"].values() ])
+        section("tag", [ (tag, t["items"], t["bytes"])\
+                for tag, t in r["tags"].items() ])
+        section("connection", [ (fd, "", sum(c.values()))\
+                for fd, c in r["sockets"].items() ])
+        section("cache", [ (name, "", size)\
+                for name, size in r["caches"].items() ])
+
+        print("Total: %.1f KiB" % (r["total"] / 1024))
+
+        if "budget" in r and r["budget"]["max_items"]:
+            print("Items: %d / %d max_items, %d evicted" % (r["budget"]["items"],
+                r["budget"]["max_items"], r["budget"]["evicted"]))
+
+    def cmd_search(self):
+        """USAGE: canto-remote search (--tag tag) (--limit n) [words] ...
+
+    Print the title and link of items with all of the words in their title or
+    summary, newest first.
+
+    --tag can be given (more than once) to only search those tags.
+    --limit can be given to print at most n items."""
+
+        tags = []
+        limit = None
+        words = []
+
+        args = sys.argv[1:]
+        while args:
+            arg = args.pop(0)
+            if arg in [ "--tag", "--limit" ]:
+                if not args:
+                    return False
+                if arg == "--tag":
+                    tags.append(args.pop(0))
+                else:
+                    try:
+                        limit = int(args.pop(0))
+                    except:
+                        print("Limit must be an integer")
+                        return False
+            else:
+                words.append(arg)
+
+        if not words:
+            return False
+
+        self.write("SEARCH", { "query" : " ".join(words), "tags" : tags,
+            "limit" : limit })
+        r = self._wait_response("SEARCH")
+        if not r or not r["items"]:
+            return
+
+        self.write("ATTRIBUTES", dict([ (id, [ "title", "link" ])\
+                for id in r["items"] ]))
+        attrs = self._wait_response("ATTRIBUTES")
+        if attrs == None:
+            return
+
+        for id in r["items"]:
+            print("%s\n\t%s" % (attrs[id]["title"], attrs[id]["link"]))
+
+    def cmd_marktag(self):
+        """USAGE: canto-remote marktag [tag] (state)
+
+    Set state (read, if not given) on every item in tag (i.e.
+    "maintag:Slashdot"), or with a leading - (like -read) unset it, and print
+    how many items changed.
+
+    NOTE: Like status, this only touches items that are in the tag after
+    defaults.global_transform and the tag's transform."""
+
+        if len(sys.argv) not in [ 2, 3 ]:
+            return False
+
+        state = "read"
+        if len(sys.argv) == 3:
+            state = sys.argv[2]
+
+        self.write("MARKTAG", { "tag" : sys.argv[1], "state" : state })
+        r = self._wait_response("MARKTAG")
+        if r == None:
+            return
+
+        print("%d items changed" % r["changed"])
+
+    # Return the tag list and { tag : count } in one round trip.
+
+    def _numstate(self, state):
+        self.write("BATCH", [ [ "LISTTAGS", "" ], [ "COUNTS", [] ] ])
+        r = {}
+        for reply in self._wait_response("BATCH"):
+            r.update(dict(reply))
+
+        key = { "unread" : "unread", "read" : "read", "all" : "total" }[state]
+
+        counts = {}
+        for tag in r["LISTTAGS"]:
+            if tag in r["COUNTS"]:
+                counts[tag] = r["COUNTS"][tag][key]
+            else:
+                counts[tag] = 0
+        return r["LISTTAGS"], counts
 
     def cmd_status(self):
         """USAGE: canto-remote status (--tag=tag) (--read|--total|--tags)
@@ -528,12 +744,11 @@ class CantoRemote(PluginHandler, CantoClient):
         if "--total" in sys.argv:
             state = "all"
 
-        self.write("LISTTAGS","")
-        t = self._wait_response("LISTTAGS")
+        t, counts = self._numstate(state)
 
         if "--tags" in sys.argv:
             for tag in t:
-                print("%s : %s" % (tag, self._numstate(tag, state)))
+                print("%s : %s" % (tag, counts[tag]))
         elif "--tag" in sys.argv:
             if "--tag" == sys.argv[-1]:
                 print("--tag must be followed by a tag name")
@@ -544,9 +759,9 @@ class CantoRemote(PluginHandler, CantoClient):
                 print("Unknown tag %s - use --tags to list known tags" % tag)
                 sys.exit(-1)
 
-            print("%s : %s" % (tag, self._numstate(tag, state)))
+            print("%s : %s" % (tag, counts[tag]))
         else:
-            print("%s" % sum([self._numstate(tag, state) for tag in t if tag.startswith("maintag:")]))
+            print("%s" % sum([ counts[tag] for tag in t if tag.startswith("maintag:") ]))
 
     def cmd_help(self):
         """USAGE: canto-remote help [command]"""
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Expiring old items (keep_time / keep_unread).
+#
+# This used to be done as each feed was indexed, looking at every old item
+# on every fetch, and a feed that wasn't fetched (a long rate, or failing)
+# kept its old items forever. Now each feed keeps a heap of when its items
+# expire (see CantoFeed.expire), and the daemon sweeps all of them on a timer,
+# only looking at items that are actually due, and untagging everything that
+# expired with one round of tag changes.
+
+from .feed import allfeeds
+from .locks import feed_lock, tag_lock
+from .metrics import metrics
+from .tag import alltags
+
+import logging
+import time
+
+log = logging.getLogger("RETENTION")
+
+SWEEP_INTERVAL = 60
+
+metrics.describe("canto_items_expired_total", "counter",
+        "Items discarded for being older than keep_time.")
+
+# Untag items dropped from disk by CantoFeed.expire() or evict(), given as
+# [ (feed, items) ... ], with one round of tag changes. Returns how many were
+# untagged.
+
+def untag_dropped(dropped):
+    count = 0
+
+    feed_lock.acquire_read()
+    tag_lock.acquire_write()
+    try:
+        for feed, items in dropped:
+            count += feed.untag_expired(items)
+        alltags.do_tag_changes()
+    finally:
+        tag_lock.release_write()
+        feed_lock.release_read()
+
+    return count
+
+class CantoRetention():
+    def __init__(self):
+        self.last_sweep = 0
+
+    def needs_sweep(self, now):
+        return now - self.last_sweep >= SWEEP_INTERVAL
+
+    # Returns the number of items expired.
+
+    def sweep(self, now = None):
+        if now == None:
+            now = time.time()
+        self.last_sweep = now
+
+        expired = []
+        for feed in allfeeds.get_feeds():
+            items = feed.expire(now)
+            if items:
+                expired.append((feed, items))
+
+        if not expired:
+            return 0
+
+        count = untag_dropped(expired)
+
+        log.debug("Expired %d items from %d feeds", count, len(expired))
+        metrics.inc("canto_items_expired_total", count)
+        return count
+
+retention = CantoRetention()
@@ -28,6 +28,10 @@ class RWLock(object):
         self.writer_stacks = []
         self.writer_id = 0
 
+        # Total seconds threads have spent waiting to acquire this lock.
+        self.read_wait = 0
+        self.write_wait = 0
+
         alllocks.append(self)
 
     def acquire_read(self, block=True):
@@ -53,9 +57,11 @@ class RWLock(object):
         # Get full lock so writers can keep us from getting a lock we don't
         # already hold.
 
+        start = time.time()
         r = self.lock.acquire(block)
         if not r:
             return r
+        self.read_wait += time.time() - start
 
         # Re-acquire reader_lock so we can manipulate the vars.
 
@@ -88,6 +94,7 @@ class RWLock(object):
         return last
 
     def acquire_write(self, block=True):
+        start = time.time()
         r = self.lock.acquire(block)
 
         if not r:
@@ -110,6 +117,8 @@ class RWLock(object):
                     break
 
             time.sleep(0.1)
+
+        self.write_wait += time.time() - start
         return True
 
     def release_write(self):
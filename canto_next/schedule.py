@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# CantoSchedule decides when a feed is due to be fetched again. The configured
+# rate is the fastest a feed will ever be polled, but feeds that publish
+# rarely, or keep answering with nothing new, are backed off towards
+# rate * MAX_BACKOFF. Publisher hints (Cache-Control, Retry-After, RSS <ttl>
+# and <skipHours>) are honored on top of that.
+#
+# It also tracks failures, so that dead feeds stop taking fetch slots (and
+# socket timeouts) away from healthy ones.
+#
+# The learned state is kept in the feed's shelf entry under "canto-schedule"
+# so it survives restarts.
+
+from email.utils import parsedate_tz, mktime_tz
+
+import calendar
+import logging
+import time
+import re
+
+log = logging.getLogger("SCHEDULE")
+
+# Idle feeds are polled at most every rate * MAX_BACKOFF minutes.
+
+MAX_BACKOFF = 8
+
+# Each consecutive fetch that brings nothing new stretches the interval by
+# this factor.
+
+UNCHANGED_FACTOR = 1.5
+
+# Don't let a single bogus header stop a feed for more than a day.
+
+MAX_HINT = 86400
+
+# Failing feeds are retried after rate, then twice that, and so on, up to
+# MAX_FAILURE_DELAY. After CIRCUIT_THRESHOLD consecutive failures the circuit
+# opens and the feed is only probed every MAX_FAILURE_DELAY until it works.
+
+MAX_FAILURE_DELAY = 86400
+CIRCUIT_THRESHOLD = 5
+
+skiphours_regex = re.compile(b"<skipHours[^>]*>(.*?)</skipHours>", re.S | re.I)
+hour_regex = re.compile(b"<hour[^>]*>\\s*(\\d+)\\s*</hour>", re.I)
+
+# feedparser only remembers the last <hour> of <skipHours>, so fetchers that
+# have the raw document can use this to get all of them.
+
+def skip_hours_from(body):
+    m = skiphours_regex.search(body)
+    if not m:
+        return []
+    return sorted(set([ int(h) for h in hour_regex.findall(m.group(1))\
+            if int(h) < 24 ]))
+
+def entry_timestamp(entry):
+    for key in [ "published_parsed", "updated_parsed" ]:
+        if key in entry and entry[key]:
+            try:
+                return calendar.timegm(tuple(entry[key]))
+            except Exception:
+                pass
+    return None
+
+def parse_seconds(value, now):
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed:
+        return mktime_tz(parsed) - now
+    return None
+
+class CantoSchedule():
+    def __init__(self, feed):
+        self.feed = feed
+        self.loaded = False
+        self.state = {
+                "cadence" : None,
+                "unchanged" : 0,
+                "last_new" : None,
+                "not_before" : 0,
+                "ttl" : None,
+                "skip_hours" : [],
+                "etag" : None,
+                "modified" : None,
+                "failures" : 0,
+                "last_error" : None,
+                "last_failure" : 0,
+        }
+
+    # Pull persisted state out of the feed's shelf entry.
+
+    def load(self, contents):
+        self.loaded = True
+        if "canto-schedule" in contents:
+            self.state.update(contents["canto-schedule"])
+
+    def interval(self):
+        base = self.feed.rate * 60
+        longest = base * MAX_BACKOFF
+        interval = base
+
+        # Poll at roughly twice the publishing rate.
+
+        if self.state["cadence"]:
+            interval = max(interval, min(self.state["cadence"] / 2, longest))
+
+        if self.state["unchanged"]:
+            interval = max(interval, min(base *\
+                    (UNCHANGED_FACTOR ** self.state["unchanged"]), longest))
+
+        if self.state["ttl"]:
+            interval = max(interval, self.state["ttl"])
+
+        return interval
+
+    def failure_delay(self):
+        failures = self.state["failures"]
+        if not failures:
+            return 0
+        if failures >= CIRCUIT_THRESHOLD:
+            return MAX_FAILURE_DELAY
+        return min(self.feed.rate * 60 * (2 ** (failures - 1)), MAX_FAILURE_DELAY)
+
+    def circuit(self):
+        if self.state["failures"] < CIRCUIT_THRESHOLD:
+            return "closed"
+        if time.time() < self.state["last_failure"] + self.failure_delay():
+            return "open"
+        return "half-open"
+
+    def next_update(self, last_update):
+        return max(last_update + self.interval(), self.state["not_before"],
+                self.state["last_failure"] + self.failure_delay())
+
+    def needs_update(self, last_update):
+        now = time.time()
+
+        if now < self.next_update(last_update):
+            return False
+
+        skip = self.state["skip_hours"]
+        if skip and len(skip) < 24 and time.gmtime(now).tm_hour in skip:
+            return False
+
+        return True
+
+    # Headers to make the next fetch conditional.
+
+    def request_headers(self):
+        headers = {}
+        if self.state["etag"]:
+            headers["If-None-Match"] = self.state["etag"]
+        if self.state["modified"]:
+            headers["If-Modified-Since"] = self.state["modified"]
+        return headers
+
+    # Called with the raw feedparser result of a successful fetch.
+
+    def fetched(self, result):
+        now = time.time()
+
+        for key in [ "etag", "modified" ]:
+            if key in result and result[key]:
+                self.state[key] = result[key]
+
+        not_before = 0
+        headers = result.get("headers", {})
+
+        if "retry-after" in headers:
+            s = parse_seconds(headers["retry-after"], now)
+            if s:
+                not_before = now + min(s, MAX_HINT)
+
+        if "cache-control" in headers:
+            for directive in headers["cache-control"].split(","):
+                directive = directive.strip().lower()
+                if directive.startswith("max-age="):
+                    try:
+                        s = int(directive[8:])
+                    except ValueError:
+                        continue
+                    not_before = max(not_before, now + min(s, MAX_HINT))
+
+        self.state["not_before"] = not_before
+
+        # A 304 (or anything else without a feed) says nothing about ttl or
+        # skipHours, so keep what we learned from the last full response.
+
+        if result.get("status", 200) != 200 or not result.get("feed"):
+            return
+
+        feed = result["feed"]
+
+        self.state["ttl"] = None
+        if "ttl" in feed:
+            try:
+                self.state["ttl"] = min(int(feed["ttl"]) * 60, MAX_HINT)
+            except ValueError:
+                pass
+
+        if "skiphours" in result:
+            self.state["skip_hours"] = result["skiphours"]
+        elif "skiphours" in feed and "hour" in feed:
+            try:
+                self.state["skip_hours"] = [ int(feed["hour"]) % 24 ]
+            except ValueError:
+                pass
+        else:
+            self.state["skip_hours"] = []
+
+    def failed(self, error):
+        self.state["failures"] += 1
+        self.state["last_error"] = error
+        self.state["last_failure"] = time.time()
+
+        if self.state["failures"] == CIRCUIT_THRESHOLD:
+            log.info("%s failed %d times, only retrying every %d seconds.",
+                    self.feed.URL, CIRCUIT_THRESHOLD, MAX_FAILURE_DELAY)
+
+        # Failures don't get indexed, so write the state out ourselves.
+
+        self.feed.save_schedule()
+
+    def succeeded(self):
+        if self.state["failures"]:
+            log.info("%s recovered after %d failures.", self.feed.URL,
+                    self.state["failures"])
+
+        self.state["failures"] = 0
+        self.state["last_error"] = None
+        self.state["last_failure"] = 0
+
+    # Called by CantoFeed.index with the entries of a fetch, and how many of
+    # them were new to us.
+
+    def indexed(self, entries, new):
+        now = time.time()
+
+        dated = self._dated(entries, now)
+
+        if new:
+            self.state["unchanged"] = 0
+            if not dated and self.state["last_new"]:
+                self._cadence_sample((now - self.state["last_new"]) / new)
+            self.state["last_new"] = now
+        else:
+            self.state["unchanged"] += 1
+
+        log.debug("%s: cadence %s unchanged %d -> interval %d",
+                self.feed.URL, self.state["cadence"],
+                self.state["unchanged"], self.interval())
+
+    # If items are dated, the cadence is the median gap between the most
+    # recent ones, or the age of the newest if that's longer (i.e. the feed
+    # has gone quiet).
+
+    def _dated(self, entries, now):
+        stamps = [ entry_timestamp(e) for e in entries ]
+        stamps = sorted([ s for s in stamps if s and s <= now ])[-11:]
+
+        if len(stamps) < 2:
+            return False
+
+        gaps = sorted([ b - a for a, b in zip(stamps, stamps[1:]) ])
+        cadence = max(gaps[len(gaps) // 2], now - stamps[-1])
+        self.state["cadence"] = cadence
+        return True
+
+    def _cadence_sample(self, sample):
+        if self.state["cadence"]:
+            self.state["cadence"] = 0.7 * self.state["cadence"] + 0.3 * sample
+        else:
+            self.state["cadence"] = sample
+
+    def report(self, last_update):
+        r = self.state.copy()
+        r["interval"] = self.interval()
+        r["last_update"] = last_update
+        r["next_update"] = self.next_update(last_update)
+        r["circuit"] = self.circuit()
+        return r
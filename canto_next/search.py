@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# An inverted index over item titles and summaries for the SEARCH command.
+#
+# It's kept up to date by CantoFeed._retag, alongside the tags, and like the
+# tags it's protected by tag_lock. Items are only tokenized when they're new
+# or their title / summary changed, so re-indexing a feed that mostly hasn't
+# changed is cheap.
+#
+# We don't keep each item's terms around (that would be most of the memory),
+# so taking an item out of the index means tokenizing the old version of it
+# again, which _retag has anyway.
+
+from .memory import memory
+
+from collections import defaultdict
+import logging
+import heapq
+import re
+
+log = logging.getLogger("SEARCH")
+
+MARKUP = re.compile("<[^>]*>")
+WORD = re.compile("\\w+")
+
+def item_text(item):
+    r = []
+    for key in [ "title", "summary" ]:
+        value = item.get(key, "")
+        if type(value) != str:
+            value = "%s" % value
+        r.append(value)
+    return tuple(r)
+
+def tokenize(text):
+    if "<" in text:
+        text = MARKUP.sub(" ", text)
+    return set(WORD.findall(text.lower()))
+
+def item_terms(text):
+    terms = set()
+    for value in text:
+        terms |= tokenize(value)
+    return terms
+
+class CantoSearch():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # term -> set of item ids
+        self.postings = defaultdict(set)
+
+        # item id -> (canto_update, id, hash of item_text), which sorts by
+        # recency. canto_update is bumped every time an item is seen in a
+        # fetch, but this is from when it was indexed, so results are ordered
+        # by when items were first seen (or changed).
+        self.docs = {}
+
+        # feed URL -> set of item ids
+        self.feeds = {}
+
+    def _index(self, url, id, item, text):
+        self.docs[id] = (item.get("canto_update", 0), id, hash(text))
+
+        postings = self.postings
+        for term in item_terms(text):
+            postings[term].add(id)
+
+        if url in self.feeds:
+            self.feeds[url].add(id)
+        else:
+            self.feeds[url] = set([ id ])
+
+    def _unindex(self, url, id, old_item):
+        doc = self.docs.pop(id, None)
+        if not doc:
+            return
+
+        if url in self.feeds:
+            self.feeds[url].discard(id)
+
+        if old_item != None:
+            text = item_text(old_item)
+            if hash(text) == doc[2]:
+                terms = item_terms(text)
+            else:
+                old_item = None
+
+        # Don't know what it was indexed as, have to look everywhere.
+
+        if old_item == None:
+            log.debug("Unindexing %s without its old content", id)
+            terms = list(self.postings.keys())
+
+        for term in terms:
+            ids = self.postings.get(term)
+            if ids == None:
+                continue
+            ids.discard(id)
+            if not ids:
+                del self.postings[term]
+
+    # old and new are { id : item } for a feed's items before and after an
+    # index, or any other change to its items.
+
+    def update(self, url, old, new):
+        for id, item in new.items():
+            text = item_text(item)
+            doc = self.docs.get(id)
+
+            if doc:
+                if doc[2] == hash(text):
+                    continue
+                self._unindex(url, id, old.get(id))
+
+            self._index(url, id, item, text)
+
+        for id, item in old.items():
+            if id not in new:
+                self._unindex(url, id, item)
+
+    def remove_feed(self, url):
+        ids = self.feeds.pop(url, set())
+        if not ids:
+            return
+
+        for id in ids:
+            self.docs.pop(id, None)
+
+        for term in list(self.postings.keys()):
+            self.postings[term] -= ids
+            if not self.postings[term]:
+                del self.postings[term]
+
+    # Return ids of items matching every term in query, newest first. If scope
+    # is given, it's a set of ids the results have to be in.
+
+    def search(self, query, scope = None, limit = None):
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        sets = []
+        for term in terms:
+            if term not in self.postings:
+                return []
+            sets.append(self.postings[term])
+
+        sets.sort(key=len)
+        if scope != None:
+            sets.insert(1, scope)
+
+        ids = sets[0]
+        for s in sets[1:]:
+            ids = ids & s
+            if not ids:
+                return []
+
+        if limit:
+            return heapq.nlargest(limit, ids, key=self.docs.__getitem__)
+        return sorted(ids, key=self.docs.__getitem__, reverse=True)
+
+search = CantoSearch()
+memory.add_cache("search", lambda : (search.postings, search.docs))
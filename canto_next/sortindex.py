@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2016 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Sort keys for the sorting transforms (sort_alphabetical, sort_date, ...).
+#
+# Like the search index, this is kept up to date by CantoFeed._retag, under
+# tag_lock. Each item's keys are computed when it's indexed, and each feed's
+# items are kept as a run of (key, id) sorted on first use after they change,
+# which is rarely, because state changes don't touch any keys.
+#
+# Everything that reads the index has to hold tag_lock, at least for reading.
+# That includes building runs: the keys can't change while it's held, so
+# readers racing to build the same run all build the same thing.
+#
+# Sorting a tag is then picking its items out of each feed's run and merging
+# the runs, instead of fetching every item's attributes from disk and sorting
+# the whole tag every time it changes.
+
+from .memory import memory
+
+from itertools import chain
+
+import calendar
+import logging
+import heapq
+
+log = logging.getLogger("SORTINDEX")
+
+def title_key(item):
+    title = item.get("title", "")
+    if type(title) != str:
+        title = "%s" % title
+    return title
+
+# Newest first, from the item's own date, or when we first saw it.
+
+def date_key(item):
+    for attr in [ "published_parsed", "updated_parsed" ]:
+        if item.get(attr):
+            try:
+                return -calendar.timegm(tuple(item[attr]))
+            except Exception:
+                pass
+    return -item.get("canto_update", 0)
+
+SORT_KEYS = { "title" : title_key, "date" : date_key }
+
+# If a tag is only a small part of the feeds it's in (like a user tag), it's
+# cheaper to just sort it than to go through every run.
+
+RUN_RATIO = 4
+
+class CantoSortIndex():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # key name -> { item id : key }
+        self.keys = {}
+        for name in SORT_KEYS:
+            self.keys[name] = {}
+
+        # item id -> feed URL, feed URL -> set of item ids
+        self.urls = {}
+        self.feeds = {}
+
+        # (key name, feed URL) -> sorted [ (key, item id) ... ]
+        self.runs = {}
+
+    def _dirty(self, name, url):
+        self.runs.pop((name, url), None)
+
+    def _remove(self, url, id):
+        for name in SORT_KEYS:
+            if self.keys[name].pop(id, None) != None:
+                self._dirty(name, url)
+        self.urls.pop(id, None)
+        if url in self.feeds:
+            self.feeds[url].discard(id)
+
+    # old and new are { id : item }, the same as CantoSearch.update()
+
+    def update(self, url, old, new):
+        for id in old:
+            if id not in new:
+                self._remove(url, id)
+
+        if new and url not in self.feeds:
+            self.feeds[url] = set()
+        ids = self.feeds.get(url)
+
+        for id, item in new.items():
+            for name, func in SORT_KEYS.items():
+                key = func(item)
+                keys = self.keys[name]
+                if id not in keys or keys[id] != key:
+                    keys[id] = key
+                    self._dirty(name, url)
+            self.urls[id] = url
+            ids.add(id)
+
+    def remove_feed(self, url):
+        for id in list(self.feeds.get(url, [])):
+            self._remove(url, id)
+        self.feeds.pop(url, None)
+
+    def run(self, name, url):
+        r = self.runs.get((name, url))
+        if r == None:
+            keys = self.keys[name]
+            r = [ (keys[id], id) for id in self.feeds.get(url, []) ]
+            r.sort()
+            self.runs[(name, url)] = r
+        return r
+
+    # Return { feed URL : run } with just the given items in each run, and a
+    # list of any items we don't know about. With lazy, runs may be generators
+    # that pick the items out of the whole run as they're consumed.
+
+    def runs_for(self, name, items, lazy = False):
+        by_url = {}
+        unknown = []
+        for id in items:
+            url = self.urls.get(id)
+            if url == None:
+                unknown.append(id)
+            elif url in by_url:
+                by_url[url].append(id)
+            else:
+                by_url[url] = [ id ]
+
+        keys = self.keys[name]
+        runs = {}
+
+        for url, ids in by_url.items():
+            total = len(self.feeds[url])
+            if len(ids) == total:
+                runs[url] = self.run(name, url)
+            elif len(ids) * RUN_RATIO < total:
+                r = [ (keys[id], id) for id in ids ]
+                r.sort()
+                runs[url] = r
+            elif lazy:
+                wanted = set(ids)
+                runs[url] = ( x for x in self.run(name, url) if x[1] in wanted )
+            else:
+                wanted = set(ids)
+                runs[url] = [ x for x in self.run(name, url) if x[1] in wanted ]
+
+        return runs, unknown
+
+    # Sort items by key. Items we don't know about go last, in the order they
+    # were given.
+
+    def sort(self, name, items):
+        runs, unknown = self.runs_for(name, items)
+        runs = list(runs.values())
+
+        if len(runs) == 1:
+            r = runs[0]
+        else:
+            r = heapq.merge(*runs)
+        return [ x[1] for x in r ] + unknown
+
+    # Group items by feed, in the given order of feed URLs, and sort them by
+    # key within each feed.
+
+    def sort_by_feed(self, name, items, order):
+        runs, unknown = self.runs_for(name, items)
+
+        r = []
+        for url in order:
+            if url in runs:
+                r.extend([ x[1] for x in runs.pop(url) ])
+
+        # Feeds that aren't in the order anymore.
+
+        for url in sorted(runs.keys()):
+            r.extend([ x[1] for x in runs[url] ])
+
+        return r + unknown
+
+    # Like sort() and sort_by_feed(), but items are only merged as they're
+    # asked for, so taking the first N is O(N log feeds) after splitting the
+    # items by feed.
+
+    def iter_sort(self, name, items):
+        runs, unknown = self.runs_for(name, items, True)
+        merged = heapq.merge(*runs.values())
+        return chain(( x[1] for x in merged ), unknown)
+
+    def iter_sort_by_feed(self, name, items, order):
+        runs, unknown = self.runs_for(name, items, True)
+
+        ordered = [ runs.pop(url) for url in order if url in runs ]
+        ordered += [ runs[url] for url in sorted(runs.keys()) ]
+        return chain(( x[1] for x in chain(*ordered) ), unknown)
+
+sortindex = CantoSortIndex()
+memory.add_cache("sortindex", lambda : (sortindex.keys, sortindex.runs))
@@ -9,6 +9,7 @@
 
 from .feed import wlock_feeds
 from .hooks import call_hook
+from .metrics import metrics
 
 import tempfile
 import logging
@@ -20,6 +21,9 @@ import os
 
 log = logging.getLogger("SHELF")
 
+metrics.describe("canto_shelf_sync_seconds", "summary",
+        "Time spent writing the feed database to disk.")
+
 class CantoShelf():
     def __init__(self, filename):
         self.filename = filename
@@ -113,6 +117,8 @@ class CantoShelf():
         if self.cache == {}:
             return
 
+        start = time.time()
+
         f, tmpname = tempfile.mkstemp("", "feeds", os.path.dirname(self.filename))
         os.close(f)
 
@@ -124,6 +130,8 @@ class CantoShelf():
 
         shutil.move(tmpname, self.filename)
 
+        metrics.observe("canto_shelf_sync_seconds", time.time() - start)
+
         log.debug("Synced.")
 
     def close(self):
@@ -28,17 +28,37 @@ class CantoTags():
 
         self.extra_tags = {}
 
+        # Ids of read items, and how many of each (transformed) tag's items are
+        # read, so that COUNTS doesn't have to look at every item. The counts
+        # are redone for each changed tag in do_tag_changes.
+
+        self.read = set()
+        self.read_counts = {}
+
+        # Sets of each tag's items, built as needed for membership tests (like
+        # SEARCH scoping) and thrown out when the tag changes. None is the set
+        # of items in any tag. Like the tags, these are built with tag_lock
+        # held, but reading is enough.
+
+        self.tag_sets = {}
+
+        # Item id -> set of tags it's in, so finding or removing an item's tags
+        # doesn't mean searching every tag.
+
+        self.item_tags = {}
+
     def items_to_tags(self, ids):
-        tags = []
+        tags = set()
         for id in ids:
-            for tag in self.tags:
-                if id in self.tags[tag] and tag not in tags:
-                    tags.append(tag)
-        return tags
+            if id in self.item_tags:
+                tags |= self.item_tags[id]
+        return [ tag for tag in self.tags if tag in tags ]
 
     def tag_changed(self, tag):
         if tag not in self.changed_tags:
             self.changed_tags.append(tag)
+        self.tag_sets.pop(tag, None)
+        self.tag_sets.pop(None, None)
 
     def get_tag(self, tag):
         if tag in list(self.tags.keys()):
@@ -48,14 +68,41 @@ class CantoTags():
     def get_tags(self):
         return list(self.tags.keys())
 
+    def get_tag_set(self, tag):
+        if tag not in self.tag_sets:
+            if tag == None:
+                self.tag_sets[None] = set().union(*[ self.get_tag_set(t)\
+                        for t in self.get_tags() ])
+            else:
+                self.tag_sets[tag] = set(self.get_tag(tag))
+        return self.tag_sets[tag]
+
+    # Set of the items in any of tags, or in any tag at all if tags is empty.
+
+    def get_tags_set(self, tags):
+        if not tags:
+            return self.get_tag_set(None)
+        if len(tags) == 1:
+            return self.get_tag_set(tags[0])
+        return set().union(*[ self.get_tag_set(tag) for tag in tags ])
+
     def tag_transform(self, tag, transform):
         self.tag_transforms[tag] = transform
 
     def set_extra_tags(self, tag, extra_tags):
         self.extra_tags[tag] = extra_tags
 
+    def get_counts(self, tag):
+        total = len(self.get_tag(tag))
+        read = self.read_counts.get(tag, 0)
+        return { "unread" : total - read, "read" : read, "total" : total }
+
     def clear_tags(self):
         self.tags = {}
+        self.read = set()
+        self.read_counts = {}
+        self.tag_sets = {}
+        self.item_tags = {}
 
     def reset(self):
         self.tag_transforms = {}
@@ -80,6 +127,11 @@ class CantoTags():
 
         alladded = [ name ] + extras
 
+        if id in self.item_tags:
+            item_tags = self.item_tags[id]
+        else:
+            item_tags = self.item_tags[id] = set()
+
         for name in alladded:
             # Create tag if no tag exists
             if name not in self.tags:
@@ -87,20 +139,57 @@ class CantoTags():
                 call_hook("daemon_new_tag", [[ name ]])
 
             # Add to tag.
-            if id not in self.tags[name]:
+            if name not in item_tags:
+                item_tags.add(name)
                 self.tags[name].append(id)
                 self.tag_changed(name)
 
     def remove_tag(self, id, name):
-        if name in self.tags and id in self.tags[name]:
+        if name in self.item_tags.get(id, ()):
             self.tags[name].remove(id)
+            self._untag(id, name)
             self.tag_changed(name)
 
+    def _untag(self, id, name):
+        self.item_tags[id].discard(name)
+        if not self.item_tags[id]:
+            del self.item_tags[id]
+
+    def set_read(self, id, read):
+        if read:
+            self.read.add(id)
+        else:
+            self.read.discard(id)
+
     def remove_id(self, id):
-        for tag in self.tags:
-            if id in self.tags[tag]:
-                self.tags[tag].remove(id)
-                self.tag_changed(tag)
+        self.remove_ids([ id ])
+
+    # Each tag is only rebuilt once, however many of its items are removed.
+
+    def remove_ids(self, ids):
+        removed = {}
+        for id in ids:
+            self.read.discard(id)
+            for tag in self.item_tags.pop(id, ()):
+                if tag in removed:
+                    removed[tag].add(id)
+                else:
+                    removed[tag] = set([ id ])
+
+        for tag, tag_ids in removed.items():
+            if len(tag_ids) == 1:
+                self.tags[tag].remove(tag_ids.pop())
+            else:
+                self.tags[tag] = [ id for id in self.tags[tag]\
+                        if id not in tag_ids ]
+            self.tag_changed(tag)
+
+    # Mark every tag an item is in as changed, for when only its attributes
+    # have.
+
+    def item_changed(self, id):
+        for tag in self.item_tags.get(id, ()):
+            self.tag_changed(tag)
 
     def apply_transforms(self, tag, tagobj):
         from .config import config
@@ -117,14 +206,26 @@ class CantoTags():
 
     def do_tag_changes(self):
         for tag in self.changed_tags:
-            tagobj = self.get_tag(tag)
+            before = self.get_tag(tag)
 
             try:
-                tagobj = self.apply_transforms(tag, tagobj)
+                tagobj = self.apply_transforms(tag, before)
             except Exception as e:
                 log.error("Exception applying transforms: %s" % e)
+                tagobj = before
+
+            # Transforms can drop items from the tag (like filter_read).
+
+            if len(tagobj) != len(before):
+                kept = set(tagobj)
+                for id in before:
+                    if id not in kept:
+                        self._untag(id, tag)
 
             self.tags[tag] = tagobj
+            self.tag_sets.pop(tag, None)
+            self.tag_sets.pop(None, None)
+            self.read_counts[tag] = len([ i for i in tagobj if i in self.read ])
             call_hook("daemon_tag_change", [ tag ])
         self.changed_tags = []
 
@@ -6,7 +6,8 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
-from .feed import allfeeds
+from .sortindex import sortindex
+from .feed import allfeeds, dict_id
 from .tag import alltags
 
 import logging
@@ -23,6 +24,10 @@ transform_locals = { }
 # elements returned by a class' `needed_attributes()`, populates a dict of
 # these elements from cache/disk, and then gives them to the `transform()` call.
 
+# Filters that decide on each item by itself can also define `keep(item,
+# attrs)`, which lets AllTransform stop early when it's followed by an
+# ItemLimit.
+
 class CantoTransform():
     def __init__(self, name):
         self.name = name
@@ -33,22 +38,14 @@ class CantoTransform():
     # This is called with the feeds already read locked.
 
     def __call__(self, tag):
-        a = {}
-        f = allfeeds.items_to_feeds(tag)
         needed = self.needed_attributes(tag)
 
-        for feed in f:
-            attrs = {}
-            for i in f[feed]:
-                attrs[i] = needed
-            a.update(feed.get_attributes(f[feed], attrs))
+        # Nothing to read from disk.
 
-        for item in tag[:]:
-            if item not in a.keys():
-                log.warn("Missing attributes for %s" % item)
-                tag.remove(item)
+        if not needed:
+            return self.transform(tag, dict.fromkeys(tag, {}))
 
-        return self.transform(tag, a)
+        return self.transform(tag, LazyAttributes(tag, needed))
 
     def needed_attributes(self, tag):
         return []
@@ -56,6 +53,95 @@ class CantoTransform():
     def transform(self, items, attrs):
         return items
 
+# The attributes dict given to transform(). Attributes are read from disk a
+# feed at a time, the first time one of the feed's items is looked up, so a
+# transform that stops early doesn't read every feed in the tag. Membership
+# doesn't need the disk, anything that goes through every item (keys(),
+# iterating, ...) reads the rest first.
+
+class LazyAttributes(dict):
+    def __init__(self, items, needed):
+        dict.__init__(self)
+        self._ids = items
+        self._id_set = None
+        self.needed = needed
+        self.by_url = None
+
+    def _url(self, item):
+        url = sortindex.urls.get(item)
+        if url == None:
+            url = dict_id(item)["URL"]
+        return url
+
+    def _split(self):
+        if self.by_url == None:
+            self.by_url = {}
+            for i in self._ids:
+                url = self._url(i)
+                if url in self.by_url:
+                    self.by_url[url].append(i)
+                else:
+                    self.by_url[url] = [ i ]
+
+    def _load(self, url, ids):
+        if url not in allfeeds.feeds:
+            raise Exception("Can't find feed: %s" % url)
+        feed = allfeeds.feeds[url]
+        self.update(feed.get_attributes(ids, dict.fromkeys(ids, self.needed)))
+
+    def _load_all(self):
+        self._split()
+        while self.by_url:
+            url, ids = self.by_url.popitem()
+            self._load(url, ids)
+
+    def __missing__(self, item):
+        self._split()
+
+        url = self._url(item)
+        ids = self.by_url.pop(url, [])
+        if item not in ids:
+            ids.append(item)
+
+        self._load(url, ids)
+        return dict.__getitem__(self, item)
+
+    def __contains__(self, item):
+        if dict.__contains__(self, item):
+            return True
+        if self._id_set == None:
+            self._id_set = set(self._ids)
+        return item in self._id_set
+
+    def get(self, item, default = None):
+        if item in self:
+            return self[item]
+        return default
+
+    def __len__(self):
+        self._load_all()
+        return dict.__len__(self)
+
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def copy(self):
+        self._load_all()
+        return dict(dict.items(self))
+
 # A StateFilter will filter out items that match a particular state. Supports
 # using "-tag" to indicate to filter out those missing the tag.
 
@@ -64,19 +150,69 @@ class StateFilter(CantoTransform):
         CantoTransform.__init__(self, "Filter state: %s" % state)
         self.state = state
 
+        if self.state[0] == "-":
+            self.want = self.state[1:]
+            self.has = True
+        else:
+            self.want = self.state
+            self.has = False
+
+    # Read state is tracked by alltags, so it doesn't need the disk.
+
     def needed_attributes(self, tag):
+        if self.want == "read":
+            return []
         return ["canto-state"]
 
+    def keep(self, item, attrs):
+        if self.want == "read":
+            return (item in alltags.read) == self.has
+        return (self.want in attrs[item]["canto-state"]) == self.has
+
     def transform(self, items, attrs):
-        if self.state[0] == "-":
-            state = self.state[1:]
-            keep = True
-        else:
-            state = self.state
-            keep = False
+        if self.want == "read":
+            read = alltags.read
+            return [ i for i in items if (i in read) == self.has ]
 
         return [ i for i in items if \
-                (state in attrs[i]["canto-state"]) == keep]
+                (self.want in attrs[i]["canto-state"]) == self.has ]
+
+# Most content filters are just looking for a string, which a substring search
+# does much faster than the regex engine backtracking through a long summary.
+# Return the literal a "match anywhere" regex (like ContentFilter's) is
+# looking for, or None if it's anything more complicated.
+
+REGEX_SPECIAL = ".^$*+?{}[]\\|()"
+
+def regex_literal(regex):
+    if len(regex) < 4 or not regex.startswith(".*") or\
+            not regex.endswith(".*"):
+        return None
+
+    r = ""
+    escaped = False
+    for c in regex[2:-2]:
+        if escaped:
+            # \d, \1, etc. aren't literals.
+            if c.isalnum():
+                return None
+            r += c
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in REGEX_SPECIAL:
+            return None
+        else:
+            r += c
+
+    if escaped:
+        return None
+    return r
+
+# Regex results are cached by content, since the same items are filtered over
+# and over as their tags change. The cache is just dropped when it fills.
+
+MATCH_CACHE_SIZE = 50000
 
 # Filter out items whose [attribute] content matches an arbitrary regex.
 
@@ -84,35 +220,55 @@ class ContentFilterRegex(CantoTransform):
     def __init__(self, attribute, regex):
         CantoTransform.__init__(self, "Filter %s in %s" % (attribute, regex))
         self.attribute = attribute
+        self.literal = None
+        self.cache = {}
         try:
             self.match = re.compile(regex)
         except:
             self.match = None
             log.error("Couldn't compile regex: %s" % regex)
+        else:
+            self.literal = regex_literal(regex)
 
     def needed_attributes(self, tag):
         if not self.match:
             return []
         return [ self.attribute ]
 
-    def transform(self, items, attrs):
-        if not self.match:
-            return items
+    def matches(self, value):
+        if self.literal != None:
+            # Same as re.match(".*literal.*"), where "." doesn't match a
+            # newline, so the literal has to start on the first line.
 
-        r = []
-        for item in items:
-            a = attrs[item]
-            if self.attribute not in a:
-                r.append(item)
-                continue
-            if type(a[self.attribute]) != str:
-                log.error("Can't match non-string!")
-                continue
+            i = value.find(self.literal)
+            return i >= 0 and value.find("\n", 0, i) < 0
 
-            if not self.match.match(a[self.attribute]):
-                r.append(item)
+        if not self.match:
+            return False
+
+        r = self.cache.get(value)
+        if r == None:
+            if len(self.cache) >= MATCH_CACHE_SIZE:
+                self.cache = {}
+            r = self.cache[value] = bool(self.match.match(value))
         return r
 
+    def keep(self, item, attrs):
+        a = attrs[item]
+        if self.attribute not in a:
+            return True
+
+        value = a[self.attribute]
+        if type(value) != str:
+            log.error("Can't match non-string!")
+            return False
+        return not self.matches(value)
+
+    def transform(self, items, attrs):
+        if not self.match:
+            return items
+        return content_filter_pass([ self ], items, attrs)[0]
+
 # Simple basic-string abstraction of the above.
 
 class ContentFilter(ContentFilterRegex):
@@ -120,6 +276,62 @@ class ContentFilter(ContentFilterRegex):
         string = ".*" + re.escape(string) + ".*"
         ContentFilterRegex.__init__(self, attribute, string)
 
+# Run several content filters on the same attribute in one pass over the
+# items, looking each value up once, and return what each of them would have
+# kept.
+
+def content_filter_pass(filters, items, attrs):
+    attribute = filters[0].attribute
+    kept = [ [] for f in filters ]
+
+    for item in items:
+        a = attrs[item]
+        if attribute not in a:
+            for k in kept:
+                k.append(item)
+            continue
+
+        value = a[attribute]
+        if type(value) != str:
+            log.error("Can't match non-string!")
+            continue
+
+        for f, k in zip(filters, kept):
+            if not f.matches(value):
+                k.append(item)
+
+    return kept
+
+# Content filters in a row on the same attribute, run by AllTransform as one
+# step that stops at the first match.
+
+class FusedContentFilter(CantoTransform):
+    def __init__(self, filters):
+        CantoTransform.__init__(self, " AND ".join([ f.name for f in filters ]))
+        self.filters = filters
+        self.attribute = filters[0].attribute
+
+    def keep(self, item, attrs):
+        a = attrs[item]
+        if self.attribute not in a:
+            return True
+
+        value = a[self.attribute]
+        if type(value) != str:
+            log.error("Can't match non-string!")
+            return False
+
+        for f in self.filters:
+            if f.matches(value):
+                return False
+        return True
+
+    def transform(self, items, attrs):
+        return [ item for item in items if self.keep(item, attrs) ]
+
+def is_content_filter(t):
+    return isinstance(t, ContentFilterRegex) and t.match
+
 class SortTransform(CantoTransform):
     def __init__(self, name, attr):
         CantoTransform.__init__(self, name)
@@ -133,6 +345,26 @@ class SortTransform(CantoTransform):
         r.sort()
         return [ item[1] for item in r ]
 
+# Sorts using the sort index (sortindex.py), so they don't need any attributes
+# from disk. With by_feed, items are grouped by feed, in config order, and
+# sorted by key within each feed.
+
+class IndexedSortTransform(CantoTransform):
+    def __init__(self, name, key, by_feed = False):
+        CantoTransform.__init__(self, name)
+        self.key = key
+        self.by_feed = by_feed
+
+    def transform(self, items, attrs):
+        if self.by_feed:
+            return sortindex.sort_by_feed(self.key, items, allfeeds.order)
+        return sortindex.sort(self.key, items)
+
+    def iter_sorted(self, items):
+        if self.by_feed:
+            return sortindex.iter_sort_by_feed(self.key, items, allfeeds.order)
+        return sortindex.iter_sort(self.key, items)
+
 # Meta-filter for AND
 class AllTransform(CantoTransform):
     def __init__(self, *args):
@@ -149,6 +381,45 @@ class AllTransform(CantoTransform):
         CantoTransform.__init__(self, name)
         self.transforms = args
 
+        # Filters don't care what order they're run in, but anything else
+        # (like ItemLimit) does, so only fuse content filters that are next
+        # to each other.
+
+        self.steps = []
+        for t in args:
+            last = self.steps[-1] if self.steps else None
+            if is_content_filter(t) and (is_content_filter(last) or\
+                    isinstance(last, FusedContentFilter)) and\
+                    last.attribute == t.attribute:
+                if isinstance(last, FusedContentFilter):
+                    last.filters.append(t)
+                else:
+                    self.steps[-1] = FusedContentFilter([ last, t ])
+            else:
+                self.steps.append(t)
+
+        # A chain of filters and at most one indexed sort, ending in an
+        # ItemLimit, can be run an item at a time, in sorted order, until the
+        # limit is reached. Filters don't change the order, so they can run
+        # after the sort no matter where they are in the chain.
+
+        self.limit = None
+        self.sort = None
+        self.filters = []
+
+        if len(self.steps) > 1 and isinstance(self.steps[-1], ItemLimit) and\
+                self.steps[-1].limit > 0:
+            for t in self.steps[:-1]:
+                if isinstance(t, IndexedSortTransform) and not self.sort:
+                    self.sort = t
+                elif hasattr(t, "keep") and\
+                        (not isinstance(t, ContentFilterRegex) or t.match):
+                    self.filters.append(t)
+                else:
+                    break
+            else:
+                self.limit = self.steps[-1].limit
+
     def needed_attributes(self, tag):
         needed = []
         for t in self.transforms:
@@ -157,9 +428,29 @@ class AllTransform(CantoTransform):
                     needed.append(a)
         return needed
 
+    def limited(self, items, attrs):
+        if self.sort:
+            items = self.sort.iter_sorted(items)
+
+        keeps = [ f.keep for f in self.filters ]
+        r = []
+
+        for item in items:
+            for keep in keeps:
+                if not keep(item, attrs):
+                    break
+            else:
+                r.append(item)
+                if len(r) == self.limit:
+                    break
+        return r
+
     def transform(self, items, attrs):
+        if self.limit:
+            return self.limited(items, attrs)
+
         good_items = items[:]
-        for t in self.transforms:
+        for t in self.steps:
             good_items = t.transform(good_items, attrs)
             if not good_items:
                 break
@@ -179,6 +470,15 @@ class AnyTransform(CantoTransform):
         CantoTransform.__init__(self, name)
         self.transforms = args
 
+        # Content filters on the same attribute, by attribute.
+
+        self.fused = {}
+        for t in args:
+            if is_content_filter(t):
+                if t.attribute not in self.fused:
+                    self.fused[t.attribute] = []
+                self.fused[t.attribute].append(t)
+
     def needed_attributes(self, tag):
         needed = []
         for t in self.transforms:
@@ -188,15 +488,26 @@ class AnyTransform(CantoTransform):
         return needed
 
     def transform(self, items, attrs):
-        good_items = []
-        per_transform = []
+        results = {}
+        for filters in self.fused.values():
+            if len(filters) > 1:
+                kept = content_filter_pass(filters, items, attrs)
+                for f, k in zip(filters, kept):
+                    results[id(f)] = k
 
+        per_transform = []
         for t in self.transforms:
-            per_transform.append(t.transform(items, attrs))
+            if id(t) in results:
+                per_transform.append(results[id(t)])
+            else:
+                per_transform.append(t.transform(items, attrs))
 
+        good_items = []
+        seen = set()
         for pt in per_transform:
             for item in pt:
-                if item not in good_items:
+                if item not in seen:
+                    seen.add(item)
                     good_items.append(item)
         return good_items
 
@@ -210,16 +521,14 @@ class InTags(CantoTransform):
     def needed_attributes(self, tag):
         return []
 
-    def transform(self, items, attrs):
-        good = []
+    def keep(self, item, attrs):
+        for tag in self.tags:
+            if item in alltags.get_tag_set(tag):
+                return True
+        return False
 
-        for item in items:
-            for itag in alltags.items_to_tags([item]):
-                if itag in self.tags:
-                    good.append(item)
-                    break
-
-        return good
+    def transform(self, items, attrs):
+        return [ item for item in items if self.keep(item, attrs) ]
 
 class ItemLimit(CantoTransform):
     def __init__(self, num):
@@ -253,7 +562,10 @@ transform_locals["ItemLimit"] = ItemLimit
 
 transform_locals["filter_read"] = StateFilter("read")
 transform_locals["sort_alphabetical"] =\
-        SortTransform("Sort Alphabetical", "title")
+        IndexedSortTransform("Sort Alphabetical", "title")
+transform_locals["sort_date"] = IndexedSortTransform("Sort by Date", "date")
+transform_locals["sort_feed"] =\
+        IndexedSortTransform("Sort by Feed", "date", True)
 
 # So now lines line `global_transform = ContentFilter('title', 'AMA')` can be
 # simply, safely, parsed with the Python interpreter. As well as supporting the
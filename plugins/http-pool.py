@@ -0,0 +1,82 @@
+# Canto HTTP Pool Plugin
+# by Jack Miller
+# v1.0
+
+# With this plugin, feeds are downloaded through a shared asyncio engine that
+# keeps persistent HTTP/1.1 connections open per host, instead of feedparser
+# opening (and resolving, and handshaking) a new connection for every fetch.
+# This helps most when many of your feeds live on the same few hosts.
+#
+# The downloaded bytes are still handed to feedparser for parsing, so the
+# result is identical to the default fetch. Non-HTTP URLs (like those handled
+# by the script plugin) fall through to the default fetch.
+
+# MAX_CONNECTIONS is the maximum number of requests in flight at once.
+
+MAX_CONNECTIONS = 8
+
+# MAX_PER_HOST is the maximum number of connections open to any single host.
+
+MAX_PER_HOST = 2
+
+# IDLE_TIMEOUT is how long, in seconds, an unused connection is kept open.
+
+IDLE_TIMEOUT = 60
+
+# TIMEOUT is how long, in seconds, a single request may take.
+
+TIMEOUT = 30
+
+# PARSE_PROCESSES, if non-zero, is the number of worker processes used to
+# parse downloaded feeds. Parsing large feeds is CPU heavy and, in the daemon
+# process, competes with serving clients. 0 parses in the fetch thread.
+
+PARSE_PROCESSES = 0
+
+# You shouldn't have to change anything beyond this line.
+
+from canto_next.plugins import check_program
+
+check_program("canto-daemon")
+
+from canto_next.fetch import DaemonFetchThreadPlugin, CantoFetchThread
+from canto_next.httppool import CantoHTTPPool, pool_parse
+from canto_next.parsepool import CantoParsePool
+from canto_next.hooks import on_hook
+
+import logging
+
+log = logging.getLogger("HTTP-POOL")
+
+pool = CantoHTTPPool(MAX_CONNECTIONS, MAX_PER_HOST, IDLE_TIMEOUT, TIMEOUT)
+
+parse_pool = None
+if PARSE_PROCESSES:
+    parse_pool = CantoParsePool(PARSE_PROCESSES)
+
+class PooledFetch(DaemonFetchThreadPlugin):
+    def __init__(self, fetch_thread):
+        self.plugin_attrs = {
+                "get_update" : self.get_update,
+        }
+
+        self.fetch_thread = fetch_thread
+
+    def get_update(self, extra_headers):
+        feed = self.fetch_thread.feed
+
+        if not feed.URL.startswith("http://") and\
+                not feed.URL.startswith("https://"):
+            return CantoFetchThread.get_update(self.fetch_thread, extra_headers)
+
+        result = pool_parse(pool, feed.URL, extra_headers, feed.username,
+                feed.password, parse_pool, feed.stats)
+
+        if parse_pool:
+            self.fetch_thread.sanitized = True
+
+        return result
+
+on_hook("daemon_exit", pool.close)
+if parse_pool:
+    on_hook("daemon_exit", parse_pool.close)
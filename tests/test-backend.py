@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.canto_backend import CantoBackend
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.hooks import on_hook, remove_hook
+from canto_next.locks import tag_lock
+from canto_next.profiler import profiler
+from canto_next.tag import alltags
+
+from threading import local, current_thread
+import time
+
+TEST_URL = "http://example.com/"
+
+class TestShelf(dict):
+    def update_umod(self):
+        pass
+
+# Just enough of a backend to run commands, without the arguments, sockets
+# and threads. Anything that would be sent is kept in written.
+
+class TestBackend(CantoBackend):
+    def __init__(self):
+        self.plugin_attrs = {}
+        self.batch_local = local()
+        self.watches = { "new_tags" : [], "del_tags" : [], "config" : [],
+                "tags" : {} }
+        self.autoattr = {}
+        self.socket_transforms = {}
+        self.written = []
+
+    def write(self, conn, cmd, args):
+        if getattr(self.batch_local, "captured", None) != None:
+            return CantoBackend.write(self, conn, cmd, args)
+        self.written.append((cmd, args))
+
+    def command(self, cmd, args):
+        self.written = []
+        getattr(self, "cmd_" + cmd.lower())(None, args)
+        return self.written
+
+class TestBackendCommands(Test):
+    def setup_feed(self):
+        alltags.reset()
+        allfeeds.reset()
+
+        shelf = TestShelf()
+        feed = CantoFeed(shelf, "Test Feed", TEST_URL, 10, 86400, False)
+
+        entries = []
+        for i in range(10):
+            entries.append({ "title" : "Title %d" % i,
+                "link" : TEST_URL + "%d/" % i })
+        feed.index({ "canto_update" : time.time(), "entries" : entries })
+
+        return shelf, feed
+
+    def check(self):
+        backend = TestBackend()
+        tag = "maintag:Test Feed"
+
+        self.banner("marktag")
+
+        shelf, feed = self.setup_feed()
+        ids = alltags.get_tag(tag)[:]
+
+        feed.set_attributes(ids[:3], dict([ (id, { "canto-state" : [ "read" ] })\
+                for id in ids[:3] ]))
+        feed.set_attributes(ids[3:4], { ids[3] : { "canto-state" : [ "marked" ] } })
+
+        # SETATTRIBUTES hooks see only the items that change, outside of the
+        # locks.
+
+        hooked = []
+        def setattributes(socket, args):
+            if tag_lock.writer_id or tag_lock.readers:
+                raise Exception("Hook called with tag_lock held")
+            hooked.append(args)
+
+        on_hook("daemon_pre_setattributes", setattributes)
+        on_hook("daemon_post_setattributes", setattributes)
+
+        r = backend.command("MARKTAG", { "tag" : tag, "state" : "read" })
+        if r != [ ("MARKTAG", { "tag" : tag, "state" : "read", "changed" : 7 }) ]:
+            raise Exception("Bad MARKTAG reply: %s" % r)
+
+        if len(hooked) != 2 or sorted(hooked[0].keys()) != sorted(ids[3:]):
+            raise Exception("Bad SETATTRIBUTES hooks: %s" % hooked)
+
+        if alltags.get_counts(tag) != { "unread" : 0, "read" : 10, "total" : 10 }:
+            raise Exception("Not marked read: %s" % alltags.get_counts(tag))
+
+        # Other states are kept.
+
+        for entry in shelf[TEST_URL]["entries"]:
+            if entry["id"] == TEST_URL + "3/" and\
+                    entry["canto-state"] != [ "marked", "read" ]:
+                raise Exception("Lost state: %s" % entry)
+
+        # Nothing to change, no hooks.
+
+        hooked = []
+        r = backend.command("MARKTAG", { "tag" : tag, "state" : "read" })
+        if r[0][1]["changed"] != 0 or hooked:
+            raise Exception("Marked read items again: %s" % r)
+
+        r = backend.command("MARKTAG", { "tag" : tag, "state" : "-read" })
+        if r[0][1]["changed"] != 10 or\
+                alltags.get_counts(tag) != { "unread" : 10, "read" : 0, "total" : 10 }:
+            raise Exception("Not marked unread: %s" % r)
+
+        remove_hook("daemon_pre_setattributes", setattributes)
+        remove_hook("daemon_post_setattributes", setattributes)
+
+        self.banner("socket transforms")
+
+        # They read the tags and the sort index, so they need tag_lock.
+
+        def check_locked(items):
+            if current_thread().ident not in\
+                    [ x[0] for x in tag_lock.reader_stacks ]:
+                raise Exception("Socket transform without tag_lock")
+            return items[:2]
+
+        backend.socket_transforms[None] = { "check" : check_locked }
+        r = backend.command("ITEMS", [ tag ])
+        del backend.socket_transforms[None]
+
+        if r[0] != ("ITEMS", { tag : ids[:2] }):
+            raise Exception("Socket transform not applied: %s" % r)
+
+        self.banner("batch")
+
+        # One reply per command, in order, even for commands that write
+        # nothing (SETATTRIBUTES) or more than once (ITEMS).
+
+        r = backend.command("BATCH", [ [ "PING", "" ],
+            [ "SETATTRIBUTES", { ids[0] : { "canto-state" : [ "read" ] } } ],
+            [ "ITEMS", [ tag ] ], [ "COUNTS", [ tag ] ] ])
+
+        if len(r) != 1 or r[0][0] != "BATCH":
+            raise Exception("Expected one BATCH reply: %s" % r)
+
+        replies = r[0][1]
+        if [ [ cmd for cmd, args in reply ] for reply in replies ] !=\
+                [ [ "PONG" ], [], [ "ITEMS", "ITEMSDONE" ], [ "COUNTS" ] ]:
+            raise Exception("Bad BATCH replies: %s" % replies)
+
+        if replies[3][0][1][tag]["read"] != 1:
+            raise Exception("SETATTRIBUTES not run before COUNTS: %s" % replies[3])
+
+        # Unknown, unbatchable and failing commands get an EXCEPT in their
+        # place, and don't stop the rest.
+
+        r = backend.command("BATCH", [ [ "BOGUS", [] ], [ "SETCONFIGS", {} ],
+            [ "COUNTS", 5 ], [ "PING", "" ] ])
+
+        replies = r[0][1]
+        if [ [ cmd for cmd, args in reply ] for reply in replies ] !=\
+                [ [ "EXCEPT" ], [ "EXCEPT" ], [ "EXCEPT" ], [ "PONG" ] ]:
+            raise Exception("Bad BATCH error replies: %s" % replies)
+
+        if "can't be batched" not in replies[1][0][1] or\
+                "TypeError" not in replies[2][0][1]:
+            raise Exception("Bad EXCEPT replies: %s" % replies)
+
+        self.banner("profile")
+
+        for rate in [ 0, "fast" ]:
+            r = backend.command("PROFILE", { "start" : True, "rate" : rate })
+            if len(r) != 1 or r[0][0] != "EXCEPT" or profiler.running():
+                raise Exception("Started profiler at rate %s: %s" % (rate, r))
+
+        feed.destroy()
+        return True
+
+TestBackendCommands("backend")
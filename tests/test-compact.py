@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from canto_next.compact import CompactEncoder, CompactDecoder, MAX_TABLE,\
+        LIST, DEFINE, REF, varint
+from canto_next.protocol import CantoSocket
+import canto_next.protocol as protocol
+
+from base import *
+
+from threading import Lock
+import select
+import socket
+import struct
+import zlib
+
+# A CantoSocket end of a socketpair.
+
+class PairSocket(CantoSocket):
+    def __init__(self, sock, server):
+        self.sock = sock
+        CantoSocket.__init__(self, None, server = server)
+
+    def connect(self):
+        self.sockets.append(self.sock)
+        self.read_locks[self.sock] = Lock()
+        self.write_locks[self.sock] = Lock()
+        self.write_frags[self.sock] = None
+
+def item_id(url, i):
+    return json.dumps({ "URL" : url, "ID" : i })
+
+class TestCompact(Test):
+    def roundtrip(self, enc, dec, obj):
+        data = enc.encode(("TEST", obj))
+        got = dec.decode(data)
+        if got != json.loads(json.dumps(("TEST", obj))):
+            raise Exception("Roundtrip mismatch: %s -> %s" % (obj, got))
+        return data
+
+    def check(self):
+        self.banner("values")
+
+        enc = CompactEncoder()
+        dec = CompactDecoder()
+
+        values = [ None, True, False, 0, 1, -1, 63, -64, 300, -300, 2**40,
+                -2**40, 0.5, -1e100, "", "plain", "ünïcödé", [], {},
+                [ 1, [ 2, [ 3 ] ] ], { "a" : { "b" : [ None, 1.5 ] } },
+                ( "tuple", 1 ) ]
+
+        for v in values:
+            self.roundtrip(enc, dec, v)
+
+        # Non-string keys are stringified like json.dumps does.
+
+        self.roundtrip(enc, dec, { 1 : "x", None : "y", True : "z" })
+
+        self.banner("item ids")
+
+        url = "http://example.com/feed.xml"
+        ids = [ item_id(url, "http://example.com/%d" % i) for i in range(100) ]
+        ids.append(item_id(url, ""))
+        ids.append(item_id(url, 'quoted \\"id\\" ü'))
+        ids.append('{"URL": "not", "quite an id"}')
+        ids.append('{"URL": "')
+
+        first = self.roundtrip(enc, dec, { "maintag:Test" : ids })
+        second = self.roundtrip(enc, dec, { "maintag:Test" : ids })
+
+        if url.encode() not in first or url.encode() in second:
+            raise Exception("URL not tabled")
+
+        if len(second) * 2 > len(json.dumps(ids)):
+            raise Exception("Item ids not compacted: %d vs %d" %\
+                    (len(second), len(json.dumps(ids))))
+
+        self.banner("records")
+
+        attrs = {}
+        for n, i in enumerate(ids[:100]):
+            attrs[i] = { "title" : "Title %d" % n, "canto-state" : [ "read" ],
+                    "n" : n }
+        self.roundtrip(enc, dec, attrs)
+
+        # Newlines in a string column, and keys that don't line up.
+
+        attrs[ids[0]]["title"] = "Two\nlines"
+        self.roundtrip(enc, dec, attrs)
+
+        attrs[ids[1]] = { "canto-state" : [], "title" : "Swapped", "n" : 1 }
+        self.roundtrip(enc, dec, attrs)
+        self.roundtrip(enc, dec, [ { "a" : 1 }, { "b" : 2 }, "c" ])
+
+        self.banner("table limits")
+
+        # The other end can't define more strings than we'd send, or refer to
+        # strings it never defined.
+
+        dec = CompactDecoder()
+        dec.table = [ "s%d" % i for i in range(MAX_TABLE) ]
+        for data in [ bytes((LIST, 1, DEFINE, 1)) + b"x",
+                bytes((LIST, 1, REF)) + varint(MAX_TABLE) ]:
+            try:
+                dec.decode(data)
+            except ValueError:
+                pass
+            else:
+                raise Exception("Accepted bad string: %s" % data)
+
+        if len(dec.table) != MAX_TABLE:
+            raise Exception("String table grew past the limit")
+
+        self.banner("negotiation")
+
+        a, b = socket.socketpair()
+        client, server = PairSocket(a, False), PairSocket(b, True)
+
+        # A JSON message sent before the switch is still read as JSON.
+
+        client.do_write(a, "VERSION", { "encodings" : [ "compact" ] })
+        client.do_write(a, "PING", [])
+
+        r = server.do_read(b)
+        if r != ("VERSION", { "encodings" : [ "compact" ] }):
+            raise Exception("Bad VERSION request: %s" % (r,))
+        reply = { "version" : 0.9, "encoding" : "compact",
+                "compression" : "zlib" }
+        server.do_write(b, "VERSION", reply, reply)
+
+        if server.do_read(b) != ("PING", []):
+            raise Exception("Pipelined JSON misread")
+
+        if client.encoders:
+            raise Exception("Client switched before reply")
+
+        r = client.do_read(a)
+        if r[0] != "VERSION" or a not in client.encoders or\
+                a not in client.compressors:
+            raise Exception("Client didn't switch: %s" % (r,))
+
+        for i in range(2):
+            client.do_write(a, "ITEMS", [ "maintag:Test" ])
+            r = server.do_read(b)
+            if r != ("ITEMS", [ "maintag:Test" ]):
+                raise Exception("Bad compact read: %s" % (r,))
+
+            # Big enough to be compressed, and the second time around to
+            # compress better.
+
+            server.do_write(b, "ITEMS", { "maintag:Test" : ids * 10 })
+            r = client.do_read(a)
+            if r != ("ITEMS", { "maintag:Test" : ids * 10 }):
+                raise Exception("Bad compact reply")
+
+            if a not in client.decompressors:
+                raise Exception("Reply wasn't compressed")
+
+            # Small messages go uncompressed, without upsetting the stream.
+
+            server.do_write(b, "PONG", "")
+            if client.do_read(a) != ("PONG", ""):
+                raise Exception("Bad uncompressed reply")
+
+        client.disconnected(a)
+        server.disconnected(b)
+        if client.encoders or client.decoders or server.encoders or\
+                server.decoders or client.compressors or\
+                client.decompressors or server.compressors:
+            raise Exception("Encoding state not cleaned up")
+
+        a.close()
+        b.close()
+
+        self.banner("oversized messages")
+
+        # Whether the size is bogus or the message inflates past the limit,
+        # the connection is dropped instead of read.
+
+        limit = protocol.MAX_MESSAGE
+        protocol.MAX_MESSAGE = 65536
+
+        for compressed in [ False, True ]:
+            a, b = socket.socketpair()
+            client, server = PairSocket(a, False), PairSocket(b, True)
+
+            if compressed:
+                server.compressors[b] = zlib.compressobj(1)
+            else:
+                b.send(struct.pack("!q", protocol.MAX_MESSAGE + 1))
+
+            server.do_write(b, "ITEMS", { "maintag:Test" : ids * 20 })
+
+            if client.do_read(a) != select.POLLHUP or a in client.read_locks:
+                raise Exception("Read oversized message (compressed: %s)" %\
+                        compressed)
+
+            server.disconnected(b)
+            a.close()
+            b.close()
+
+        protocol.MAX_MESSAGE = limit
+
+        return True
+
+TestCompact("compact")
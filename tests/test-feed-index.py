@@ -5,11 +5,22 @@ from base import *
 
 from canto_next.feed import CantoFeed, dict_id, allfeeds
 from canto_next.tag import alltags
+from canto_next.locks import feed_lock, tag_lock
+from canto_next.search import search
+from canto_next.sortindex import sortindex
+from canto_next.retention import retention
+from canto_next.budget import budget
+from canto_next.transform import eval_transform, LazyAttributes
+from canto_next.hooks import on_hook, remove_hook
 import time
 
 TEST_URL = "http://example.com/"
 DEF_KEEP_TIME = 86400
 
+class TestShelf(dict):
+    def update_umod(self):
+        pass
+
 class TestFeedIndex(Test):
 
     # Make sure all items in the feeds have all of their tags...
@@ -63,7 +74,7 @@ class TestFeedIndex(Test):
         alltags.reset()
         allfeeds.reset()
 
-        test_shelf = {}
+        test_shelf = TestShelf()
         test_feed = CantoFeed(test_shelf, feed_name, feed_url, 10, DEF_KEEP_TIME, False)
         update = self.generate_update_contents(num_items, item_content_template, time.time())
 
@@ -129,6 +140,14 @@ class TestFeedIndex(Test):
 
         test_feed.index(second_update)
 
+        # Old items are only dropped by the retention sweep.
+
+        if len(alltags.tags["maintag:Test Feed"]) != 200:
+            raise Exception("Items discarded on index")
+
+        if retention.sweep(now) != 95:
+            raise Exception("Wrong number of items expired")
+
         self.compare_feed_and_tags(test_shelf)
 
         tag = alltags.tags["maintag:Test Feed"]
@@ -144,6 +163,7 @@ class TestFeedIndex(Test):
         test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now - 300)
 
         test_feed.index(second_update)
+        retention.sweep(now)
 
         self.compare_feed_and_tags(test_shelf)
 
@@ -177,6 +197,7 @@ class TestFeedIndex(Test):
         second_update = self.generate_update_contents(100, update_content, now)
 
         test_feed.index(second_update)
+        retention.sweep(now)
 
         self.compare_feed_and_tags(test_shelf)
 
@@ -186,6 +207,52 @@ class TestFeedIndex(Test):
         if nitems != 175:
             raise Exception("Wrong number of items in tag! %d - %s" % (nitems, tag))
 
+        # Once read, the kept items expire too.
+
+        ids = [ test_feed._item_id(entry) for entry in\
+                test_shelf[TEST_URL]["entries"][100:] ]
+        test_feed.set_attributes(ids, dict([ (id, { "canto-state" : [ "read" ] })\
+                for id in ids ]))
+        retention.sweep(now)
+
+        nitems = len(alltags.tags["maintag:Test Feed"])
+        if nitems != 105:
+            raise Exception("Read items not expired: %d" % nitems)
+
+        self.banner("retention")
+
+        # A feed that isn't fetched still expires items, and items still in
+        # the feed are kept at least until a couple of fetches are missed.
+
+        test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now)
+        test_feed.keep_time = 60
+        test_feed.index({ "entries" : [] })
+
+        interval = test_feed.schedule.interval()
+        if retention.sweep(now + interval) != 0:
+            raise Exception("Items in the feed expired early")
+        if retention.sweep(now + interval * 2 + 1) != 100:
+            raise Exception("Items not expired without a fetch")
+        if alltags.tags["maintag:Test Feed"] or test_shelf[TEST_URL]["entries"]:
+            raise Exception("Expired items left behind")
+
+        # Items indexed again after they expired, but before they were
+        # untagged, stay.
+
+        test_feed.index(self.generate_update_contents(100, content, now))
+        expired = test_feed.expire(now + interval * 2 + 1)
+        test_feed.index(self.generate_update_contents(100, content, now))
+
+        feed_lock.acquire_read()
+        tag_lock.acquire_write()
+        untagged = test_feed.untag_expired(expired)
+        tag_lock.release_write()
+        feed_lock.release_read()
+
+        if len(expired) != 100 or untagged != 0 or\
+                len(alltags.tags["maintag:Test Feed"]) != 100:
+            raise Exception("Reindexed items untagged")
+
         self.banner("save all items on empty new content")
 
         test_feed, test_shelf, first_update = self.generate_baseline("Test Feed", TEST_URL, 100, content, now - (DEF_KEEP_TIME + 1))
@@ -198,6 +265,387 @@ class TestFeedIndex(Test):
         if nitems != 100:
             raise Exception("Wrong number of items in tag! %d - %s" % (nitems, tag))
 
+        self.banner("keep_fields")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        test_shelf = {}
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10,
+                DEF_KEEP_TIME, False, keep_fields = [ "title" ])
+
+        test_feed.index(self.generate_update_contents(10,
+            dict(content, summary = "Summary %d"), now))
+
+        for entry in test_shelf[TEST_URL]["entries"]:
+            if sorted(entry.keys()) != [ "canto_update", "id", "title" ]:
+                raise Exception("Failed to prune entry: %s" % entry)
+
+        test_feed.keep_fields = None
+        test_feed.index(self.generate_update_contents(10,
+            dict(content, summary = "Summary %d"), now))
+
+        test_feed.keep_fields = set([ "link" ])
+        if test_feed.compact() != 20:
+            raise Exception("Compact pruned wrong number of fields")
+
+        for entry in test_shelf[TEST_URL]["entries"]:
+            if sorted(entry.keys()) != [ "canto_update", "id", "link" ]:
+                raise Exception("Failed to compact entry: %s" % entry)
+
+        self.banner("counts")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        test_shelf = TestShelf()
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10,
+                DEF_KEEP_TIME, False)
+        test_feed.index(self.generate_update_contents(10, content, now))
+
+        tag = "maintag:Test Feed"
+        if alltags.get_counts(tag) != { "unread" : 10, "read" : 0, "total" : 10 }:
+            raise Exception("Bad initial counts: %s" % alltags.get_counts(tag))
+
+        ids = alltags.tags[tag][:3]
+        test_feed.set_attributes(ids, dict([ (id, { "canto-state" : [ "read" ] })\
+                for id in ids ]))
+
+        if alltags.get_counts(tag) != { "unread" : 7, "read" : 3, "total" : 10 }:
+            raise Exception("Read not counted: %s" % alltags.get_counts(tag))
+
+        test_feed.index(self.generate_update_contents(10, content, now))
+        test_feed.set_attributes(ids[:1], { ids[0] : { "canto-state" : [] } })
+
+        if alltags.get_counts(tag) != { "unread" : 8, "read" : 2, "total" : 10 }:
+            raise Exception("Bad counts after reindex: %s" % alltags.get_counts(tag))
+
+        self.banner("set attributes")
+
+        alltags.reset()
+        allfeeds.reset()
+
+        test_shelf = TestShelf()
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10,
+                DEF_KEEP_TIME, False)
+        other_feed = CantoFeed(test_shelf, "Other Feed", TEST_URL + "other/",
+                10, DEF_KEEP_TIME, False)
+
+        tagged = dict(content, **{ "canto-tags" : [ "user:shared" ] })
+        for feed in [ test_feed, other_feed ]:
+            feed.index(self.generate_update_contents(10, tagged, now))
+
+        order = dict([ (tag, alltags.tags[tag][:]) for tag in alltags.tags ])
+
+        changes = []
+        on_hook("daemon_tag_change", changes.append)
+
+        # Marking items in both feeds read changes each of their tags once,
+        # and doesn't move them.
+
+        ids = alltags.tags["user:shared"][::2]
+        allfeeds.set_attributes(dict([ (id, { "canto-state" : [ "read" ] })\
+                for id in ids ]))
+
+        if sorted(changes) != sorted(order.keys()):
+            raise Exception("Bad tag changes: %s" % changes)
+        if alltags.tags != order:
+            raise Exception("Items moved on state change")
+        if alltags.get_counts("user:shared")["read"] != 10 or\
+                alltags.get_counts("maintag:Test Feed")["read"] != 5:
+            raise Exception("Read not counted: %s" % alltags.read_counts)
+
+        # Changing an item's tags still retags it.
+
+        id = ids[0]
+        test_feed.set_attributes([ id ],
+                { id : { "canto-tags" : [ "user:other" ] } })
+
+        if alltags.items_to_tags([ id ]) != [ "maintag:Test Feed", "user:other" ]:
+            raise Exception("Not retagged: %s" % alltags.items_to_tags([ id ]))
+
+        for name in alltags.tags:
+            for item in alltags.tags[name]:
+                if name not in alltags.item_tags[item]:
+                    raise Exception("%s missing from item_tags" % item)
+        for item in alltags.item_tags:
+            for name in alltags.item_tags[item]:
+                if item not in alltags.tags[name]:
+                    raise Exception("%s not in %s" % (item, name))
+
+        self.compare_feed_and_tags(test_shelf)
+        remove_hook("daemon_tag_change", changes.append)
+
+        test_feed.destroy()
+        other_feed.destroy()
+
+        self.banner("search")
+
+        alltags.reset()
+        allfeeds.reset()
+        search.reset()
+
+        test_shelf = TestShelf()
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10,
+                DEF_KEEP_TIME, False)
+
+        first = self.generate_update_contents(10, dict(content,
+            summary = "<p>Common <b>words</b> and item%d</p>"), now - 10)
+        first["entries"][3]["canto-tags"] = [ "user:starred" ]
+        test_feed.index(first)
+
+        ids = alltags.tags[tag][:]
+        scope = alltags.get_tags_set([ tag ])
+
+        if search.search("COMMON words", scope) != sorted(ids, reverse=True):
+            raise Exception("Bad search for all items")
+        if search.search("item4") != [ ids[4] ]:
+            raise Exception("Bad search for one item")
+        if search.search("title 7") != [ ids[7] ] or search.search("p b"):
+            raise Exception("Bad title search / markup indexed")
+        if search.search("common", alltags.get_tags_set([ "user:starred" ])) !=\
+                [ ids[3] ] or len(alltags.get_tags_set([])) != 10:
+            raise Exception("Bad scoped search")
+
+        # Newer items first, unchanged items aren't re-indexed, changed ones
+        # are, and discarded ones are removed.
+
+        second = self.generate_update_contents(5, dict(content,
+            summary = "Common words, newer %d"), now)
+        second["entries"][0]["title"] = "Changed title"
+        second["entries"].extend(first["entries"][5:])
+
+        indexed = search.docs[ids[9]]
+        test_feed.index(second)
+
+        if search.docs[ids[9]] is not indexed:
+            raise Exception("Unchanged item re-indexed")
+        if search.search("common", None, 5) != list(reversed(ids[:5])):
+            raise Exception("Bad recency order: %s" % search.search("common"))
+        if search.search("item0") or search.search("changed") != [ ids[0] ]:
+            raise Exception("Changed title not re-indexed")
+
+        test_feed.index(self.generate_update_contents(1, content, now))
+        if search.search("newer") != ids[4:0:-1]:
+            raise Exception("Search changed on keep_time")
+
+        test_feed.keep_time = 0
+        test_feed.index(self.generate_update_contents(1, content, now + 1))
+        retention.sweep(now + 1)
+        if search.search("common") or len(search.docs) != 1:
+            raise Exception("Discarded items not removed: %s" % search.docs)
+
+        test_feed.destroy()
+        if search.docs or search.postings:
+            raise Exception("Feed not removed from search")
+
+        self.banner("budget")
+
+        alltags.reset()
+        allfeeds.reset()
+        sortindex.reset()
+
+        budget.max_items = 30
+        budget.access = {}
+        budget.evicted = 0
+
+        # Two feeds of 20 items, where all but the first two of each have
+        # fallen out of the feed. Half of the old items in the first feed are
+        # read, all of them in the second.
+
+        test_shelf = TestShelf()
+        feeds = []
+        for name, url in [ ("Test Feed", TEST_URL), ("Other Feed", TEST_URL + "other/") ]:
+            feed = CantoFeed(test_shelf, name, url, 10, DEF_KEEP_TIME, False,
+                    min_items = 5)
+            feed.index(self.generate_update_contents(20, content, now - 100))
+            feed.index(self.generate_update_contents(2, content, now))
+            feeds.append(feed)
+
+        test_feed, other_feed = feeds
+
+        def ids(feed, numbers):
+            entries = test_shelf[feed.URL]["entries"]
+            return [ feed._item_id(entries[i]) for i in numbers ]
+
+        def mark_read(feed, numbers):
+            read = ids(feed, numbers)
+            feed.set_attributes(read, dict([ (id, { "canto-state" : [ "read" ] })\
+                    for id in read ]))
+            return read
+
+        def count(feed):
+            return len(test_shelf[feed.URL]["entries"])
+
+        test_read = mark_read(test_feed, range(2, 20, 2))
+        other_read = mark_read(other_feed, range(2, 20))
+
+        # Recently accessed items go last, even though they're the same age.
+
+        budget.touch(test_read)
+
+        if budget.enforce() != 10:
+            raise Exception("Didn't evict down to max_items")
+        if count(test_feed) != 20 or count(other_feed) != 10:
+            raise Exception("Evicted recently accessed items first: %d / %d" %\
+                    (count(test_feed), count(other_feed)))
+
+        remaining = alltags.tags["maintag:Other Feed"]
+        if len([ id for id in other_read if id in remaining ]) != 8:
+            raise Exception("Evicted the wrong items: %s" % remaining)
+
+        # Unread items, items in the latest fetch and min_items are kept,
+        # no matter how far over we are.
+
+        budget.max_items = 1
+
+        if budget.enforce() != 14:
+            raise Exception("Evicted too much, or too little")
+        if count(test_feed) != 11 or count(other_feed) != 5:
+            raise Exception("Evicted unread or protected items: %d / %d" %\
+                    (count(test_feed), count(other_feed)))
+
+        for entry in test_shelf[test_feed.URL]["entries"]:
+            if "read" in entry.get("canto-state", []):
+                raise Exception("Read item left behind: %s" % entry)
+
+        self.compare_feed_and_tags(test_shelf)
+
+        if len(alltags.tags["maintag:Test Feed"]) != 11 or\
+                len(alltags.tags["maintag:Other Feed"]) != 5:
+            raise Exception("Evicted items left in tags")
+
+        if budget.enforce() != 0:
+            raise Exception("Evicted past min_items")
+
+        # Until something changes, we don't look again.
+
+        test_feed.eviction_candidates = None
+        budget.enforce()
+        del test_feed.eviction_candidates
+
+        # Marking an old item read makes it evictable.
+
+        entries = test_shelf[test_feed.URL]["entries"]
+        old = [ i for i, e in enumerate(entries)\
+                if e["canto_update"] < test_feed.latest ]
+        mark_read(test_feed, old[:1])
+
+        if budget.enforce() != 1 or count(test_feed) != 10:
+            raise Exception("Newly read item not evicted")
+
+        if budget.report() != { "items" : 15, "max_items" : 1, "evicted" : 25 }:
+            raise Exception("Bad report: %s" % budget.report())
+
+        test_feed.destroy()
+        other_feed.destroy()
+        budget.max_items = 0
+
+        self.banner("sort")
+
+        alltags.reset()
+        allfeeds.reset()
+        sortindex.reset()
+
+        other_url = TEST_URL + "other/"
+        test_shelf = TestShelf()
+        test_feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10,
+                DEF_KEEP_TIME, False)
+        other_feed = CantoFeed(test_shelf, "Other Feed", other_url, 10,
+                DEF_KEEP_TIME, False)
+
+        # Titles in the opposite order of dates, interleaved between feeds,
+        # and an undated item.
+
+        for feed, start in [ (test_feed, 0), (other_feed, 1) ]:
+            update = self.generate_update_contents(5, content, now)
+            for i, entry in enumerate(update["entries"]):
+                n = start + i * 2
+                entry["title"] = "Title %02d" % n
+                entry["published_parsed"] = list(time.gmtime(now - n * 60))
+            if feed == other_feed:
+                del update["entries"][4]["published_parsed"]
+                update["entries"][4]["title"] = "Undated"
+            feed.index(update)
+
+        ids = alltags.tags["maintag:Test Feed"] +\
+                alltags.tags["maintag:Other Feed"]
+        titles = {}
+        for feed in [ test_feed, other_feed ]:
+            for entry in test_shelf[feed.URL]["entries"]:
+                titles[feed._item_id(entry)] = entry["title"]
+
+        def sort(name, items):
+            return [ titles[i] for i in eval_transform(name)(items[:]) ]
+
+        expected = [ "Title %02d" % n for n in range(9) ] + [ "Undated" ]
+        if sort("sort_alphabetical", ids) != expected:
+            raise Exception("Bad title sort: %s" % sort("sort_alphabetical", ids))
+
+        # The undated item was seen "now", so it's newest.
+
+        expected = [ "Undated" ] + [ "Title %02d" % n for n in range(9) ]
+        if sort("sort_date", ids) != expected:
+            raise Exception("Bad date sort: %s" % sort("sort_date", ids))
+
+        expected = [ "Title %02d" % n for n in [ 0, 2, 4, 6, 8 ] ] +\
+                [ "Undated" ] + [ "Title %02d" % n for n in [ 1, 3, 5, 7 ] ]
+        if sort("sort_feed", ids) != expected:
+            raise Exception("Bad feed sort: %s" % sort("sort_feed", ids))
+
+        # Attributes are still read for filters that need them.
+
+        got = [ titles[i] for i in eval_transform("All(ContentFilter("
+            "'title', '2'), sort_alphabetical, ItemLimit(3))")(ids[:]) ]
+        if got != [ "Title 00", "Title 01", "Title 03" ]:
+            raise Exception("Bad filtered, limited sort: %s" % got)
+
+        # The lazy attributes still act like a dict of every item.
+
+        attrs = LazyAttributes(ids, [ "title" ])
+        if ids[0] not in attrs or "bogus" in attrs or\
+                dict.__len__(attrs) != 0:
+            raise Exception("Membership read from disk")
+        if attrs.get("bogus", 1) != 1 or attrs.get(ids[0])["title"] != titles[ids[0]]:
+            raise Exception("Bad get()")
+        if sorted(attrs.keys()) != sorted(ids) or len(attrs) != len(ids) or\
+                dict(attrs.items())[ids[-1]]["title"] != titles[ids[-1]]:
+            raise Exception("Not every item: %s" % list(attrs.keys()))
+
+        # Part of a tag, whichever way it's picked out of the runs.
+
+        for subset in [ ids[::2], ids[:1] + ids[5:6] ]:
+            expected = sorted([ titles[i] for i in subset ])
+            if sort("sort_alphabetical", subset) != expected:
+                raise Exception("Bad subset sort: %s" %\
+                        sort("sort_alphabetical", subset))
+
+        # Unknown items go last, retitled items move.
+
+        unknown = '{"URL": "%s", "ID": "unknown"}' % TEST_URL
+        titles[unknown] = "Unknown"
+        if sort("sort_alphabetical", [ unknown ] + ids)[-1] != "Unknown":
+            raise Exception("Unknown item not sorted last")
+
+        run = sortindex.run("title", TEST_URL)
+        test_feed.set_attributes(ids[:1], { ids[0] : { "title" : "Zzz" } })
+        titles[ids[0]] = "Zzz"
+        if sort("sort_alphabetical", ids)[-1] != "Zzz":
+            raise Exception("Retitled item not resorted")
+
+        # State changes don't touch the runs.
+
+        run = sortindex.run("title", TEST_URL)
+        test_feed.set_attributes(ids[:1],
+                { ids[0] : { "canto-state" : [ "read" ] } })
+        if sortindex.run("title", TEST_URL) is not run:
+            raise Exception("Run rebuilt on state change")
+
+        test_feed.destroy()
+        other_feed.destroy()
+        if sortindex.urls or sortindex.feeds or sortindex.keys["date"]:
+            raise Exception("Feeds not removed from sort index")
+
         return True
 
 TestFeedIndex("feed index")
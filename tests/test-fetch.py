@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.fetch import json_clean, sanitize_update, keep_toplevel
+
+import feedparser
+import time
+
+FEED = """<?xml version="1.0"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel><title>Feed</title>
+<item><title>Item 1</title><link>http://example.com/1</link>
+<pubDate>Mon, 06 Sep 2010 16:45:00 +0000</pubDate>
+<dc:creator>Someone</dc:creator></item>
+<item><title>Item 2 & broken</title></item>
+</channel></rss>"""
+
+class Key(str):
+    pass
+
+def json_roundtrip(obj):
+    return json.loads(json.dumps(obj, default=lambda x: None, skipkeys=True))
+
+class TestFetch(Test):
+    def compare(self, obj):
+        got = json_clean(obj)
+        expected = json_roundtrip(obj)
+        if got != expected:
+            raise Exception("json_clean mismatch:\n%s\n%s" % (got, expected))
+
+        # Same key order too, items are stored as they come.
+
+        if json.dumps(got) != json.dumps(expected):
+            raise Exception("json_clean order mismatch:\n%s\n%s" %\
+                    (got, expected))
+
+    def check(self):
+        self.banner("feedparser output")
+
+        result = feedparser.parse(FEED, response_headers =\
+                { "content-type" : "application/rss+xml", "etag" : '"a"' })
+
+        if not result["bozo"] or type(result["entries"][0]) == dict or\
+                type(result["entries"][0]["published_parsed"]) !=\
+                time.struct_time:
+            raise Exception("Unexpected feedparser output: %s" % result)
+
+        self.compare(result)
+        self.compare(result["entries"])
+
+        self.banner("odd values")
+
+        entry = feedparser.FeedParserDict({ "title" : "Title",
+            "published_parsed" : time.gmtime(0),
+            "content" : [ feedparser.FeedParserDict({ "value" : b"bytes",
+                "type" : "text/html" }) ],
+            "error" : ValueError("bad"),
+            "tags" : ( "a", "b" ),
+            "unique" : set([ 1 ]),
+            "nested" : { "deeper" : feedparser.FeedParserDict({ "n" : 1.5 }) },
+            1 : "int key", 2.5 : "float key", float("nan") : "nan key",
+            None : "none key", True : "bool key", ( 1, 2 ) : "tuple key",
+            Key("sub") : "str subclass key", "value" : Key("str subclass") })
+
+        self.compare(entry)
+        self.compare([ entry, [ time.gmtime(0) ], b"bytes", None ])
+
+        cleaned = json_clean(entry)
+        if type(cleaned) != dict or type(cleaned["nested"]["deeper"]) != dict\
+                or type(cleaned["value"]) != str or\
+                cleaned["published_parsed"] != list(time.gmtime(0)):
+            raise Exception("Not plain types: %s" % cleaned)
+
+        self.banner("sanitize update")
+
+        result["canto_update"] = 1234
+        sanitized = sanitize_update(result)
+
+        if sorted(sanitized.keys()) !=\
+                sorted([ k for k in keep_toplevel if k in result ]):
+            raise Exception("Bad top level keys: %s" % sanitized.keys())
+
+        for key in [ "headers", "namespaces" ]:
+            if key not in result or key in sanitized:
+                raise Exception("Unknown top level key %s kept" % key)
+
+        if sanitized["bozo_exception"] != None or\
+                type(sanitized["entries"][0]) != dict:
+            raise Exception("Not sanitized: %s" % sanitized)
+
+        if sanitized["entries"] != json_roundtrip(result["entries"]):
+            raise Exception("Entries not cleaned like JSON")
+
+        # Already clean content is only filtered.
+
+        clean = sanitize_update(result, True)
+        if clean["entries"] is not result["entries"] or "headers" in clean:
+            raise Exception("Clean content copied or unfiltered")
+
+        # Keys can be added, by plugins or for parse pool workers.
+
+        if "headers" not in sanitize_update(result, keep = [ "headers" ]):
+            raise Exception("Extra top level key dropped")
+
+        keep_toplevel.append("headers")
+        sanitized = sanitize_update(result)
+        keep_toplevel.remove("headers")
+
+        if sanitized["headers"] != result["headers"]:
+            raise Exception("Appended top level key dropped")
+
+        return True
+
+TestFetch("fetch")
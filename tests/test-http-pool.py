@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.httppool import CantoHTTPPool, pool_parse
+import canto_next.httppool as httppool
+from canto_next.parsepool import CantoParsePool
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.fetch import CantoFetchThread, DaemonFetchThreadPlugin,\
+        keep_toplevel
+from canto_next.tag import alltags
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread
+import base64
+import time
+import gzip
+
+FEED = """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Feed %s</title>
+<item><title>Item 1</title><link>http://example.com/%s/1</link></item>
+<item><title>Item 2</title><link>http://example.com/%s/2</link></item>
+</channel></rss>"""
+
+connections = []
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        connections.append(self.client_address)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/auth/"):
+            creds = base64.b64encode(b"user:pass").decode()
+            if self.headers.get("Authorization") != "Basic " + creds:
+                self.send_response(401)
+                self.send_header("WWW-Authenticate", 'Basic realm="test"')
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        if self.path.startswith("/moved/"):
+            self.send_response(301)
+            self.send_header("Location", "/feed/" + self.path[7:])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.path.startswith("/slow/"):
+            time.sleep(0.6)
+
+        if self.path.startswith("/chunked/"):
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(1000):
+                chunk = b"chunk %d\n" % i
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        if self.headers.get("If-None-Match") == '"same"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        name = self.path.split("/")[-1]
+        body = (FEED % (name, name, name)).encode("UTF-8")
+
+        if self.path.startswith("/big/"):
+            body += b"<!--" + b" " * 100000 + b"-->"
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("ETag", '"same"')
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TestHTTPPool(Test):
+    def check(self):
+        server = ThreadingServer(("127.0.0.1", 0), FeedHandler)
+        Thread(target = server.serve_forever, daemon = True).start()
+
+        base = "http://127.0.0.1:%d" % server.server_address[1]
+
+        pool = CantoHTTPPool(max_connections = 4, max_per_host = 2)
+
+        self.banner("connection reuse")
+
+        for i in range(10):
+            r = pool.get(base + "/feed/%d" % i)
+            if r.status != 200:
+                raise Exception("Bad status %s" % r.status)
+            if b"Feed %d" % i not in r.body:
+                raise Exception("Bad (or still compressed) body: %s" % r.body)
+
+        if len(connections) != 1:
+            raise Exception("Expected 1 connection, got %d" % len(connections))
+        if pool.reused != 9:
+            raise Exception("Expected 9 reuses, got %d" % pool.reused)
+
+        self.banner("bounded concurrency")
+
+        del connections[:]
+        responses = pool.get_many([ base + "/feed/%d" % i for i in range(20) ])
+
+        for i, r in enumerate(responses):
+            if isinstance(r, Exception):
+                raise r
+            if b"Feed %d" % i not in r.body:
+                raise Exception("Responses out of order")
+
+        # One idle connection from the first test, and at most one more per
+        # host slot.
+
+        if len(connections) > 1:
+            raise Exception("Opened too many connections: %d" % len(connections))
+
+        self.banner("redirect, auth, 304")
+
+        r = pool.get(base + "/moved/x")
+        if r.URL != base + "/feed/x" or b"Feed x" not in r.body:
+            raise Exception("Failed to follow redirect: %s" % r)
+
+        r = pool.get(base + "/auth/y")
+        if r.status != 401:
+            raise Exception("Expected 401 without credentials, got %s" % r.status)
+
+        r = pool.get(base + "/auth/y", {}, "user", "pass")
+        if r.status != 200 or b"Feed y" not in r.body:
+            raise Exception("Failed basic auth: %s" % r)
+
+        result = pool_parse(pool, base + "/feed/z", { "If-None-Match" : '"same"' })
+        if result["status"] != 304 or result["entries"] != []:
+            raise Exception("Failed to pass through 304: %s" % result)
+
+        self.banner("chunked")
+
+        r = pool.get(base + "/chunked/x")
+        if r.body != b"".join([ b"chunk %d\n" % i for i in range(1000) ]):
+            raise Exception("Bad chunked body: %s" % r.body[:100])
+
+        self.banner("body limit")
+
+        # Bodies, chunked or decompressed, can't be bigger than MAX_BODY.
+
+        limit = httppool.MAX_BODY
+
+        for path, size in [ ("/chunked/x", 5000), ("/big/x", 50000) ]:
+            httppool.MAX_BODY = size
+            try:
+                r = pool.get(base + path)
+            except Exception as e:
+                if "over %d bytes" % size not in str(e):
+                    raise
+            else:
+                raise Exception("Took %d byte body from %s" % (len(r.body), path))
+
+        httppool.MAX_BODY = limit
+
+        r = pool.get(base + "/big/x")
+        if len(r.body) < 100000 or b"Feed x" not in r.body:
+            raise Exception("Bad big body: %s" % r.body[:100])
+
+        self.banner("timeout")
+
+        # Each request takes over half of the timeout, so the last one would
+        # time out if time waiting for the one connection to the host counted.
+
+        slow_pool = CantoHTTPPool(max_connections = 4, max_per_host = 1,
+                timeout = 1)
+        responses = slow_pool.get_many([ base + "/slow/%d" % i for i in range(3) ])
+        for r in responses:
+            if isinstance(r, Exception):
+                raise Exception("Queued request timed out: %r" % r)
+        slow_pool.close()
+
+        self.banner("fetch thread plugin")
+
+        class PooledFetch(DaemonFetchThreadPlugin):
+            def __init__(self, fetch_thread):
+                self.plugin_attrs = { "get_update" : self.get_update }
+                self.fetch_thread = fetch_thread
+
+            def get_update(self, extra_headers):
+                feed = self.fetch_thread.feed
+                return pool_parse(pool, feed.URL, extra_headers, None, None,
+                        None, feed.stats)
+
+        alltags.reset()
+        allfeeds.reset()
+
+        URL = base + "/feed/plugin"
+        test_shelf = {}
+        test_feed = CantoFeed(test_shelf, "Pool Feed", URL, 10, 86400, False)
+
+        reused = pool.reused
+
+        thread = CantoFetchThread(test_feed, False)
+        thread.start()
+        thread.join()
+
+        if URL not in test_shelf or len(test_shelf[URL]["entries"]) != 2:
+            raise Exception("Fetch thread didn't use pool result")
+        if pool.reused != reused + 1:
+            raise Exception("Fetch thread didn't go through the pool")
+        if len(alltags.tags["maintag:Pool Feed"]) != 2:
+            raise Exception("Items not tagged")
+
+        self.banner("feed stats")
+
+        summary = test_feed.stats.summary()
+        last = summary["last"]
+
+        for key in [ "fetch", "download", "parse", "index", "retag", "total" ]:
+            if key not in last or last[key] < 0 or last[key] > last["total"]:
+                raise Exception("Bad %s timing: %s" % (key, last))
+
+        if last["bytes"] < 100 or last["added"] != 2 or last["failed"]:
+            raise Exception("Bad stats: %s" % last)
+
+        thread = CantoFetchThread(test_feed, False)
+        thread.start()
+        thread.join()
+
+        summary = test_feed.stats.summary()
+        if summary["samples"] != 2 or summary["last"]["kept"] != 2 or\
+                summary["mean"]["added"] != 1:
+            raise Exception("Bad second sample: %s" % summary)
+
+        self.banner("parse pool")
+
+        parse_pool = CantoParsePool(2)
+
+        plain = pool_parse(pool, base + "/feed/parse", {})
+        result = pool_parse(pool, base + "/feed/parse", {}, None, None, parse_pool)
+
+        if type(result) != dict or type(result["entries"][0]) != dict:
+            raise Exception("Parse pool returned non-plain types")
+        if [ e["title"] for e in result["entries"] ] !=\
+                [ e["title"] for e in plain["entries"] ]:
+            raise Exception("Parse pool result differs")
+        if type(result["entries"][0]["title_detail"]) != dict:
+            raise Exception("Parse pool result not sanitized")
+
+        # Workers are separate processes, but still keep what plugins added to
+        # keep_toplevel here.
+
+        if "namespaces" in result:
+            raise Exception("Parse pool kept unknown top level key")
+
+        keep_toplevel.append("namespaces")
+        result = pool_parse(pool, base + "/feed/parse", {}, None, None, parse_pool)
+        keep_toplevel.remove("namespaces")
+
+        if type(result.get("namespaces")) != dict:
+            raise Exception("Parse pool ignored keep_toplevel")
+
+        parse_pool.close()
+
+        pool.close()
+        server.shutdown()
+        return True
+
+# Parse pool workers are spawned, and re-import this file.
+
+if __name__ == "__main__":
+    TestHTTPPool("http pool")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.metrics import metrics
+from canto_next.metricsserver import CantoMetricsServer
+from canto_next.cmdstats import CantoCommandStats, summarize
+from canto_next.rwlock import RWLock
+from canto_next.profiler import CantoProfiler, MAX_PROFILE_RATE
+from canto_next.memory import memory, deep_size
+
+from threading import Thread
+import urllib.request
+import tempfile
+import socket
+import os
+
+class TestMetrics(Test):
+    def check(self):
+        self.banner("disabled by default")
+
+        metrics.inc("test_total")
+        if metrics.collect() != []:
+            raise Exception("Counted while disabled")
+
+        self.banner("tcp endpoint")
+
+        server = CantoMetricsServer("0")
+        port = server.server.server_address[1]
+
+        metrics.describe("test_total", "counter", "Test counter.")
+        metrics.inc("test_total", cmd = "PING")
+        metrics.inc("test_total", 2, cmd = "PING")
+        metrics.observe("test_seconds", 0.25)
+        metrics.add_collector(lambda : [ ("test_gauge", { "tag" : 'a"b' }, 3) ])
+
+        text = urllib.request.urlopen("http://127.0.0.1:%d/" % port).read().decode()
+
+        for line in [ "# TYPE test_total counter", 'test_total{cmd="PING"} 3',
+                "test_seconds_count 1", "test_seconds_sum 0.250000",
+                'test_gauge{tag="a\\"b"} 3' ]:
+            if line not in text.split("\n"):
+                raise Exception("Missing %s in:\n%s" % (line, text))
+
+        server.close()
+
+        self.banner("unix endpoint")
+
+        path = tempfile.mkdtemp() + "/metrics"
+        server = CantoMetricsServer(path)
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        s.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        resp = b""
+        while True:
+            d = s.recv(4096)
+            if not d:
+                break
+            resp += d
+        s.close()
+
+        if b'test_total{cmd="PING"} 3' not in resp:
+            raise Exception("Bad unix response: %s" % resp)
+
+        server.close()
+        if os.path.exists(path):
+            raise Exception("Socket not cleaned up")
+
+        self.banner("lock wait")
+
+        lock = RWLock("test")
+        lock.acquire_write()
+        t = Thread(target = lambda : (lock.acquire_read(), lock.release_read()))
+        t.start()
+        time.sleep(0.2)
+        lock.release_write()
+        t.join()
+
+        if lock.read_wait < 0.1:
+            raise Exception("Read wait not counted: %s" % lock.read_wait)
+
+        self.banner("command stats")
+
+        stats = CantoCommandStats()
+        stats.record("ITEMS", [ "maintag:Slashdot" ], 0.003, 30, 5000, 500)
+        stats.record("ITEMS", [ "maintag:Slashdot" ], 0.7, 30, 9000, 500)
+
+        big = { "id%d" % i : { "canto-state" : [ "read" ] } for i in range(1000) }
+        stats.record("SETATTRIBUTES", big, 0.6, 50000, 0, 500)
+        stats.record("PING", [], 0.6, 10, 10, 0)
+
+        r = stats.report()
+        items = r["commands"]["ITEMS"]
+
+        if items["count"] != 2 or items["max"] < 700 or items["out_max"] != 9000:
+            raise Exception("Bad ITEMS stats: %s" % items)
+        if items["buckets"][1] != (5, 1) or items["buckets"][6] != (1000, 1):
+            raise Exception("Bad ITEMS histogram: %s" % items["buckets"])
+
+        if [ e["cmd"] for e in r["slow"] ] != [ "ITEMS", "SETATTRIBUTES" ]:
+            raise Exception("Bad slow log: %s" % r["slow"])
+        if len(r["slow"][1]["args"]) != 6:
+            raise Exception("Args not summarized: %s" % r["slow"][1]["args"])
+
+        if summarize("x" * 100) != "x" * 60 + "..." or\
+                summarize([ [ [ 1, 2 ] ] ]) != [ [ "[2 items]" ] ]:
+            raise Exception("Bad summarize")
+
+        self.banner("profiler")
+
+        def busy_profiled():
+            end = time.time() + 0.3
+            while time.time() < end:
+                pass
+
+        profiler = CantoProfiler()
+
+        # Bad rates are refused rather than killing the sampling thread, and
+        # silly ones are clamped.
+
+        for rate in [ 0, -5, "fast", None ]:
+            try:
+                profiler.start(rate)
+            except ValueError:
+                pass
+            else:
+                raise Exception("Started at rate %s" % (rate,))
+            if profiler.running():
+                raise Exception("Running after bad rate %s" % (rate,))
+
+        profiler.start(10 ** 9)
+        if profiler.status()["rate"] != MAX_PROFILE_RATE:
+            raise Exception("Rate not clamped: %s" % profiler.status())
+        profiler.stop(tempfile.mkdtemp() + "/profile.folded")
+
+        profiler.start(200)
+        if profiler.start(200):
+            raise Exception("Started twice")
+
+        t = Thread(target = busy_profiled, name = "Busy")
+        t.start()
+        t.join()
+
+        path = tempfile.mkdtemp() + "/profile.folded"
+        r = profiler.stop(path)
+
+        if not r or r["path"] != path or r["samples"] < 10 or r["running"]:
+            raise Exception("Bad profile summary: %s" % r)
+        if profiler.stop(path) != None:
+            raise Exception("Stopped twice")
+
+        busy = 0
+        for line in open(path):
+            stack, count = line.rsplit(" ", 1)
+            if stack.startswith("Busy;") and "busy_profiled (" in stack:
+                busy += int(count)
+
+        if busy < r["samples"] / 2:
+            raise Exception("Busy thread only in %d/%d samples" %\
+                    (busy, r["samples"]))
+
+        self.banner("memory")
+
+        shared = "x" * 1000
+        small = deep_size([ "a" ])
+        big = deep_size([ shared, { "k" : [ shared ] } ])
+
+        if big < 1000 or big > 2000:
+            raise Exception("Shared string miscounted: %d" % big)
+        if deep_size([ "a" ]) != small:
+            raise Exception("deep_size not repeatable")
+
+        class Holder():
+            def __init__(self):
+                self.data = "y" * 5000
+
+        memory.add_cache("test", lambda : Holder())
+        sizes = memory.cache_sizes()
+        if sizes["test"] < 5000 or "cmdstats" not in sizes:
+            raise Exception("Bad cache sizes: %s" % sizes)
+
+        memory.remove_cache("test")
+        if "test" in memory.cache_sizes():
+            raise Exception("Cache not removed")
+
+        return True
+
+TestMetrics("metrics")
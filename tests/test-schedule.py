@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.schedule import CantoSchedule, skip_hours_from, MAX_BACKOFF,\
+        CIRCUIT_THRESHOLD, MAX_FAILURE_DELAY
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.tag import alltags
+
+import time
+
+TEST_URL = "http://example.com/"
+
+class TestSchedule(Test):
+    def entries(self, num, start, gap, prefix="item"):
+        r = []
+        for i in range(num):
+            stamp = time.gmtime(start + i * gap)
+            r.append({ "id" : prefix + str(i), "published_parsed" : list(stamp) })
+        return r
+
+    def check(self):
+        alltags.reset()
+        allfeeds.reset()
+
+        test_shelf = {}
+        feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10, 86400, False)
+        base = 600
+
+        self.banner("defaults to rate")
+
+        if feed.schedule.interval() != base:
+            raise Exception("Expected interval %d, got %d" % (base, feed.schedule.interval()))
+
+        now = time.time()
+        if not feed.schedule.needs_update(now - base):
+            raise Exception("Should need update after rate")
+        if feed.schedule.needs_update(now - base + 60):
+            raise Exception("Shouldn't need update before rate")
+
+        self.banner("busy feed stays at rate")
+
+        feed.index({ "canto_update" : now, "entries" : self.entries(10, now - 600, 60) })
+        if feed.schedule.interval() != base:
+            raise Exception("Busy feed backed off: %d" % feed.schedule.interval())
+
+        self.banner("quiet feed backs off")
+
+        quiet = CantoFeed(test_shelf, "Quiet Feed", TEST_URL + "quiet", 10, 86400, False)
+        quiet.index({ "canto_update" : now,
+            "entries" : self.entries(10, now - 86400 * 30, 86400) })
+        if quiet.schedule.interval() != base * MAX_BACKOFF:
+            raise Exception("Quiet feed didn't back off: %d" % quiet.schedule.interval())
+
+        self.banner("unchanged backs off")
+
+        feed.schedule.state["cadence"] = None
+        feed.schedule.state["unchanged"] = 0
+        for i in range(3):
+            feed.index({ "canto_update" : now, "entries" : [] })
+        if feed.schedule.interval() != base * 1.5 ** 3:
+            raise Exception("Unchanged didn't back off: %d" % feed.schedule.interval())
+
+        self.banner("hints")
+
+        feed.schedule.fetched({ "headers" : { "retry-after" : "3600",
+            "cache-control" : "public, max-age=60" }, "feed" : { "ttl" : "120" },
+            "etag" : '"abc"' })
+
+        if feed.schedule.needs_update(0):
+            raise Exception("Retry-After not honored")
+        if feed.schedule.state["ttl"] != 7200 or feed.schedule.interval() < 7200:
+            raise Exception("ttl not honored")
+        if feed.schedule.request_headers() != { "If-None-Match" : '"abc"' }:
+            raise Exception("Bad conditional headers")
+
+        # Not modified keeps the hints from the last full response.
+
+        feed.schedule.fetched({ "status" : 304, "headers" : {}, "feed" : {},
+            "entries" : [] })
+
+        if feed.schedule.state["ttl"] != 7200 or feed.schedule.interval() < 7200:
+            raise Exception("ttl lost on 304: %s" % feed.schedule.state["ttl"])
+
+        hours = skip_hours_from(b"<rss><skipHours><hour>0</hour><hour>23</hour>" +
+                b"<hour>24</hour></skipHours></rss>")
+        if hours != [ 0, 23 ]:
+            raise Exception("Bad skipHours parse: %s" % hours)
+
+        self.banner("persistence")
+
+        if test_shelf[TEST_URL]["canto-schedule"]["unchanged"] != 3:
+            raise Exception("Schedule not persisted")
+
+        allfeeds.reset()
+        feed = CantoFeed(test_shelf, "Test Feed", TEST_URL, 10, 86400, False)
+        feed.index({ "entries" : [] })
+
+        if feed.schedule.state["unchanged"] != 3 or feed.schedule.state["etag"] != '"abc"':
+            raise Exception("Schedule not loaded: %s" % feed.schedule.state)
+
+        self.banner("failure backoff")
+
+        dead = CantoFeed(test_shelf, "Dead Feed", TEST_URL + "dead", 10, 86400, False)
+        now = time.time()
+
+        dead.schedule.failed("Connection refused")
+        if dead.schedule.next_update(now - base) < now + base - 5:
+            raise Exception("First failure didn't delay by rate")
+
+        dead.schedule.failed("Connection refused")
+        if dead.schedule.next_update(now - base) < now + base * 2 - 5:
+            raise Exception("Second failure didn't double delay")
+
+        if test_shelf[TEST_URL + "dead"]["canto-schedule"]["failures"] != 2:
+            raise Exception("Failures not persisted")
+
+        self.banner("circuit breaker")
+
+        for i in range(CIRCUIT_THRESHOLD - 2):
+            dead.schedule.failed("Connection refused")
+
+        if dead.schedule.circuit() != "open":
+            raise Exception("Circuit didn't open: %s" % dead.schedule.circuit())
+        if dead.schedule.needs_update(0):
+            raise Exception("Open circuit still fetching")
+
+        dead.schedule.state["last_failure"] = now - MAX_FAILURE_DELAY
+        if dead.schedule.circuit() != "half-open" or not dead.schedule.needs_update(0):
+            raise Exception("Circuit didn't half-open")
+
+        dead.schedule.succeeded()
+        if dead.schedule.circuit() != "closed" or dead.schedule.state["last_error"]:
+            raise Exception("Circuit didn't close on success")
+
+        # Load happens on first index, so it should pick up the stub.
+
+        allfeeds.reset()
+        test_shelf[TEST_URL + "dead"]["canto-schedule"]["failures"] = 3
+        dead = CantoFeed(test_shelf, "Dead Feed", TEST_URL + "dead", 10, 86400, False)
+        dead.index({ "entries" : [] })
+        if dead.schedule.state["failures"] != 3:
+            raise Exception("Failures not loaded")
+
+        return True
+
+TestSchedule("schedule")
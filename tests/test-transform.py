@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from base import *
+
+from canto_next.transform import ContentFilter, ContentFilterRegex,\
+        AllTransform, AnyTransform, ItemLimit, StateFilter, SortTransform,\
+        regex_literal, transform_locals
+from canto_next.sortindex import sortindex
+from canto_next.tag import alltags
+
+import re
+
+VALUES = [ "linux", "Linux", "about linux today", "nothing here",
+        "first line\nlinux on the second", "linux first\nthen more",
+        "a.b (c)", "axb (c)", "", "two\nlines", "\nlinux" ]
+
+class TestTransform(Test):
+    def items(self):
+        attrs = {}
+        items = []
+        for i, v in enumerate(VALUES):
+            items.append("id%d" % i)
+            attrs["id%d" % i] = { "title" : v }
+
+        # Missing attribute is kept, non-string is dropped.
+
+        items.append("missing")
+        attrs["missing"] = {}
+        items.append("number")
+        attrs["number"] = { "title" : 1 }
+
+        return items, attrs
+
+    # What ContentFilterRegex did before it learned shortcuts.
+
+    def slow_filter(self, regex, items, attrs):
+        r = []
+        for item in items:
+            if "title" not in attrs[item]:
+                r.append(item)
+            elif type(attrs[item]["title"]) != str:
+                continue
+            elif not re.match(regex, attrs[item]["title"]):
+                r.append(item)
+        return r
+
+    def check(self):
+        self.banner("literals")
+
+        for regex, literal in [ (".*linux.*", "linux"), (".*.*", ""),
+                (".*" + re.escape("a.b (c)") + ".*", "a.b (c)"),
+                (".*\\d.*", None), (".*a|b.*", None), ("linux.*", None),
+                (".*a\\.*", None), (".*[ab].*", None) ]:
+            if regex_literal(regex) != literal:
+                raise Exception("regex_literal(%s) = %s, expected %s" %\
+                        (regex, regex_literal(regex), literal))
+
+        self.banner("same as regex")
+
+        items, attrs = self.items()
+        for string in [ "linux", "a.b (c)", "", "\n", "o\nl", "first\nthen" ]:
+            f = ContentFilter("title", string)
+            if f.literal != string:
+                raise Exception("ContentFilter(%s) isn't literal" % string)
+
+            got = f.transform(items, attrs)
+            expected = self.slow_filter(".*" + re.escape(string) + ".*",
+                    items, attrs)
+            if got != expected:
+                raise Exception("ContentFilter(%s): %s, expected %s" %\
+                        (string, got, expected))
+
+        for regex in [ ".*(linux|here).*", "[Ll]inux", ".*\\(c\\)$" ]:
+            f = ContentFilterRegex("title", regex)
+            expected = self.slow_filter(regex, items, attrs)
+
+            # Twice, to check the cached results.
+
+            for i in range(2):
+                got = f.transform(items, attrs)
+                if got != expected:
+                    raise Exception("ContentFilterRegex(%s): %s, expected %s"\
+                            % (regex, got, expected))
+
+        self.banner("fused")
+
+        filters = [ ContentFilter("title", "linux"),
+                ContentFilterRegex("title", ".*here.*"),
+                ContentFilter("title", "two") ]
+
+        expected = items
+        for f in filters:
+            expected = f.transform(expected, attrs)
+
+        a = AllTransform(*filters)
+        if len(a.steps) != 1:
+            raise Exception("Filters not fused: %s" % a.steps)
+        got = a.transform(items, attrs)
+        if got != expected:
+            raise Exception("Fused All: %s, expected %s" % (got, expected))
+
+        # Anything in between isn't fused over.
+
+        a = AllTransform(filters[0], ItemLimit(3), filters[1])
+        if len(a.steps) != 3:
+            raise Exception("Fused over ItemLimit: %s" % a.steps)
+
+        # Any keeps the order of what each filter kept.
+
+        expected = []
+        for f in filters:
+            for item in f.transform(items, attrs):
+                if item not in expected:
+                    expected.append(item)
+
+        got = AnyTransform(*filters).transform(items, attrs)
+        if got != expected:
+            raise Exception("Fused Any: %s, expected %s" % (got, expected))
+
+        self.banner("limit")
+
+        sortindex.reset()
+        alltags.reset()
+
+        items = []
+        attrs = {}
+        for f in range(3):
+            url = "http://example.com/%d/" % f
+            new = {}
+            for i in range(20):
+                id = '{"URL": "%s", "ID": "%d"}' % (url, i)
+                new[id] = { "title" : "Title %d" % i,
+                        "canto_update" : i * 3 + f }
+                attrs[id] = new[id]
+                items.append(id)
+                alltags.set_read(id, i % 3 == 0)
+            sortindex.update(url, {}, new)
+
+        sort_date = transform_locals["sort_date"]
+        sort_feed = transform_locals["sort_feed"]
+
+        chains = [ [ StateFilter("read"), sort_date ],
+                [ sort_date, ContentFilter("title", "Title 1") ],
+                [ ContentFilter("title", "Title 1"), StateFilter("-read") ],
+                [ sort_feed, StateFilter("read") ] ]
+
+        for chain in chains:
+            for limit in [ 1, 7, 100 ]:
+                a = AllTransform(*(chain + [ ItemLimit(limit) ]))
+                if a.limit != limit:
+                    raise Exception("Not limited: %s" % a)
+
+                expected = AllTransform(*chain).transform(items, attrs)[:limit]
+                got = a.transform(items, attrs)
+                if got != expected:
+                    raise Exception("%s: %s, expected %s" % (a, got, expected))
+
+        # Anything that cares about order, or a limit that isn't last, runs
+        # the whole tag.
+
+        for chain in [ [ ItemLimit(5), StateFilter("read") ],
+                [ SortTransform("Sort", "title"), ItemLimit(5) ],
+                [ sort_date, sort_feed, ItemLimit(5) ] ]:
+            if AllTransform(*chain).limit:
+                raise Exception("Shouldn't be limited: %s" % chain)
+
+        return True
+
+TestTransform("transform")